@@ -0,0 +1,57 @@
+###################
+# Driver script for genome-scale 1D loop extrusion: many loci or whole chromosomes in one run
+# Domains, CTCF sites (with orientation) and cohesin loading regions are read from BED-like files,
+# and every domain's trajectory is written to its own dataset (domains/<name>/positions).
+#
+# Usage: python3 1D_genome_simulation.py domains.bed ctcf.bed [--loading loading.bed] [--resolution 1000] ...
+#   domains.bed - chrom start end [name] [LEFs per 1000 monomers] [lifetime] [stalled lifetime]
+#   ctcf.bed    - chrom start end [name] [score] [strand] [capture prob.] [release prob.]
+#   loading.bed - chrom start end [weight]
+###################
+import sys
+import time
+import argparse
+from lef_genome import read_domains, read_blockers, read_loading, build_engine, write_domains
+from parallel_engine import ParallelLEFEngine
+from trajectory_cache import canonical_json
+
+def main():
+    parser = argparse.ArgumentParser(description='Genome-scale 1D loop extrusion simulation')
+    parser.add_argument('domains', help='BED-like file of domains (loci or chromosomes)')
+    parser.add_argument('ctcf', help='BED-like file of CTCF sites and their orientation')
+    parser.add_argument('--loading', default=None, help='BED-like file of cohesin loading regions (default: load uniformly in each domain)')
+    parser.add_argument('--resolution', type=int, default=1000, help='base pairs per monomer')
+    parser.add_argument('--density', type=float, default=5, help='LEFs per 1000 monomers, for domains without their own')
+    parser.add_argument('--lifetime', type=float, default=800, help='cohesin lifetime, for domains without their own')
+    parser.add_argument('--capture', type=float, default=0.5, help='capture probability, for sites without their own')
+    parser.add_argument('--release', type=float, default=0.01, help='release probability, for sites without their own')
+    parser.add_argument('--steps', type=int, default=50000, help='1D steps')
+    parser.add_argument('--chunk', type=int, default=1000, help='frames simulated and written at a time')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes; more than 1 splits the polymer between them (see parallel_engine.py)')
+    parser.add_argument('--window', type=int, default=10, help='steps between synchronizations of the workers (results do not depend on it)')
+    parser.add_argument('--backend', default='auto', help='translocation kernel: auto, numpy, numba or python (see lef_backends.py)')
+    parser.add_argument('--out', default='trajectory/genome_LEFPositions.h5', help='output file')
+    args = parser.parse_args()
+
+    domains = read_domains(args.domains, args.resolution, density=args.density, lifetime=args.lifetime,
+                           lifetime_stalled=args.lifetime // 10)
+    blockers = read_blockers(args.ctcf, domains, capture=args.capture, release=args.release)
+    if args.loading is not None:
+        read_loading(args.loading, domains)
+    engine, lefRanges = build_engine(domains, blockers, seed=args.seed, backend=args.backend)
+    print('{} domains, {} monomers, {} LEFs, {} blocker sites'.format(len(domains), engine.N, engine.nLEF,
+                                                                     len(blockers.sites[0]) + len(blockers.sites[1])))
+    t = time.time()
+    if args.workers > 1:
+        engine = ParallelLEFEngine(engine, workers=args.workers, window=args.window, seed=args.seed)
+    try:
+        write_domains(engine, domains, lefRanges, args.out, args.steps, chunk=args.chunk,
+                      attrs={"params": canonical_json(vars(args))})
+    finally:
+        if args.workers > 1:
+            engine.close()
+    print('Wrote {} in {:.1f} s'.format(args.out, time.time() - t))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,15 +6,14 @@
 ###################
 
 ### 1-D loop extrusion simulation
-from extruder import Extruder
+import argparse
+from lef_simulation import run_1D, parse_seed
 import numpy as np
-from pathlib import Path
-import seaborn as sns
-import h5py
-import sys
-import os
 
-def main():
+def parameters():
+    """
+    Resolved parameters and metadata of this run; the 3D driver also calls this to run both stages at once (--pipe)
+    """
     ###############################################################
     ### Translocating and writing trajectories using custom extruder class
     # Basic parameters for simulation run
@@ -26,11 +25,8 @@ def main():
     N1 = N1_pol + front_buffer + end_buffer
     M = 1 # No. of systems
     N = N1*M # Total size of system, in momomers
-    occupied = np.zeros(N) # List to tell if current monomer is occupied by an extruder
-    occupied[0] = 1 
-    occupied[-1] = 1
     steps = 50000 # Timesteps for 1D sim.
-    num_chunks = 50 # No. of chunks to write trajectories in
+    SEED = 0 # Random seed; identical parameters and seed give identical trajectories (and are read from the cache). Override with --seed
     LIFETIME = 800 # Cohesin lifetime
     LIFETIME_STALLED = LIFETIME // 10 # Cohesin lifetime when stalled
 
@@ -147,77 +143,33 @@ def main():
 
     ### Number of cohesins per loading region (each index is associated with the corresponding index of the loading_regions list)
     loading_region_freqs = [14]
-    LEFNum = np.sum(loading_region_freqs)
 
     ### Beyond this point, you need not change any variable values.
     ###############################################################
 
-    # Generate (initial) loading region spots for the loading region LEFs and list of loading site for each LEF
-    LOADING_SPOTS = []
-    REGIONS_INDEX = []
-    for i, region in enumerate(loading_regions):
-        print(i, region)
-        for j in range(loading_region_freqs[i]):
-            while True:
-                spot = np.random.randint(low=region[0], high=region[1])
-                if spot not in LOADING_SPOTS and spot+1 not in LOADING_SPOTS and spot-1 not in LOADING_SPOTS:
-                    print(spot)
-                    break
-            LOADING_SPOTS.append(spot)
-            REGIONS_INDEX.append(loading_regions[i])
-    print(REGIONS_INDEX)
-
-    EXTRUDERS = []
-    targeted_idx = 0
-    for i in range(len(LOADING_SPOTS)):
-        #leg = np.random.randint(N)
-        #print('Loading extruder at {}'.format(LOADING_SPOTS[i]))
-        leg = LOADING_SPOTS[i]
-        print('Loading extruder at {}, its loading region is {}'.format(leg, REGIONS_INDEX[i]))
-        EXTRUDERS.append(Extruder(
-                extruder_index = i,
-                leg1 = leg,
-                leg2 = leg+1,
-                left_blockers_capture = left_blockers_capture,
-                right_blockers_capture = right_blockers_capture,
-                left_blockers_release = left_blockers_release,
-                right_blockers_release = right_blockers_release,
-                extrusion_occupancy = occupied,
-                loading_region = REGIONS_INDEX[i],
-                lifetime = LIFETIME,
-                lifetime_stalled = LIFETIME_STALLED)
-        )
-
-    ### Write parameters to text file
-    print(os.getcwd())
-    with open('{}_params.txt'.format(RUN_NAME),'w+') as pf:
-        pf.write("N: {}\n1D Steps: {}\nTotal LEF: {}\nLoading Regions: {} LEFs per loading region: {}\n Lifetime: {} Lifetime stalled: {}\nBlocking Regions: {}\nLeft cap: {}, Left rel: {}\nRight cap: {}, Right rel: {}".format(
-                                                                                                N1,steps,LEFNum,
-                                                                                                REGIONS_INDEX,loading_region_freqs,
-                                                                                                LIFETIME,LIFETIME_STALLED,blockingRegions,left_blockers_capture,left_blockers_release,
-                                                                                                right_blockers_capture,right_blockers_release))
+    ### Resolved parameters of this run. Reruns with identical parameters (including SEED) are read from the trajectory cache
+    params = {"N": N, "front_buffer": front_buffer, "end_buffer": end_buffer, "steps": steps,
+              "LIFETIME": LIFETIME, "LIFETIME_STALLED": LIFETIME_STALLED,
+              "left_blockers_capture": left_blockers_capture, "right_blockers_capture": right_blockers_capture,
+              "left_blockers_release": left_blockers_release, "right_blockers_release": right_blockers_release,
+              "loading_regions": loading_regions, "loading_region_freqs": loading_region_freqs,
+              "seed": SEED}
+    ### Stored with the trajectory (HDF5 attributes), but not part of the cache key
+    metadata = {"RUN_NAME": RUN_NAME, "blockingRegions": blockingRegions}
+    return params, metadata
+
+def main():
+    parser = argparse.ArgumentParser(description='1D loop extrusion simulation; the trajectory is written to trajectory/LEFPositions.h5')
+    parser.add_argument('--seed', type=parse_seed, default=None,
+                        help='random seed replacing SEED (an int, or "random" for a new trajectory at every run)')
+    args = parser.parse_args()
+    params, metadata = parameters()
+    if args.seed is not None:
+        params["seed"] = args.seed
+    num_chunks = 50 # No. of chunks to write trajectories in
     outf = "trajectory/LEFPositions.h5"
-    p = Path(outf)
-    if p.exists():
-        p.unlink()
-    with h5py.File(outf, mode='w') as f:
-        dset = f.create_dataset("positions", 
-                shape=(steps, LEFNum, 2), 
-                dtype=np.int32, 
-                compression="gzip")
-        bins = np.linspace(0, steps, num_chunks, dtype=int)
-        for st,end in zip(bins[:-1], bins[1:]): # Loop through bins
-            cur = []
-            for i in range(st,end): # For bin in bins 
-                positions = [(extruder.leg1.pos, extruder.leg2.pos) for extruder in EXTRUDERS] # Get both leg positions for all extruders
-                cur.append(positions)
-                for extruder in EXTRUDERS:
-                    occupied = extruder.translocate(occupied) # Translocate extruder
-            cur = np.array(cur)
-            dset[st:end] = np.array(cur)
-        f.attrs["N"] = N
-        f.attrs["LEFNum"] = LEFNum
-    del EXTRUDERS
+    key = run_1D(params, outf=outf, metadata=metadata, num_chunks=num_chunks)
+    print('Trajectory written to {} (seed {}, cache key {})'.format(outf, params["seed"], key))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,174 @@
+###################
+# Online steady-state (burn-in) and convergence detection
+# Statistics are averaged over windows of consecutive samples (1D steps, or 3D conformations):
+#   - burn-in ends at the first window w where the mean of windows [w, w+settle) agrees with the mean of the next
+#     settle windows, within tolerance plus two standard errors of their difference (window means are noisy),
+#     i.e. the statistics stopped drifting away from their starting values;
+#   - after burn-in, the run has converged once the standard error of the steady-state mean (batch means over the
+#     windows since burn-in) is within tolerance for every statistic.
+# ConvergenceMonitor tracks the loop size distribution (mean and spread) and the occupancy of each blocking region
+# for 1D trajectories; SeriesMonitor works on any per-sample statistics, i.e. the radius of gyration of 3D conformations.
+###################
+import numpy as np
+
+class SeriesMonitor():
+    def __init__(self, names, window=1000, settle=5, tolerance=0.05, atol=0.01, minWindows=10):
+        """
+        Parameters:
+            names - list of names of the tracked statistics
+            window - int, samples averaged per window
+            settle - int, windows compared on either side when looking for the end of burn-in
+            tolerance - float, relative tolerance (of drift for burn-in, of the standard error for convergence)
+            atol - float, absolute tolerance added to the relative one (for statistics close to 0, i.e. fractions)
+            minWindows - int, fewest steady-state windows before the run can count as converged
+        """
+        if settle < 2 or window < 1:
+            raise ValueError("Need window >= 1 and settle >= 2 (got {} and {})".format(window, settle))
+        self.names = list(names)
+        self.window = window
+        self.settle = settle
+        self.tolerance = tolerance
+        self.atol = atol
+        self.minWindows = minWindows
+        self.samples = 0
+        self.means = [] # Mean of every complete window
+        self.burnIn = None # Samples before steady state, once detected
+        self.converged = False
+        self._sum = np.zeros(len(self.names))
+        self._count = 0
+
+    def _within(self, diff, ref, noise=0):
+        return bool(np.all(np.abs(diff) <= self.tolerance * np.abs(ref) + self.atol + noise))
+
+    def add(self, values):
+        """
+        Add samples
+        Parameters:
+            values - (n, len(names)) array, the statistics of n consecutive samples (or one sample as a 1D array)
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self.names))
+        st = 0
+        while st < len(values):
+            take = min(self.window - self._count, len(values) - st)
+            self._sum += values[st:st+take].sum(axis=0)
+            self._count += take
+            st += take
+            if self._count == self.window:
+                self.means.append(self._sum / self.window)
+                self._sum = np.zeros(len(self.names))
+                self._count = 0
+                self._check()
+        self.samples += len(values)
+
+    def _check(self):
+        """
+        Look for the end of burn-in, then for convergence, after every complete window
+        """
+        n = len(self.means)
+        if self.burnIn is None and n >= 2 * self.settle:
+            w = n - 2 * self.settle
+            before, after = np.array(self.means[w:w+self.settle]), np.array(self.means[w+self.settle:])
+            # Variance of the window means from successive differences, which a slow drift hardly inflates
+            var = np.mean(np.diff(self.means[w:], axis=0) ** 2, axis=0) / 2
+            noise = 2 * np.sqrt(2 * var / self.settle)
+            if self._within(before.mean(axis=0) - after.mean(axis=0), after.mean(axis=0), noise):
+                self.burnIn = w * self.window
+        if self.burnIn is not None and not self.converged:
+            steady = np.array(self.means[self.burnIn // self.window:])
+            if len(steady) >= max(self.minWindows, 2):
+                self.converged = self._within(self.standard_error(), steady.mean(axis=0))
+
+    @property
+    def steady(self):
+        """
+        True once burn-in is over
+        """
+        return self.burnIn is not None
+
+    def mean(self):
+        """
+        Mean of every statistic over the steady-state windows (all windows before steady state)
+        """
+        if not self.means:
+            return np.full(len(self.names), np.nan)
+        return np.mean(self.means[(self.burnIn or 0) // self.window:], axis=0)
+
+    def standard_error(self):
+        """
+        Batch-means standard error of mean()
+        """
+        steady = np.array(self.means[(self.burnIn or 0) // self.window:])
+        if len(steady) < 2:
+            return np.full(len(self.names), np.inf)
+        return steady.std(axis=0, ddof=1) / np.sqrt(len(steady))
+
+    def summary(self):
+        """
+        Dict of burn_in (samples, -1 if not reached), converged, samples, and steady-state means and standard errors
+        """
+        return {"burn_in": -1 if self.burnIn is None else int(self.burnIn), "converged": self.converged,
+                "samples": int(self.samples), "window": int(self.window),
+                "mean": {name: float(v) for name, v in zip(self.names, self.mean())},
+                "standard_error": {name: float(v) for name, v in zip(self.names, self.standard_error())}}
+
+def blocking_regions(params):
+    """
+    Blocking regions of a parameter set: runs of consecutive blocker sites
+    """
+    if "blockingRegions" in params:
+        return {name: np.asarray(sites) for name, sites in params["blockingRegions"].items()}
+    sites = sorted(set(params["left_blockers_capture"]) | set(params["right_blockers_capture"]))
+    regions = {}
+    run = []
+    for s in sites:
+        if run and s != run[-1] + 1:
+            regions["b{}".format(run[0])] = np.array(run)
+            run = []
+        run.append(s)
+    if run:
+        regions["b{}".format(run[0])] = np.array(run)
+    return regions
+
+class ConvergenceMonitor(SeriesMonitor):
+    def __init__(self, N, blockingRegions, **kwargs):
+        """
+        SeriesMonitor of 1D frames: mean and standard deviation of the loop sizes, and for each blocking region
+        the fraction of frames with a leg in it
+        Parameters:
+            N - int, number of monomers
+            blockingRegions - dict {name: array of monomers}
+            kwargs - see SeriesMonitor (window in 1D steps)
+        """
+        self.regionNames = list(blockingRegions)
+        self.regionOf = np.full(N, -1, dtype=np.int64) # Blocking region index of each monomer, -1 if none
+        for r, name in enumerate(self.regionNames):
+            self.regionOf[np.asarray(blockingRegions[name], dtype=np.int64)] = r
+        names = ["loop_mean", "loop_sd"] + ["occupancy:{}".format(name) for name in self.regionNames]
+        super().__init__(names, **kwargs)
+
+    def update(self, frames):
+        """
+        Add a chunk of consecutive frames, (n, LEFNum, 2) leg positions
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        loops = frames[..., 1] - frames[..., 0]
+        region = self.regionOf[frames.reshape(len(frames), -1)] # (n, 2 * LEFNum)
+        occupancy = [np.any(region == r, axis=1) for r in range(len(self.regionNames))]
+        self.add(np.column_stack([loops.mean(axis=1), loops.std(axis=1)] + occupancy))
+
+def monitor_from_params(params):
+    """
+    ConvergenceMonitor for the "convergence" entry of a dict of resolved 1D parameters, if any
+    Parameters:
+        params - dict; params["convergence"] holds SeriesMonitor arguments, plus optionally "stop" (end the run
+                 once converged) and "blockingRegions" ({name: monomers}, default: runs of blocker sites)
+    Returns:
+        (ConvergenceMonitor or None, stop)
+    """
+    options = dict(params.get("convergence") or {})
+    if not options:
+        return None, False
+    stop = bool(options.pop("stop", False))
+    regions = options.pop("blockingRegions", None)
+    regions = blocking_regions(params) if regions is None else {name: np.asarray(sites) for name, sites in regions.items()}
+    return ConvergenceMonitor(params["N"], regions, **options), stop
@@ -0,0 +1,196 @@
+###################
+# Statistical-equivalence harness for 1D engines
+# Runs the reference Extruder engine and a candidate engine with many seeds, in parallel,
+# and compares loop size distributions, occupancy profiles, stall fractions, blocker residence
+# times and LEF lifetimes with two-sample KS and (permutation) chi-square tests.
+#
+# An engine is a function engine(params, seed) returning a (steps, LEFNum, 2) array of leg positions.
+# Run as: python3 equivalence.py [module:function] [--seeds 32]
+# or as python3 equivalence.py --backends to check that the LEFEngine backends (lef_backends.py) agree exactly.
+###################
+import sys
+import argparse
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats as ss
+from lef_simulation import load_extruders, record_positions
+from lef_analysis import TrajectoryStats
+from convergence import blocking_regions
+
+def scenario(N=500, LEFNum=10, steps=5000, lifetime=200):
+    """
+    Small test system with blockers of every kind (left, right and bidirectional, strong and weak)
+    Returns:
+        dict of resolved 1D parameters
+    """
+    lc, rc, lr, rr = {}, {}, {}, {}
+    for pos in range(100, 104): # Left-facing, strong
+        lc[pos], lr[pos] = 0.9, 0.005
+    for pos in range(240, 246): # Bidirectional, medium
+        lc[pos], lr[pos] = 0.4, 0.05
+        rc[pos], rr[pos] = 0.4, 0.05
+    for pos in range(380, 384): # Right-facing, strong
+        rc[pos], rr[pos] = 0.75, 0.001
+    rc[300], rr[300] = 0.05, 0.05 # Single weak blocker
+    return {"N": N, "steps": steps, "LIFETIME": lifetime, "LIFETIME_STALLED": lifetime // 10,
+            "left_blockers_capture": lc, "right_blockers_capture": rc,
+            "left_blockers_release": lr, "right_blockers_release": rr,
+            "loading_regions": [[10, N - 11]], "loading_region_freqs": [LEFNum]}
+
+def reference_engine(params, seed):
+    """
+    Reference engine: Extruder objects stepped as in the 1D drivers
+    """
+    np.random.seed(seed)
+    N = params["N"]
+    occupied = np.zeros(N)
+    occupied[0] = 1
+    occupied[-1] = 1
+    EXTRUDERS = load_extruders(occupied, params["loading_regions"], params["loading_region_freqs"],
+                               params["left_blockers_capture"], params["right_blockers_capture"],
+                               params["left_blockers_release"], params["right_blockers_release"],
+                               params["LIFETIME"], params["LIFETIME_STALLED"])
+    positions, occupied = record_positions(EXTRUDERS, occupied, params["steps"])
+    return positions
+
+def _run(args):
+    """
+    Run one engine with one seed and reduce its trajectory to the samples the tests need
+    """
+    engine, params, seed, burnIn, thin, binSize = args
+    positions = np.asarray(engine(params, seed), dtype=np.int64)[burnIn:]
+    N = params["N"]
+    regions = blocking_regions(params)
+    st = TrajectoryStats(N, positions.shape[1], blockingRegions=regions)
+    st.update(positions)
+    thinned = positions[::thin]
+    legFrames = np.maximum(st.legFrames, 1)
+    return {"loop_sizes": (thinned[..., 1] - thinned[..., 0]).ravel(),
+            "occupancy": np.bincount(thinned.ravel() // binSize, minlength=N // binSize + 1),
+            "stall_fraction": {name: st.stalledFrames[r] / legFrames[r] for r, name in enumerate(st.regionNames)},
+            "capture_fraction": {name: st.capturedFrames[r] / legFrames[r] for r, name in enumerate(st.regionNames)},
+            "residence": st.blockerResidence,
+            "lifetimes": np.array(st.lifetimes)}
+
+def _chi2_permutation(profilesA, profilesB, permutations=2000, seed=0):
+    """
+    Chi-square distance between the mean profiles of two groups of runs, with a permutation p-value.
+    Runs are independent while frames within a run are not, so runs are what gets permuted
+    """
+    profiles = np.array([p / max(p.sum(), 1) for p in list(profilesA) + list(profilesB)])
+    nA = len(profilesA)
+
+    def distance(order):
+        a, b = profiles[order[:nA]].mean(axis=0), profiles[order[nA:]].mean(axis=0)
+        denom = a + b
+        return np.sum((a - b)[denom > 0] ** 2 / denom[denom > 0])
+
+    rng = np.random.RandomState(seed)
+    observed = distance(np.arange(len(profiles)))
+    null = [distance(rng.permutation(len(profiles))) for i in range(permutations)]
+    return (1 + np.sum(np.array(null) >= observed)) / (1 + permutations)
+
+def _ks(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    if len(a) < 2 or len(b) < 2:
+        return float("nan")
+    return ss.ks_2samp(a, b).pvalue
+
+def compare_engines(candidate, params=None, seeds=32, reference=reference_engine, burnIn=1000, thin=None,
+                    binSize=10, alpha=0.01, processes=None):
+    """
+    Compare a candidate engine against the reference in distribution
+    Parameters:
+        candidate - engine function (must be importable at module level, for the process pool)
+        params - dict of resolved 1D parameters; defaults to scenario()
+        seeds - number of independent runs per engine
+        burnIn - frames discarded at the start of every run
+        thin - keep every thin-th frame for loop size and occupancy samples, to reduce autocorrelation (default: LIFETIME)
+        binSize - monomers per bin of the occupancy profile
+        alpha - family-wise significance level (Bonferroni-corrected over all tests)
+    Returns:
+        (passed, list of (test name, p-value))
+    """
+    params = scenario() if params is None else params
+    thin = params["LIFETIME"] if thin is None else thin
+    # Different seeds for the two engines, so that comparing the reference with itself is a meaningful check
+    jobs = [(reference, params, seed, burnIn, thin, binSize) for seed in range(seeds)]
+    jobs += [(candidate, params, seeds + seed, burnIn, thin, binSize) for seed in range(seeds)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        runs = list(pool.map(_run, jobs))
+    ref, cand = runs[:seeds], runs[seeds:]
+
+    tests = []
+    tests.append(("loop size (KS)", _ks(np.concatenate([r["loop_sizes"] for r in ref]),
+                                        np.concatenate([r["loop_sizes"] for r in cand]))))
+    tests.append(("occupancy profile (chi2 permutation)", _chi2_permutation([r["occupancy"] for r in ref],
+                                                                             [r["occupancy"] for r in cand])))
+    tests.append(("LEF lifetime (KS)", _ks(np.concatenate([r["lifetimes"] for r in ref]),
+                                           np.concatenate([r["lifetimes"] for r in cand]))))
+    for name in ref[0]["stall_fraction"]:
+        # Per-run fractions are independent samples across seeds
+        tests.append(("stall fraction {} (KS)".format(name), _ks([r["stall_fraction"][name] for r in ref],
+                                                                 [r["stall_fraction"][name] for r in cand])))
+        tests.append(("capture fraction {} (KS)".format(name), _ks([r["capture_fraction"][name] for r in ref],
+                                                                   [r["capture_fraction"][name] for r in cand])))
+        tests.append(("residence {} (KS)".format(name), _ks(sum([r["residence"][name] for r in ref], []),
+                                                            sum([r["residence"][name] for r in cand], []))))
+    valid = [p for name, p in tests if not np.isnan(p)]
+    passed = all(p >= alpha / max(len(valid), 1) for p in valid)
+    return passed, tests
+
+def compare_backends(params=None, seeds=4, backends=None):
+    """
+    Check that LEFEngine gives the same trajectory with every translocation backend (see lef_backends.py) as with numpy
+    Parameters:
+        backends - list of backend names (default: all installed ones)
+    Returns:
+        (passed, list of (backend, number of seeds with an identical trajectory))
+    """
+    from lef_engine import engine_from_params
+    from lef_backends import available_backends
+    params = scenario() if params is None else params
+    backends = available_backends() if backends is None else backends
+    results = []
+    for backend in backends:
+        same = 0
+        for seed in range(seeds):
+            ref = engine_from_params(params, seed, backend="numpy").run(params["steps"])
+            same += np.array_equal(engine_from_params(params, seed, backend=backend).run(params["steps"]), ref)
+        results.append((backend, same))
+    return all(same == seeds for backend, same in results), results
+
+def load_engine(spec):
+    """
+    Import an engine given as "module:function"
+    """
+    module, func = spec.split(':')
+    return getattr(importlib.import_module(module), func)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a 1D engine reproduces the reference Extruder in distribution')
+    parser.add_argument('candidate', nargs='?', default='equivalence:reference_engine', help='engine as module:function')
+    parser.add_argument('--seeds', type=int, default=32, help='runs per engine')
+    parser.add_argument('--steps', type=int, default=5000, help='1D steps per run')
+    parser.add_argument('--alpha', type=float, default=0.01, help='family-wise significance level')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--backends', action='store_true', help='instead, check that all LEFEngine backends give identical trajectories')
+    args = parser.parse_args()
+
+    if args.backends:
+        passed, results = compare_backends(params=scenario(steps=args.steps), seeds=args.seeds)
+        for backend, same in results:
+            print('{:<40s} {}/{} identical'.format(backend, same, args.seeds))
+        print('PASSED' if passed else 'FAILED')
+        return 0 if passed else 1
+
+    passed, tests = compare_engines(load_engine(args.candidate), params=scenario(steps=args.steps), seeds=args.seeds,
+                                    alpha=args.alpha, processes=args.processes)
+    for name, p in tests:
+        print('{:<40s} p = {:.4g}'.format(name, p))
+    print('PASSED' if passed else 'FAILED')
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,14 @@
 import numpy as np
 import sys
+from lef_loading import LoadingSpots
+
+STALLED = 1 # Leg flag bits
+CAPTURED = 2
+FLAGS = {'stalled': STALLED, 'captured': CAPTURED}
 
 class Extruder():
+    __slots__ = ('waiting', 'ex_index', 'targeted_loading', 'loading_region', 'loading_spots', 'nLEF', 'loading_dist',
+                 'leg1', 'leg2', 'legs', 'occupied', 'lifetime', 'lifetime_stalled')
     def __init__(self, extruder_index, leg1, leg2, left_blockers_capture, right_blockers_capture, left_blockers_release, right_blockers_release, extrusion_occupancy, loading_region, lifetime=100, lifetime_stalled=10, targeted_loading=False, loading_spots=None, loading_dist=None):
         """
         Class defining a generic Loop Extrusion Factor (LEF)
@@ -12,8 +19,8 @@ class Extruder():
             left/right_ blockers - dicts: each dict of form {pos:prob}, where pos is position of blocker and prob is capture probability [0,1]. Left-facing blockers and right-facing in respective dicts
             extrusion_occupancy - list of ints, denotes positions on polymer that are occupied by an extruder
             targeted_loading - boolean, are extruders to be loaded at predetermined positions?
-            loading_spots - list, all loading index positions for all extruders
-            loading_dist - list, probabilities of loading at each spot 
+            loading_spots - list, all loading index positions for all extruders, or a LoadingSpots shared by all extruders (see lef_loading.py)
+            loading_dist - list, probabilities of loading at each spot (with a list of loading_spots)
             random_with_targeted - boolean, do random (uniform) loading in addition to targeted loading
             loading_regions - list of lists definign (random) cohesin loading regions, i.e. [[start1, end1], [start2, end2], ...]
         """
@@ -22,32 +29,25 @@ class Extruder():
         self.targeted_loading = targeted_loading
         self.loading_region = loading_region
         # Checks
-        if (not targeted_loading and loading_spots != None) or (targeted_loading and loading_spots == None):
+        if (not targeted_loading and loading_spots is not None) or (targeted_loading and loading_spots is None):
             print('ERROR - Please specify both targeted loading as true AND a list of ALL loading spots for ALL extruders.')
             sys.exit(1)
         if targeted_loading: # If we have specified loading, we will first load the extruders at their defined spots 
-            self.loading_spots = loading_spots
-            leg1 = loading_spots[self.ex_index] # int of leg position
-            leg2 = leg1+1 # int of other leg position
-            self.nLEF = len(loading_spots)
-            if loading_dist == None:
-                #print('{} extruders'.format(self.nLEF))
-                self.loading_dist = np.linspace(1/self.nLEF, 1, num=self.nLEF)
-                #print(self.loading_dist)
+            if isinstance(loading_spots, LoadingSpots): # Shared between extruders; leg1 and leg2 are the initial positions
+                self.loading_spots = loading_spots
             else:
-                # make probabilities cumulative
-                loading_distribution = []
-                s = 0
-                for i,x in enumerate(loading_dist):
-                    s += x
-                    loading_distribution.append(s)
-                    
-                self.loading_dist = loading_distribution
+                leg1 = loading_spots[self.ex_index] # int of leg position
+                leg2 = leg1+1 # int of other leg position
+                self.loading_spots = LoadingSpots(loading_spots, loading_dist) # loading_dist=None loads uniformly; pass one LoadingSpots to share its table
+            self.nLEF = len(self.loading_spots)
+            self.loading_dist = self.loading_spots.cdf
             
         self.leg1 = self.ExtruderLeg(leg1, -1)
         self.leg2 = self.ExtruderLeg(leg2, 1)
-        self.blockers_capture = {-1:left_blockers_capture, 1:right_blockers_capture}
-        self.blockers_release = {-1:left_blockers_release, 1:right_blockers_release}
+        self.legs = (self.leg1, self.leg2)
+        # Each leg keeps the blocker dicts of its side
+        self.leg1.blockers_capture, self.leg1.blockers_release = left_blockers_capture, left_blockers_release
+        self.leg2.blockers_capture, self.leg2.blockers_release = right_blockers_capture, right_blockers_release
         self.occupied = extrusion_occupancy
         #print(self.occupied)
         self.occupied[self.leg1.pos] = 1
@@ -57,41 +57,45 @@ class Extruder():
         self.lifetime = lifetime
         self.lifetime_stalled = lifetime_stalled
 
+    @property
+    def blockers_capture(self):
+        return {-1:self.leg1.blockers_capture, 1:self.leg2.blockers_capture}
+    @property
+    def blockers_release(self):
+        return {-1:self.leg1.blockers_release, 1:self.leg2.blockers_release}
+
     def _any(self, attribute):
         """
-        Returns true if either leg is true for attribute
+        Returns true if either leg is true for attribute ('stalled', 'captured', or a flag bit)
         """
-        return self.leg1.attrs[attribute] or self.leg2.attrs[attribute]
+        return bool((self.leg1.flags | self.leg2.flags) & FLAGS.get(attribute, attribute))
     def _all(self, attribute):
         """
         Returns true if both legs are true for attribute
         """
-        return self.leg1.attrs[attribute] and self.leg2.attrs[attribute]
+        bit = FLAGS.get(attribute, attribute)
+        return bool(self.leg1.flags & self.leg2.flags & bit)
     def capture(self):
         """
         Attempt to 'capture' a LEF with a blocker
         """
-        #print('Starting capture, leg info:\n')
-        #self.printLegInfo()
-        legs = [self.leg1, self.leg2]
-        for i in range(len(legs)):
+        for leg in self.legs:
             p = np.random.random()
-            #print('Capture prob. for leg {} at pos {}: {}'.format(leg.side, leg.pos, self.blockers_capture[leg.side].get(leg.pos, 0)))
-            if p < self.blockers_capture[legs[i].side].get(legs[i].pos, 0):
-                #print('Leg {} captured at pos {} with prob. {}'.format(legs[i].side, legs[i].pos, p))
-                legs[i].setAttribute('captured',True)
+            if p < leg.blockers_capture.get(leg.pos, 0):
+                #print('Leg {} captured at pos {} with prob. {}'.format(leg.side, leg.pos, p))
+                leg.flags |= CAPTURED
     def release(self):
         """
         And attempt to release an LEF captured by a blocker
         """
-        if not self._any('captured'):
+        if not (self.leg1.flags | self.leg2.flags) & CAPTURED:
             #print('No captured legs, not trying to release...')
             return
-        for leg in [self.leg1, self.leg2]:
+        for leg in self.legs:
             p = np.random.random()
-            if (p < self.blockers_release[leg.side].get(leg.pos, 0)):
+            if (p < leg.blockers_release.get(leg.pos, 0)):
                 #print('Leg {} released at pos {} with prob {}'.format(leg.side, leg.pos, p))
-                leg.attrs['captured'] = False
+                leg.flags &= ~CAPTURED
     def translocate(self, occupied):
         """
         The main function. Performs 3 main functions:
@@ -112,24 +116,25 @@ class Extruder():
         self.capture()
         self.release()
         # 3 - translocate cohesin
-        #print(self.occupied)
-        for leg in [self.leg1, self.leg2]:
-            #print('Leg {}: captured = {}'.format(leg.pos, leg.attrs['captured']))
-            if not leg.attrs['captured']:
-                if (leg.pos + leg.side) >= len(self.occupied) or self.occupied[leg.pos + leg.side] != 0:
-                    #print('Leg {} stalled at pos {} because it is marked as {}'.format(leg.side, leg.pos, self.occupied[leg.pos+leg.side]))
-                    leg.attrs['stalled'] = True
+        occupied = self.occupied
+        N = len(occupied)
+        for leg in self.legs:
+            flags = leg.flags
+            if not flags & CAPTURED:
+                pos = leg.pos
+                new = pos + leg.side
+                if new >= N or occupied[new] != 0:
+                    #print('Leg {} stalled at pos {} because it is marked as {}'.format(leg.side, pos, occupied[new]))
+                    leg.flags = flags | STALLED
                 else:
-                    #print('Leg at {} translocating'.format(leg.pos))
-                    leg.attrs['stalled'] = False
-                    self.occupied[leg.pos] = 0
-                    self.occupied[leg.pos + leg.side] = 1
-                    #print(self.occupied)
-                    leg.pos += leg.side
+                    leg.flags = flags & ~STALLED
+                    occupied[pos] = 0
+                    occupied[new] = 1
+                    leg.pos = new
         #print('Extruder now at ({},{})'.format(self.leg1.pos,self.leg2.pos))
-        return self.occupied
+        return occupied
     def getUnloadProb(self):
-        if self._any('stalled'):
+        if (self.leg1.flags | self.leg2.flags) & STALLED:
             return 1/self.lifetime_stalled
         return 1/self.lifetime
     def loadNew(self):
@@ -138,17 +143,7 @@ class Extruder():
         """
         while True:
             if self.targeted_loading: # This is where the ""magic"" happens for targeted loading!
-                p = np.random.random()
-                #print(p)
-                pos = self.loading_spots[len(self.loading_dist)-1]
-                # find first index greater than p
-                for i,x in enumerate(self.loading_dist):
-                    if p > x:
-                        continue
-                    elif p < x:
-                        pos = self.loading_spots[i]
-                        break
-                pos = self.loading_spots[i]
+                pos = self.loading_spots.draw() # Alias table draw, O(1) whatever the number of spots
             else:
                 numOccupied = np.sum(self.occupied[self.loading_region[0]:self.loading_region[1]])
                 regionSize = len(self.occupied[self.loading_region[0]:self.loading_region[1]])+1
@@ -165,27 +160,59 @@ class Extruder():
         self.leg1.pos = pos
         self.leg2.pos = pos+1
         # Reset leg attributes
-        for leg in [self.leg1, self.leg2]:
-            leg.attrs['captured'] = False
-            leg.attrs['stalled'] = False
+        self.leg1.flags = 0
+        self.leg2.flags = 0
         self.occupied[pos] = 1
         self.occupied[pos+1] = 1
     def printLegInfo(self):
-        for leg in [self.leg1, self.leg2]:
+        for leg in self.legs:
             s = "Leg {}:\nPosition: {}\n Captured: {}\n Stalled: {}\n".format(leg.side, leg.pos, leg.attrs['captured'], leg.attrs['stalled'])
             #print(s)
     class ExtruderLeg():
         """
         Class defining one side / 'leg' of a loop extruder
         Conceptually, the extruder will be contacting two points on the polymer as it pulls two distal locations closer (like a cohesin ring)
+        The stalled and captured state is kept in the bits of flags (STALLED, CAPTURED); attrs gives dict-style access to it
         """
+        __slots__ = ('pos', 'side', 'flags', 'blockers_capture', 'blockers_release')
         def __init__(self, pos, side, attrs = None):
-            self.pos = pos
+            self.pos = int(pos)
             self.side = side
-            if attrs is None:
-                self.attrs = {'stalled': False, 'captured': False}
+            self.flags = 0
+            self.blockers_capture = {} # {pos:prob} of blockers facing this leg (set by Extruder)
+            self.blockers_release = {}
+            for attribute, value in (attrs or {}).items():
+                self.setAttribute(attribute, value)
+        @property
+        def attrs(self):
+            return Extruder.LegAttrs(self)
         def setAttribute(self, attribute, value):
-            self.attrs[attribute] = value
+            if value:
+                self.flags |= FLAGS[attribute]
+            else:
+                self.flags &= ~FLAGS[attribute]
+
+    class LegAttrs():
+        """
+        Dict-style view of the flags of a leg, i.e. leg.attrs['stalled'] (compatibility with the old attrs dict)
+        """
+        __slots__ = ('leg',)
+        def __init__(self, leg):
+            self.leg = leg
+        def __getitem__(self, attribute):
+            return bool(self.leg.flags & FLAGS[attribute])
+        def __setitem__(self, attribute, value):
+            self.leg.setAttribute(attribute, value)
+        def __contains__(self, attribute):
+            return attribute in FLAGS
+        def __iter__(self):
+            return iter(FLAGS)
+        def keys(self):
+            return FLAGS.keys()
+        def items(self):
+            return [(attribute, self[attribute]) for attribute in FLAGS]
+        def __repr__(self):
+            return repr(dict(self.items()))
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,301 @@
+###################
+# Fitting blocker capture/release probabilities and the LEF lifetime against a reference contact map
+# The free parameters are cap and rel of chosen blocking regions of a 1D driver (applied to every blocker site of the
+# region, on the sides it already blocks) and optionally LIFETIME (LIFETIME_STALLED keeps its ratio to it). Each
+# candidate is scored by the distance between the 1D contact proxy of its trajectory (lef_analysis.contact_proxy)
+# and the reference map, both normalized by their mean contact frequency at each separation (observed/expected).
+#
+# Search: an evolution strategy over a diagonal Gaussian in logit (probabilities) / log (lifetime) space. Every
+# generation draws a population and screens it by successive halving: all candidates run minSteps 1D steps, the
+# best 1/eta run eta times longer, and so on up to the steps of the driver, so most of the compute goes to the
+# promising candidates. The mean and spread of the Gaussian then move to the best ranked candidates.
+# Candidates of a rung run in parallel in a process pool; trajectories go through the trajectory cache, so an
+# interrupted fit reruns quickly. Every evaluation is appended to a JSON lines log.
+#
+# Run as: python3 fit_parameters.py <1D driver> <reference matrix.txt> [--regions E1_2,E2] [--lifetime] [--bin 10]
+###################
+import os
+import sys
+import copy
+import json
+import argparse
+import importlib
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from lef_simulation import run_1D
+from lef_analysis import contact_proxy
+from trajectory_cache import canonical_json
+
+PROB_BOUNDS = (1e-4, 1 - 1e-4)
+LIFETIME_BOUNDS = (20, 20000)
+
+def bin_matrix(matrix, factor):
+    """
+    Sum a square contact matrix over factor x factor bins (a trailing partial bin is dropped)
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n = matrix.shape[0] // factor
+    return matrix[:n*factor, :n*factor].reshape(n, factor, n, factor).sum(axis=(1, 3))
+
+def observed_over_expected(matrix):
+    """
+    Matrix divided by the mean of its diagonal at each separation
+    """
+    n = matrix.shape[0]
+    sep = np.abs(np.arange(n)[:, None] - np.arange(n)[None, :])
+    expected = np.bincount(sep.ravel(), weights=matrix.ravel()) / np.bincount(sep.ravel())
+    return matrix / np.where(expected > 0, expected, 1)[sep]
+
+def matrix_distance(a, b, minSeparation=2):
+    """
+    1 - Pearson correlation of log observed/expected contacts of two maps of the same shape, over the pairs
+    at least minSeparation bins apart (the near diagonal is dominated by the polymer backbone)
+    Returns:
+        float in [0, 2]; 0 for maps with the same pattern
+    """
+    if a.shape != b.shape:
+        raise ValueError("Contact maps differ in shape: {} and {}".format(a.shape, b.shape))
+    i, j = np.triu_indices(a.shape[0], k=minSeparation)
+    x = np.log(np.maximum(observed_over_expected(a)[i, j], 1e-12))
+    y = np.log(np.maximum(observed_over_expected(b)[i, j], 1e-12))
+    keep = (a[i, j] > 0) & (b[i, j] > 0)
+    if keep.sum() < 3:
+        return 2.0
+    r = np.corrcoef(x[keep], y[keep])[0, 1]
+    return float(1 - r) if np.isfinite(r) else 2.0
+
+class ParameterSpace():
+    def __init__(self, params, blockingRegions, regions, lifetime=True):
+        """
+        Parameters:
+            params - dict of resolved 1D parameters of a driver (see lef_simulation.init_extruders)
+            blockingRegions - dict {name: array of monomers} of the driver
+            regions - list of names of the blocking regions to fit (cap and rel of each)
+            lifetime - bool, also fit LIFETIME
+        """
+        self.params = params
+        self.names = []
+        self.sites = {} # Region name: list of (blocker dict name, monomer) of its sites
+        start = []
+        for name in regions:
+            if name not in blockingRegions:
+                raise ValueError("Unknown blocking region {}; choose from {}".format(name, ", ".join(blockingRegions)))
+            monomers = set(int(m) for m in blockingRegions[name])
+            sites = [(side, loc) for side in ("left", "right") for loc in params["{}_blockers_capture".format(side)]
+                     if int(loc) in monomers]
+            if not sites:
+                raise ValueError("Blocking region {} has no blocker sites".format(name))
+            self.sites[name] = sites
+            side, loc = sites[0]
+            self.names += ["cap:" + name, "rel:" + name]
+            start += [params["{}_blockers_capture".format(side)][loc], params["{}_blockers_release".format(side)][loc]]
+        if lifetime:
+            self.names.append("LIFETIME")
+            start.append(params["LIFETIME"])
+        self.start = np.array(start, dtype=np.float64)
+        self.stalledRatio = params["LIFETIME_STALLED"] / params["LIFETIME"]
+
+    def _is_lifetime(self):
+        return np.array([name == "LIFETIME" for name in self.names])
+
+    def to_latent(self, values):
+        """
+        Values -> unbounded coordinates of the search (logit of probabilities, log of the lifetime)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        p = np.clip(values, *PROB_BOUNDS)
+        return np.where(self._is_lifetime(), np.log(np.clip(values, *LIFETIME_BOUNDS)), np.log(p / (1 - p)))
+
+    def from_latent(self, z):
+        """
+        Unbounded coordinates -> values, within PROB_BOUNDS and LIFETIME_BOUNDS
+        """
+        z = np.asarray(z, dtype=np.float64)
+        prob = np.clip(1 / (1 + np.exp(-z)), *PROB_BOUNDS)
+        life = np.clip(np.exp(np.minimum(z, 50)), *LIFETIME_BOUNDS)
+        return np.where(self._is_lifetime(), np.round(life), prob)
+
+    def apply(self, values, steps=None):
+        """
+        Copy of the parameters with a candidate's values (and optionally another number of steps)
+        """
+        params = copy.deepcopy(self.params)
+        for name, value in zip(self.names, values):
+            if name == "LIFETIME":
+                params["LIFETIME"] = int(value)
+                params["LIFETIME_STALLED"] = max(int(round(value * self.stalledRatio)), 1)
+                continue
+            kind, region = name.split(":", 1)
+            table = "capture" if kind == "cap" else "release"
+            for side, loc in self.sites[region]:
+                params["{}_blockers_{}".format(side, table)][loc] = float(value)
+        if steps is not None:
+            params["steps"] = int(steps)
+        return params
+
+    def describe(self, values):
+        return {name: float(v) for name, v in zip(self.names, values)}
+
+def _evaluate(job):
+    """
+    Run (or read from the cache) the trajectory of one candidate and score its contact proxy. The trajectory is
+    scored from a private copy, as the other workers' trajectories may evict it from the shared cache at any time
+    """
+    params, metadata, reference, options = job
+    fd, tmp = tempfile.mkstemp(suffix=".h5")
+    os.close(fd)
+    try:
+        key = run_1D(params, outf=tmp, metadata=metadata)
+        proxy = contact_proxy(tmp, stride=options["stride"], binSize=options["bin"])
+    finally:
+        os.unlink(tmp)
+    return key, matrix_distance(proxy, reference, options["minSeparation"])
+
+class SuccessiveHalvingES():
+    def __init__(self, space, reference, minSteps=5000, maxSteps=None, eta=3, population=12, elite=None, sigma=1.0,
+                 seed=0, processes=None, proxyOptions=None, metadata=None, log=None):
+        """
+        Parameters:
+            space - ParameterSpace
+            reference - (n, n) reference contact map, binned as the proxy (see proxyOptions)
+            minSteps, maxSteps - int, 1D steps of the first and last rung of successive halving (default maxSteps:
+                                 the steps of the driver); every rung runs eta times longer than the one before
+            eta - int, 1/eta of the candidates of a rung are promoted to the next
+            population - int, candidates per generation
+            elite - int, best ranked candidates the Gaussian moves to (default: population // 3)
+            sigma - float, initial standard deviation of the search distribution, in latent units
+            seed - int, seed of the search (each trajectory keeps the seed of the driver's parameters,
+                   so candidates are compared on common random numbers)
+            processes - int, worker processes (default: number of CPUs, at most population)
+            proxyOptions - dict of stride, bin and minSeparation for the contact proxy and the distance
+            metadata - dict stored with every trajectory
+            log - str, JSON lines file every evaluation is appended to (None for no log)
+        """
+        maxSteps = maxSteps or space.params["steps"]
+        if minSteps > maxSteps or eta < 2:
+            raise ValueError("Need minSteps <= maxSteps and eta >= 2 (got {}, {} and {})".format(minSteps, maxSteps, eta))
+        self.space = space
+        self.reference = np.asarray(reference, dtype=np.float64)
+        self.rungs = []
+        steps = maxSteps
+        while steps >= minSteps:
+            self.rungs.insert(0, int(steps))
+            steps //= eta
+        self.eta = eta
+        self.population = population
+        self.elite = elite or max(population // 3, 2)
+        self.rng = np.random.default_rng(seed)
+        self.mean = space.to_latent(space.start)
+        self.sigma = np.full(len(space.names), float(sigma))
+        self.processes = processes or min(os.cpu_count() or 1, population) # A rung never has more candidates
+        self.proxyOptions = dict({"stride": 100, "bin": 1, "minSeparation": 2}, **(proxyOptions or {}))
+        self.metadata = dict(metadata or {})
+        self.log = log
+        self.best = None # (score, values) of the best candidate run for maxSteps
+        self.generation = 0
+
+    def _record(self, entry):
+        if self.log is not None:
+            with open(self.log, "a") as f:
+                f.write(canonical_json(entry) + "\n")
+
+    def _screen(self, pool, candidates):
+        """
+        Successive halving of one generation
+        Returns:
+            list of (rung reached, score there) per candidate
+        """
+        reached = [(0, np.inf)] * len(candidates)
+        alive = list(range(len(candidates)))
+        for r, steps in enumerate(self.rungs):
+            jobs = [(self.space.apply(candidates[c], steps), dict(self.metadata, fit=self.space.describe(candidates[c])),
+                     self.reference, self.proxyOptions) for c in alive]
+            scores = []
+            for c, (key, score) in zip(alive, pool.map(_evaluate, jobs)):
+                reached[c] = (r, score)
+                scores.append(score)
+                self._record({"generation": self.generation, "steps": steps, "key": key, "score": score,
+                              "values": self.space.describe(candidates[c])})
+            if r == len(self.rungs) - 1:
+                break
+            keep = max(len(alive) // self.eta, 1)
+            alive = [alive[k] for k in np.argsort(scores, kind='stable')[:keep]]
+        return reached
+
+    def run(self, generations=10):
+        """
+        Run a number of generations
+        Returns:
+            (best score, dict of the best values) among the candidates run for maxSteps
+        """
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            for g in range(generations):
+                z = self.mean + self.sigma * self.rng.standard_normal((self.population, len(self.mean)))
+                if self.generation == 0:
+                    z[0] = self.mean # The driver's own values compete in the first generation
+                candidates = [self.space.from_latent(zc) for zc in z]
+                reached = self._screen(pool, candidates)
+                # Rank by the rung reached, then by the score there
+                order = sorted(range(len(candidates)), key=lambda c: (-reached[c][0], reached[c][1]))
+                for c in order:
+                    if reached[c][0] == len(self.rungs) - 1 and (self.best is None or reached[c][1] < self.best[0]):
+                        self.best = (reached[c][1], candidates[c])
+                # Move to the elite, weighting better ranks more (log-linear weights, as in CMA-ES)
+                elite = z[order[:self.elite]]
+                w = np.log(self.elite + 0.5) - np.log(np.arange(1, self.elite + 1))
+                w /= w.sum()
+                newMean = w @ elite
+                spread = np.sqrt(w @ (elite - self.mean) ** 2)
+                self.sigma = np.clip(0.5 * self.sigma + 0.5 * spread, 0.02, 3.0)
+                self.mean = newMean
+                print('Generation {}: best {:.4f} ({})'.format(self.generation, self.best[0], " ".join(
+                    "{}={:.4g}".format(k, v) for k, v in self.space.describe(self.best[1]).items())))
+                self.generation += 1
+        return self.best[0], self.space.describe(self.best[1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit blocker capture/release and LEF lifetime to a reference contact map')
+    parser.add_argument('driver', help='1D driver module providing parameters(), i.e. 1D_polychrom_simulation_blocking_WT')
+    parser.add_argument('reference', help='reference contact map (tab-delimited, i.e. matrix.txt of make_contactMap.py)')
+    parser.add_argument('--regions', default=None, help='comma-separated blocking regions to fit (default: all of the driver)')
+    parser.add_argument('--lifetime', action='store_true', help='also fit LIFETIME')
+    parser.add_argument('--bin', type=int, default=1, help='monomers per bin of the comparison')
+    parser.add_argument('--reference-bin', type=int, default=1, help='monomers per bin of the reference map')
+    parser.add_argument('--stride', type=int, default=100, help='frame stride of the contact proxy')
+    parser.add_argument('--min-separation', type=int, default=2, help='bins closer than this are left out of the distance')
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--population', type=int, default=12, help='candidates per generation')
+    parser.add_argument('--eta', type=int, default=3, help='successive halving: 1/eta of the candidates are promoted')
+    parser.add_argument('--min-steps', type=int, default=5000, help='1D steps of the first screening rung')
+    parser.add_argument('--sigma', type=float, default=1.0, help='initial spread (logit / log units)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the search')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: number of CPUs, at most --population)')
+    parser.add_argument('--log', default='fit_log.jsonl', help='JSON lines log of every evaluation')
+    parser.add_argument('--out', default='fit_best.json', help='best values found')
+    args = parser.parse_args()
+
+    if args.bin % args.reference_bin != 0:
+        print('--bin ({}) must be a multiple of --reference-bin ({})'.format(args.bin, args.reference_bin))
+        os._exit(1)
+    driver = importlib.import_module(args.driver[:-3] if args.driver.endswith(".py") else args.driver)
+    params, metadata = driver.parameters()
+    regions = args.regions.split(",") if args.regions else list(metadata["blockingRegions"])
+    space = ParameterSpace(params, metadata["blockingRegions"], regions, lifetime=args.lifetime)
+    reference = bin_matrix(np.loadtxt(args.reference, delimiter='\t'), args.bin // args.reference_bin)
+    if reference.shape[0] != params["N"] // args.bin:
+        print('Reference map has {} bins, expected {} ({} monomers in bins of {})'.format(
+            reference.shape[0], params["N"] // args.bin, params["N"], args.bin))
+        os._exit(1)
+    fit = SuccessiveHalvingES(space, reference, minSteps=args.min_steps, eta=args.eta, population=args.population,
+                              sigma=args.sigma, seed=args.seed, processes=args.processes,
+                              proxyOptions={"stride": args.stride, "bin": args.bin, "minSeparation": args.min_separation},
+                              metadata=metadata, log=args.log)
+    print('Fitting {} ({} rungs of {} steps)'.format(", ".join(space.names), len(fit.rungs), fit.rungs))
+    score, best = fit.run(args.generations)
+    with open(args.out, "w") as f:
+        json.dump({"score": score, "values": best}, f, indent=1)
+    print('Best distance {:.4f}; values written to {}'.format(score, args.out))
+
+if __name__ == '__main__':
+    sys.exit(main())
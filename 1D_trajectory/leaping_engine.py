@@ -0,0 +1,236 @@
+###################
+# Leaping 1D loop extrusion for sparse LEFs on long polymers
+# Most steps of a sparse system are free translocation: legs move one monomer per step, far from blockers and
+# from each other, and nothing random happens. LeapingLEFEngine sorts every leg into "moving" (its next monomer
+# is free and no blocker lies on its path) or "static" (captured, or stalled against a barrier or a leg that
+# cannot move away), and when every LEF on the polymer is made of such legs it advances them all in one update:
+#   - the leap lasts until the first moving leg could reach a blocker site, a static obstacle, or meet a leg
+#     moving towards it (half the gap);
+#   - unloading, capture by the blocker a stalled leg sits on and release of captured legs are the only random
+#     events of such an LEF; the number of steps to its first event is drawn at once (geometric), and the leap
+#     stops at the earliest one. That step is then taken with the events drawn conditioned on at least one happening.
+# Any other situation (stalled legs that may be freed, followers right behind a moving leg, waiting LEFs) is
+# handled by a plain LEFEngine step. Frames inside a leap are reconstructed from the start of the leap, and only
+# for the frames that are recorded. The results match LEFEngine in distribution (equivalence.py), not step by step.
+###################
+import numpy as np
+from lef_engine import LEFEngine, LEFT, RIGHT, SIDES, engine_from_params
+
+class LeapingLEFEngine(LEFEngine):
+    def __init__(self, *args, maxLeap=10000, maxBackoff=64, **kwargs):
+        """
+        Parameters as LEFEngine, plus:
+            maxLeap - int, longest leap in steps
+            maxBackoff - int, most ordinary steps taken before trying to leap again; the wait doubles after every
+                         failed attempt but the first, so dense systems pay little for the attempts
+        """
+        super().__init__(*args, **kwargs)
+        self.maxLeap = maxLeap
+        self.maxBackoff = maxBackoff
+        self._backoff = 0
+        self._wait = 0
+        self.leaps = 0 # Number of leaps and of steps they covered (for diagnostics)
+        self.leapedSteps = 0
+        # Blocker sites that can capture, per leg side
+        self._captureSites = [self.blockers.sites[side][self.blockers.capture[side] > 0] for side in (LEFT, RIGHT)]
+
+    def _blocker_distance(self, pos, side):
+        """
+        Steps a leg of this side can move from pos before it stands on a site that can capture it (0 if it does now)
+        """
+        sites = self._captureSites[side]
+        if len(sites) == 0:
+            return np.full(len(pos), np.iinfo(np.int64).max)
+        if side == RIGHT:
+            idx = np.searchsorted(sites, pos, side='left')
+            nxt = sites[np.minimum(idx, len(sites) - 1)]
+            return np.where(idx < len(sites), nxt - pos, np.iinfo(np.int64).max)
+        idx = np.searchsorted(sites, pos, side='right') - 1
+        prv = sites[np.maximum(idx, 0)]
+        return np.where(idx >= 0, pos - prv, np.iinfo(np.int64).max)
+
+    def _plan(self):
+        """
+        Classify legs and find the leap
+        Returns:
+            None if some LEF is not made of moving and static legs, else (moving (nLEF, 2) bool, horizon, event rates)
+        """
+        if self.waiting.any():
+            return None
+        legs = self.legs
+        nLEF = self.nLEF
+        pos = legs.ravel() # Leg k = 2 * lef + side
+        side = np.tile([LEFT, RIGHT], nLEF)
+        step = SIDES[side]
+        captured = self.captured.ravel()
+        stalled = self.stalled.ravel()
+        # Sorted obstacles: barriers (owner -1) and legs (owner = leg number)
+        obstacles = np.concatenate([self.barriers, pos])
+        owner = np.concatenate([np.full(len(self.barriers), -1), np.arange(2 * nLEF)])
+        order = np.argsort(obstacles, kind='stable')
+        obstacles, owner = obstacles[order], owner[order]
+        rank = np.searchsorted(obstacles, pos)
+        nextIdx = rank + step # Nearest obstacle in the leg's direction (the chain ends are barriers)
+        nextPos = obstacles[nextIdx]
+        nextOwner = owner[nextIdx]
+        gap = np.abs(nextPos - pos) - 1
+        blocked = gap == 0
+        moving = ~captured & ~blocked & ~stalled
+        # Static: captured, or stalled against a barrier, an opposite leg, or a static leg moving the same way
+        opposite = (nextOwner >= 0) & (side[np.maximum(nextOwner, 0)] != side)
+        static = captured | (~captured & blocked & stalled & ((nextOwner < 0) | opposite))
+        follower = ~captured & blocked & stalled & (nextOwner >= 0) & ~opposite
+        while True:
+            add = follower & ~static & static[np.maximum(nextOwner, 0)]
+            if not add.any():
+                break
+            static |= add
+        if not np.all(moving | static):
+            return None
+        # Horizon of moving legs: blocker sites on their path, and obstacles ahead
+        horizon = np.full(2 * nLEF, np.iinfo(np.int64).max)
+        for s in (LEFT, RIGHT):
+            k = np.nonzero(moving & (side == s))[0]
+            horizon[k] = self._blocker_distance(pos[k], s)
+        towards = (nextOwner >= 0) & opposite & moving[np.maximum(nextOwner, 0)]
+        sameWay = (nextOwner >= 0) & ~opposite & moving[np.maximum(nextOwner, 0)]
+        ahead = np.where(towards, gap // 2, np.where(sameWay, np.iinfo(np.int64).max, gap))
+        horizon = np.where(moving, np.minimum(horizon, ahead), horizon)
+        H = int(horizon.min()) if len(horizon) else np.iinfo(np.int64).max
+        # Per-step event probabilities: unloading, and changes of static legs
+        capture = np.zeros(2 * nLEF)
+        release = np.zeros(2 * nLEF)
+        for s in (LEFT, RIGHT):
+            capture[s::2], release[s::2] = self.blockers.lookup(s, legs[:, s])
+        legRate = np.where(static & captured, release, np.where(static, capture * (1 - release), 0.0)).reshape(nLEF, 2)
+        unloadRate = np.where(self.stalled.any(axis=1), self.unloadProbStalled, self.unloadProb)
+        rates = np.column_stack([unloadRate, legRate])
+        return moving.reshape(nLEF, 2), H, rates
+
+    def _events(self, rates):
+        """
+        Steps before the first event of every LEF, geometric with the probability that any of its events happens
+        """
+        q = 1 - np.prod(1 - rates, axis=1)
+        u = self.rng.random(self.nLEF)
+        with np.errstate(divide='ignore'):
+            T = np.floor(np.log1p(-u) / np.log1p(-np.minimum(q, 1)))
+        T[q <= 0] = np.inf
+        T[q >= 1] = 0
+        return T
+
+    def _conditional(self, rates):
+        """
+        Draw which events happen for LEFs known to have at least one: each in turn, conditioned on one among it and the rest
+        Returns:
+            (n, 3) bool array (unload, leg 0 change, leg 1 change)
+        """
+        n, m = rates.shape
+        out = np.zeros((n, m), dtype=bool)
+        some = np.zeros(n, dtype=bool)
+        for k in range(m):
+            tail = 1 - np.prod(1 - rates[:, k:], axis=1)
+            p = np.where(some, rates[:, k], rates[:, k] / np.where(tail > 0, tail, 1))
+            out[:, k] = self.rng.random(n) < p
+            some |= out[:, k]
+        return out
+
+    def _leap(self, moving, H):
+        """
+        Move every moving leg H monomers
+        """
+        src = self.legs[moving]
+        self.occupied[src] = 0
+        self.legs += moving * SIDES * H
+        self.occupied[self.legs[moving]] = 1
+
+    def _forced_step(self, moving, event, changes):
+        """
+        One step after a leap: LEFs with event=True have the events in changes (unload, leg changes), the others have none;
+        moving legs (and reloaded LEFs) draw capture and release as usual
+        """
+        rng = self.rng
+        self._touched = []
+        fresh = moving.copy() # Legs with usual capture/release draws
+        unload = np.zeros(self.nLEF, dtype=bool)
+        unload[event] = changes[:, 0]
+        legChange = np.zeros((self.nLEF, 2), dtype=bool)
+        legChange[event] = changes[:, 1:]
+        legChange[unload] = False
+        if unload.any():
+            u = np.nonzero(unload)[0]
+            freed = self.legs[u].ravel()
+            self.occupied[freed] = 0
+            self._freedBy[freed] = np.repeat(u, 2)
+            self._touched.append(freed)
+            if self.autoload:
+                self.load(u)
+            else:
+                self.waiting[u] = True
+                self.stalled[u] = False
+                self.captured[u] = False
+            fresh[u] = True
+        onPolymer = ~self.waiting
+        probs = [self.blockers.lookup(side, self.legs[:, side]) for side in (LEFT, RIGHT)]
+        # Static legs: uncaptured ones are captured (and stay so), captured ones are released, on a change
+        wasCaptured = self.captured.copy()
+        self.captured |= legChange & ~wasCaptured
+        for side in (LEFT, RIGHT):
+            self.captured[:, side] |= fresh[:, side] & onPolymer & (rng.random(self.nLEF) < probs[side][0])
+        anyCaptured = self.captured.any(axis=1)
+        self.captured &= ~(legChange & wasCaptured)
+        for side in (LEFT, RIGHT):
+            self.captured[:, side] &= ~(fresh[:, side] & anyCaptured & (rng.random(self.nLEF) < probs[side][1]))
+        self._translocate(onPolymer[:, None] & ~self.captured)
+        for cells in self._touched:
+            self._freedBy[cells] = -1
+
+    def run(self, steps, stride=1):
+        """
+        Record positions, then step, for a number of steps, leaping whenever possible
+        Parameters:
+            stride - int, record every stride-th frame only
+        Returns:
+            (ceil(steps / stride), nLEF, 2) int32 array
+        """
+        out = np.zeros((-(-steps // stride), self.nLEF, 2), dtype=np.int32)
+        t = 0
+        while t < steps:
+            plan = None if self._wait > 0 else self._plan()
+            if plan is None:
+                if self._wait > 0:
+                    self._wait -= 1
+                else:
+                    self._wait = self._backoff
+                    self._backoff = min(max(2 * self._backoff, 1), self.maxBackoff)
+                if t % stride == 0:
+                    out[t // stride] = self.legs
+                self.step()
+                t += 1
+                continue
+            # The events drawn here are the ones of step t+H, even if H is 0
+            moving, horizon, rates = plan
+            self._backoff = 0
+            T = self._events(rates)
+            H = int(min(horizon, T.min(), self.maxLeap, steps - 1 - t))
+            # Frames t .. t+H: legs as at t, moving legs shifted by the steps since t
+            first = -(-t // stride) * stride
+            times = np.arange(first, t + H + 1, stride)
+            if len(times):
+                out[times // stride] = self.legs[None] + (moving * SIDES)[None] * (times - t)[:, None, None]
+            self._leap(moving, H)
+            event = T == H
+            self._forced_step(moving, event, self._conditional(rates[event]))
+            if H > 0:
+                self.leaps += 1
+                self.leapedSteps += H
+            t += H + 1
+        return out
+
+def leaping_engine(params, seed):
+    """
+    Engine function for equivalence.py
+    """
+    base = engine_from_params(params, seed)
+    eng = LeapingLEFEngine(base.N, base.lefRegions, base.blockers, params["LIFETIME"], params["LIFETIME_STALLED"], seed=seed)
+    return eng.run(params["steps"])
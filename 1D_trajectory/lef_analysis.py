@@ -0,0 +1,305 @@
+###################
+# Analysis of 1D loop extrusion trajectories, without running the 3D stage
+# Computes loop size distributions, bridging between blocking regions, stall and capture
+# fractions per blocking region, LEF and blocker residence times, and a 1D-derived contact map proxy.
+# Every statistic is computed in chunks of frames straight from LEFPositions.h5
+###################
+import sys
+import argparse
+import json
+import numpy as np
+import h5py
+
+### Blocking regions of the WT blocking driver (front_buffer of 10 included), used when none are given
+DEFAULT_BLOCKING_REGIONS = {'E1_1': np.arange(181+10, 185+10),
+                            'E1_2': np.arange(210+10, 220+10),
+                            'E2': np.arange(304+10, 310+10),
+                            'B3_EBF1': np.arange(553+10, 578+10),
+                            'MYC': np.arange(737+10, 742+10)}
+
+def iter_chunks(dset, chunkSize=5000, start=0):
+    """
+    Yield (first frame index, frames) for consecutive chunks of a (frames, LEFNum, 2) dataset, from frame start on
+    """
+    for st in range(start, dset.shape[0], chunkSize):
+        yield st, np.asarray(dset[st:st+chunkSize], dtype=np.int64)
+
+def reloads(prev, cur):
+    """
+    Detect LEFs that were unloaded and loaded again between two frames.
+    Between consecutive frames leg1 can only move by 0 or -1 and leg2 by 0 or +1; anything else is a reload
+
+    Parameters:
+        prev, cur - (..., LEFNum, 2) arrays of leg positions at consecutive frames
+    Returns:
+        (..., LEFNum) boolean array
+    """
+    d1 = cur[..., 0] - prev[..., 0]
+    d2 = cur[..., 1] - prev[..., 1]
+    return (d1 > 0) | (d1 < -1) | (d2 < 0) | (d2 > 1)
+
+class TrajectoryStats():
+    def __init__(self, N, LEFNum, blockingRegions=None, maxLoop=None):
+        """
+        Streaming 1D statistics; feed consecutive chunks of frames to update()
+        Parameters:
+            N - int, number of monomers
+            LEFNum - int, number of extruders
+            blockingRegions - dict {name: array of monomers}; defaults to DEFAULT_BLOCKING_REGIONS
+            maxLoop - int, largest loop size kept in the loop size histogram (default N)
+        """
+        self.N = N
+        self.LEFNum = LEFNum
+        self.blockingRegions = DEFAULT_BLOCKING_REGIONS if blockingRegions is None else blockingRegions
+        self.regionNames = list(self.blockingRegions)
+        self.regionOf = np.full(N, -1, dtype=np.int64) # Blocking region index of each monomer, -1 if none
+        for r, name in enumerate(self.regionNames):
+            self.regionOf[np.asarray(self.blockingRegions[name])] = r
+        nR = len(self.regionNames)
+        self.frames = 0
+        self.loopHist = np.zeros((maxLoop or N) + 1, dtype=np.int64)
+        self.bridged = np.zeros((nR, nR), dtype=np.int64) # LEF-frames with leg1 in region a and leg2 in region b
+        self.bridgedFrames = np.zeros((nR, nR), dtype=np.int64) # Frames where a and b are bridged by at least one LEF
+        self.legFrames = np.zeros(nR, dtype=np.int64) # Leg-frames spent in each region
+        self.stalledFrames = np.zeros(nR, dtype=np.int64) # ...not moving because the next monomer is occupied
+        self.capturedFrames = np.zeros(nR, dtype=np.int64) # ...not moving although the next monomer is free
+        self.lifetimes = [] # Completed LEF residence times (frames between two reloads)
+        self.blockerResidence = {name: [] for name in self.regionNames} # Completed stays of a leg inside a region
+        self._prev = None
+        self._lastReload = np.zeros(LEFNum, dtype=np.int64)
+        self._seenReload = np.zeros(LEFNum, dtype=bool)
+        self._runStart = np.zeros(2 * LEFNum, dtype=np.int64)
+        self._seenBoundary = np.zeros(2 * LEFNum, dtype=bool)
+
+    def update(self, frames):
+        """
+        Add a (T, LEFNum, 2) chunk of consecutive frames
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        T = len(frames)
+        t0 = self.frames
+        leg1, leg2 = frames[..., 0], frames[..., 1]
+        nR = len(self.regionNames)
+
+        ### Loop sizes
+        self.loopHist += np.bincount(np.minimum(leg2 - leg1, len(self.loopHist) - 1).ravel(), minlength=len(self.loopHist))
+
+        ### Bridging between blocking regions
+        r1, r2 = self.regionOf[leg1], self.regionOf[leg2]
+        both = (r1 >= 0) & (r2 >= 0)
+        pairIdx = r1[both] * nR + r2[both]
+        self.bridged += np.bincount(pairIdx, minlength=nR * nR).reshape(nR, nR)
+        tIdx = np.nonzero(both)[0]
+        uniq = np.unique(tIdx * nR * nR + pairIdx) % (nR * nR)
+        self.bridgedFrames += np.bincount(uniq, minlength=nR * nR).reshape(nR, nR)
+
+        ### Transitions between frames (need the previous frame for the first one of the chunk)
+        allFrames = frames if self._prev is None else np.concatenate([self._prev[None], frames])
+        offset = 0 if self._prev is None else 1
+        if len(allFrames) > 1:
+            prev, cur = allFrames[:-1], allFrames[1:]
+            times = t0 + np.arange(len(cur)) + (1 - offset) # Global frame index of cur
+            reloaded = reloads(prev, cur)
+            self._stalls(prev, cur, reloaded)
+            self._lifetimes(reloaded, times)
+            self._residence(prev, cur, reloaded, times)
+        self._prev = frames[-1]
+        self.frames += T
+
+    def _stalls(self, prev, cur, reloaded):
+        # A leg is blocked if its next monomer holds a leg in the previous frame or is a chain end (as in the drivers);
+        # legs are looked up in the sorted (frame, position) keys of the previous frames, not in a dense occupancy
+        T = len(prev)
+        stride = self.N + 2
+        frameKey = np.arange(T, dtype=np.int64)[:, None] * stride
+        legKeys = np.sort((frameKey + prev.reshape(T, -1)).ravel())
+        for side, col in ((-1, 0), (1, 1)):
+            pos = prev[..., col]
+            r = self.regionOf[pos]
+            inRegion = (r >= 0) & ~reloaded
+            still = cur[..., col] == pos
+            nextPos = np.clip(pos + side, 0, self.N)
+            query = frameKey + nextPos
+            found = legKeys[np.minimum(np.searchsorted(legKeys, query), len(legKeys) - 1)] == query
+            blocked = found | (nextPos == 0) | (nextPos >= self.N - 1)
+            nR = len(self.regionNames)
+            self.legFrames += np.bincount(r[inRegion], minlength=nR)
+            self.stalledFrames += np.bincount(r[inRegion & still & blocked], minlength=nR)
+            self.capturedFrames += np.bincount(r[inRegion & still & ~blocked], minlength=nR)
+
+    def _lifetimes(self, reloaded, times):
+        t, lef = np.nonzero(reloaded)
+        order = np.lexsort((t, lef))
+        t, lef = times[t[order]], lef[order]
+        if len(t) == 0:
+            return
+        sameAsPrev = np.r_[False, lef[1:] == lef[:-1]]
+        prevT = np.where(sameAsPrev, np.r_[0, t[:-1]], self._lastReload[lef])
+        complete = sameAsPrev | self._seenReload[lef] # The first stay of each LEF started before the trajectory did
+        self.lifetimes += list(t[complete] - prevT[complete])
+        last = np.r_[lef[1:] != lef[:-1], True]
+        self._lastReload[lef[last]] = t[last]
+        self._seenReload[lef[last]] = True
+
+    def _residence(self, prev, cur, reloaded, times):
+        T = len(prev)
+        ridPrev = self.regionOf[prev].reshape(T, -1)
+        ridCur = self.regionOf[cur].reshape(T, -1)
+        boundary = (ridPrev != ridCur) | np.repeat(reloaded, 2, axis=1)
+        t, leg = np.nonzero(boundary)
+        order = np.lexsort((t, leg))
+        t, leg = t[order], leg[order]
+        if len(t) == 0:
+            return
+        sameAsPrev = np.r_[False, leg[1:] == leg[:-1]]
+        gt = times[t]
+        starts = np.where(sameAsPrev, np.r_[0, gt[:-1]], self._runStart[leg])
+        region = ridPrev[t, leg] # Region of the run that ends at this boundary
+        complete = (region >= 0) & (sameAsPrev | self._seenBoundary[leg])
+        for r, d in zip(region[complete], (gt - starts)[complete]):
+            self.blockerResidence[self.regionNames[r]].append(int(d))
+        last = np.r_[leg[1:] != leg[:-1], True]
+        self._runStart[leg[last]] = gt[last]
+        self._seenBoundary[leg[last]] = True
+
+    def loop_size_distribution(self):
+        """
+        Returns: (loop sizes, probability of each size)
+        """
+        return np.arange(len(self.loopHist)), self.loopHist / max(self.loopHist.sum(), 1)
+
+    def summary(self):
+        """
+        Returns: dict of per-region and global summary statistics
+        """
+        sizes, p = self.loop_size_distribution()
+        legFrames = np.maximum(self.legFrames, 1)
+        return {
+            'frames': self.frames,
+            'mean_loop_size': float(np.sum(sizes * p)),
+            'mean_lifetime': float(np.mean(self.lifetimes)) if self.lifetimes else float('nan'),
+            'occupancy': {name: float(self.legFrames[r] / max(self.frames, 1)) for r, name in enumerate(self.regionNames)},
+            'stall_fraction': {name: float(self.stalledFrames[r] / legFrames[r]) for r, name in enumerate(self.regionNames)},
+            'capture_fraction': {name: float(self.capturedFrames[r] / legFrames[r]) for r, name in enumerate(self.regionNames)},
+            'mean_blocker_residence': {name: float(np.mean(v)) if v else float('nan') for name, v in self.blockerResidence.items()},
+            'bridged_fraction': {'{}-{}'.format(a, b): float(self.bridgedFrames[i, j] / max(self.frames, 1))
+                                 for i, a in enumerate(self.regionNames) for j, b in enumerate(self.regionNames)
+                                 if self.bridgedFrames[i, j] > 0},
+        }
+
+def burn_in_frames(f, dataset='positions'):
+    """
+    Frames of a dataset before steady state, from the burn_in attribute (in 1D steps) stored by a run with a
+    convergence monitor (see convergence.py); 0 if there is none or steady state was not reached
+    """
+    burnIn = int(f.attrs.get('burn_in', -1))
+    return -(-burnIn // int(f[dataset].attrs.get('stride', 1))) if burnIn > 0 else 0
+
+def trajectory_stats(fname, blockingRegions=None, chunkSize=5000, dataset='positions', skipBurnIn=False):
+    """
+    Compute TrajectoryStats over a whole trajectory file. Without blockingRegions, the blocking
+    regions stored with the trajectory by the 1D driver are used, if any
+    Parameters:
+        skipBurnIn - bool, leave out the frames before steady state (see burn_in_frames)
+    """
+    with h5py.File(fname, mode='r') as f:
+        dset = f[dataset]
+        if blockingRegions is None and "metadata" in f.attrs:
+            blockingRegions = json.loads(f.attrs["metadata"]).get("blockingRegions")
+        N = int(dset.attrs['N']) if 'N' in dset.attrs else int(f.attrs['N']) # Per-domain datasets carry their own N
+        if dset.attrs.get('stride', 1) != 1:
+            raise ValueError("Trajectory statistics need every 1D step; {} has stride {}".format(dataset, dset.attrs['stride']))
+        stats = TrajectoryStats(N, dset.shape[1], blockingRegions=blockingRegions)
+        start = burn_in_frames(f, dataset) if skipBurnIn else 0
+        for st, frames in iter_chunks(dset, chunkSize, start=start):
+            stats.update(frames)
+    return stats
+
+def effective_separation_weights(frames, N):
+    """
+    Backbone link weights for each frame once loops are collapsed: links inside a loop count 0,
+    the first link of each outermost loop counts 1 (the LEF bridge) and the rest count 1.
+
+    Parameters:
+        frames - (T, LEFNum, 2) leg positions
+    Returns:
+        (T, N) cumulative weights W, so that |W[j] - W[i]| is the effective separation of i and j
+    """
+    T = len(frames)
+    cover = np.zeros((T, N), dtype=np.int64) # No. of loops covering link k (between monomers k and k+1)
+    rows = np.repeat(np.arange(T), frames.shape[1])
+    np.add.at(cover, (rows, frames[..., 0].ravel()), 1)
+    np.add.at(cover, (rows, frames[..., 1].ravel()), -1)
+    cover = np.cumsum(cover, axis=1)
+    covered = cover > 0
+    loopStart = covered & ~np.concatenate([np.zeros((T, 1), dtype=bool), covered[:, :-1]], axis=1)
+    w = (~covered | loopStart).astype(np.int64)
+    return np.concatenate([np.zeros((T, 1), dtype=np.int64), np.cumsum(w[:, :-1], axis=1)], axis=1)
+
+def contact_proxy(fname, stride=100, binSize=1, alpha=1.5, chunkSize=5000, dataset='positions', skipBurnIn=False):
+    """
+    Fast 1D-derived contact map proxy: average over frames of s_eff^-alpha, where s_eff is the
+    genomic separation of two monomers after collapsing extruded loops. An approximation of the
+    3D contact map that only needs the 1D trajectory
+
+    Parameters:
+        stride - use a frame every stride 1D steps (at least every frame of a strided output stream)
+        binSize - monomers per bin; the proxy is evaluated at bin centers
+        alpha - contact probability scaling exponent of the unlooped polymer
+        skipBurnIn - bool, leave out the frames before steady state (see burn_in_frames)
+    Returns:
+        (N // binSize, N // binSize) array
+    """
+    with h5py.File(fname, mode='r') as f:
+        dset = f[dataset]
+        N = int(dset.attrs['N']) if 'N' in dset.attrs else int(f.attrs['N'])
+        stride = max(stride // int(dset.attrs.get('stride', 1)), 1) # In frames of the stream
+        centers = np.arange(binSize // 2, N - N % binSize, binSize)
+        out = np.zeros((len(centers), len(centers)))
+        sEff = np.empty_like(out) # One frame at a time, so memory does not grow with chunkSize
+        count = 0
+        for st, frames in iter_chunks(dset, chunkSize, start=burn_in_frames(f, dataset) if skipBurnIn else 0):
+            frames = frames[(-st) % stride::stride]
+            if len(frames) == 0:
+                continue
+            W = effective_separation_weights(frames, N)[:, centers]
+            for w in W:
+                np.subtract.outer(w, w, out=sEff, casting='unsafe')
+                np.abs(sEff, out=sEff)
+                np.maximum(sEff, 1, out=sEff)
+                np.power(sEff, -alpha, out=sEff)
+                out += sEff
+            count += len(frames)
+    return out / max(count, 1)
+
+def parse_region(text):
+    """
+    Parse a blocking region argument of form NAME:START-END (END exclusive)
+    """
+    name, span = text.split(':')
+    start, end = span.split('-')
+    return name, np.arange(int(start), int(end))
+
+def main():
+    parser = argparse.ArgumentParser(description='1D statistics of a loop extrusion trajectory')
+    parser.add_argument('trajectory', help='LEFPositions.h5')
+    parser.add_argument('--region', action='append', type=parse_region, default=None,
+                        help='blocking region NAME:START-END, may be repeated (default: regions stored with the trajectory, or those of the WT blocking driver)')
+    parser.add_argument('--proxy', default=None, help='also write the 1D contact map proxy to this file')
+    parser.add_argument('--stride', type=int, default=100, help='frame stride for the contact map proxy')
+    parser.add_argument('--bin', type=int, default=1, help='bin size of the contact map proxy')
+    parser.add_argument('--skip-burn-in', action='store_true', help='leave out the frames before steady state (runs with a convergence monitor)')
+    args = parser.parse_args()
+
+    regions = dict(args.region) if args.region else None
+    stats = trajectory_stats(args.trajectory, blockingRegions=regions, skipBurnIn=args.skip_burn_in)
+    for key, value in stats.summary().items():
+        print('{}: {}'.format(key, value))
+    sizes, p = stats.loop_size_distribution()
+    np.savetxt('loop_sizes.txt', np.column_stack([sizes, p]), delimiter='\t')
+    if args.proxy is not None:
+        np.savetxt(args.proxy, contact_proxy(args.trajectory, stride=args.stride, binSize=args.bin,
+                                                 skipBurnIn=args.skip_burn_in), delimiter='\t')
+
+if __name__ == '__main__':
+    sys.exit(main())
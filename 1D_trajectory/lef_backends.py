@@ -0,0 +1,129 @@
+###################
+# Translocation kernels of LEFEngine
+# Moving the legs is the one part of a step with a data dependency: a leg may enter a monomer freed in the same
+# step only by an LEF with a lower index, as if the LEFs moved one after the other. The "numpy" backend resolves
+# this with rounds of array operations; "numba" compiles a plain loop over the LEFs in index order (Numba is optional),
+# and "python" runs the same loop uncompiled, to check it without Numba. Random draws stay in LEFEngine.step, so all
+# backends give identical trajectories for the same seed.
+#
+# A kernel is translocate(legs, trying, occupied, freedBy, stalled): it moves every leg in trying by one monomer if
+# it can, updates legs, occupied, freedBy and stalled in place, and returns the monomers it freed (int64 array).
+###################
+import numpy as np
+
+SIDES = np.array([-1, 1]) # Direction of leg 0 and leg 1
+
+def translocate_numpy(legs, trying, occupied, freedBy, stalled):
+    """
+    Rounds of vectorized moves: every round moves the legs whose next monomer is free; two legs heading for the
+    same monomer go in LEF order
+    """
+    pending = trying.copy()
+    moved = np.zeros_like(trying)
+    freed = []
+    while True:
+        lef, side = np.nonzero(pending)
+        if len(lef) == 0:
+            break
+        target = legs[lef, side] + SIDES[side]
+        free = (occupied[target] == 0) & (freedBy[target] < lef)
+        if not free.any():
+            break
+        lef, side, target = lef[free], side[free], target[free]
+        # Two legs heading for the same monomer: the LEF with the lower index goes first
+        order = np.lexsort((lef, target))
+        first = np.r_[True, target[order][1:] != target[order][:-1]]
+        win = order[first]
+        lef, side, target = lef[win], side[win], target[win]
+        src = legs[lef, side]
+        occupied[src] = 0
+        occupied[target] = 1
+        freedBy[src] = lef
+        freed.append(src)
+        legs[lef, side] = target
+        moved[lef, side] = True
+        pending[lef, side] = False
+    stalled[trying] = ~moved[trying]
+    return np.concatenate(freed) if freed else np.zeros(0, dtype=np.int64)
+
+def translocate_sequential(legs, trying, occupied, freedBy, stalled):
+    """
+    One LEF after the other, left leg first; the loop compiled by the numba backend
+    """
+    freed = np.empty(legs.shape[0] * 2, dtype=np.int64)
+    n = 0
+    for lef in range(legs.shape[0]):
+        for side in range(2):
+            if not trying[lef, side]:
+                continue
+            pos = legs[lef, side]
+            target = pos + (1 if side == 1 else -1)
+            if occupied[target] == 0 and freedBy[target] < lef:
+                occupied[pos] = 0
+                occupied[target] = 1
+                freedBy[pos] = lef
+                freed[n] = pos
+                n += 1
+                legs[lef, side] = target
+                stalled[lef, side] = False
+            else:
+                stalled[lef, side] = True
+    return freed[:n]
+
+def _numba():
+    import numba
+    return numba.njit(cache=True)(translocate_sequential)
+
+BACKENDS = {"numpy": lambda: translocate_numpy, "numba": _numba, "python": lambda: translocate_sequential}
+_loaded = {}
+_missing = set() # Backends whose loader raised ImportError in this process
+
+def register_backend(name, loader):
+    """
+    Add a backend: loader() returns its kernel, and may raise ImportError if a dependency is missing
+    """
+    BACKENDS[name] = loader
+    _loaded.pop(name, None)
+    _missing.discard(name)
+
+def available_backends():
+    """
+    Names of the backends whose dependencies are installed
+    """
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name, fallback=False)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_backend(name="auto", fallback=True):
+    """
+    Kernel of a backend, loaded (and compiled) once per process
+    Parameters:
+        name - str, a key of BACKENDS, or "auto" for numba if it is installed, else numpy
+        fallback - bool, use the numpy backend if the dependencies of name are missing (else raise ImportError)
+    Returns:
+        (name of the backend used, kernel)
+    """
+    if name == "auto":
+        try:
+            return get_backend("numba", fallback=False)
+        except ImportError:
+            return get_backend("numpy")
+    if name not in BACKENDS:
+        raise ValueError("Unknown 1D backend {}; choose from {}".format(name, ", ".join(["auto"] + list(BACKENDS))))
+    if name not in _loaded:
+        try:
+            if name in _missing:
+                raise ImportError("1D backend {} is not available".format(name))
+            _loaded[name] = BACKENDS[name]()
+        except ImportError:
+            _missing.add(name)
+            if not fallback:
+                raise
+            print("1D backend {} is not available (missing dependency), using numpy".format(name))
+            return get_backend("numpy")
+    return name, _loaded[name]
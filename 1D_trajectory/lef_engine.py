@@ -0,0 +1,249 @@
+###################
+# Array-based 1D loop extrusion engine, for many loci or whole chromosomes
+# LEF legs, their stalled/captured flags and the occupancy of the polymer are flat NumPy arrays,
+# and blockers are sorted site tables instead of dicts, so memory and step cost scale with the
+# number of LEFs and blockers rather than with Python objects.
+# Each step follows Extruder.translocate (load, unload, capture, release, translocate) for all LEFs at once.
+###################
+import numpy as np
+from lef_backends import SIDES, get_backend
+
+LEFT, RIGHT = 0, 1 # Leg columns; leg 0 moves towards lower monomers, leg 1 towards higher ones (SIDES)
+UNLOAD, CAPTURE, RELEASE = 0, 1, 3 # Random draws of a step (CAPTURE + side, RELEASE + side), see LEFEngine._random
+
+class BlockerTable():
+    def __init__(self, sites, capture, release):
+        """
+        Sparse table of blocker sites for both leg directions
+        Parameters:
+            sites - pair of int arrays, blocker monomers seen by left-moving (leg1) and right-moving (leg2) legs
+            capture, release - pairs of float arrays, probabilities for each site
+        """
+        self.sites, self.capture, self.release = [], [], []
+        for side in (LEFT, RIGHT):
+            s = np.asarray(sites[side], dtype=np.int64)
+            order = np.argsort(s, kind='stable')
+            self.sites.append(s[order])
+            self.capture.append(np.asarray(capture[side], dtype=np.float64)[order])
+            self.release.append(np.asarray(release[side], dtype=np.float64)[order])
+
+    @classmethod
+    def from_dicts(cls, left_capture, right_capture, left_release, right_release):
+        """
+        Build from the {pos:prob} blocker dicts used by Extruder and the drivers
+        """
+        sites, capture, release = [], [], []
+        for cap, rel in ((left_capture, left_release), (right_capture, right_release)):
+            pos = sorted(set(cap) | set(rel))
+            sites.append([int(p) for p in pos])
+            capture.append([cap.get(p, 0) for p in pos])
+            release.append([rel.get(p, 0) for p in pos])
+        return cls(sites, capture, release)
+
+    def lookup(self, side, pos):
+        """
+        Capture and release probabilities for legs of one side at positions pos (0 where there is no blocker)
+        """
+        sites = self.sites[side]
+        idx = np.minimum(np.searchsorted(sites, pos), max(len(sites) - 1, 0))
+        if len(sites) == 0:
+            zero = np.zeros(np.shape(pos))
+            return zero, zero
+        hit = sites[idx] == pos
+        return np.where(hit, self.capture[side][idx], 0.0), np.where(hit, self.release[side][idx], 0.0)
+
+    def window(self, lo, hi):
+        """
+        Table of the sites in [lo, hi), shifted so that monomer lo becomes 0
+        """
+        sites, capture, release = [], [], []
+        for side in (LEFT, RIGHT):
+            a, b = np.searchsorted(self.sites[side], [lo, hi])
+            sites.append(self.sites[side][a:b] - lo)
+            capture.append(self.capture[side][a:b])
+            release.append(self.release[side][a:b])
+        return BlockerTable(sites, capture, release)
+
+class LEFEngine():
+    def __init__(self, N, lefRegions, blockers, lifetime=100, lifetime_stalled=10, barriers=None, seed=None, maxLoadTries=100,
+                 legs=None, autoload=True, backend="auto"):
+        """
+        Parameters:
+            N - int, number of monomers
+            lefRegions - (nLEF, 2) int array, [low, high) loading region of each LEF
+            blockers - BlockerTable
+            lifetime, lifetime_stalled - float or per-LEF arrays, inverse unloading probabilities
+            barriers - monomers that are always occupied (chain ends and domain boundaries); default [0, N-1]
+            seed - int, seed of the engine's random generator
+            maxLoadTries - int, loading attempts per step before an LEF is left waiting, as in Extruder.loadNew
+            legs - (nLEF, 2) initial leg positions, negative for LEFs not on the polymer (default: load every LEF)
+            autoload - bool, load unloaded LEFs again straight away; if False they are left waiting (see parallel_engine.py)
+            backend - str, translocation kernel (see lef_backends.py): "auto" (numba if installed, else numpy), "numpy", "numba" or "python"
+        """
+        self.N = N
+        self.blockers = blockers
+        self.lefRegions = np.asarray(lefRegions, dtype=np.int64).reshape(-1, 2)
+        self.nLEF = len(self.lefRegions)
+        self.unloadProb = 1 / np.broadcast_to(np.asarray(lifetime, dtype=np.float64), (self.nLEF,))
+        self.unloadProbStalled = 1 / np.broadcast_to(np.asarray(lifetime_stalled, dtype=np.float64), (self.nLEF,))
+        self.rng = np.random.default_rng(seed)
+        self.maxLoadTries = maxLoadTries
+        self.autoload = autoload
+        self.backend, self._kernel = get_backend(backend)
+        self.occupied = np.zeros(N, dtype=np.int8)
+        self.barriers = np.array([0, N-1] if barriers is None else barriers, dtype=np.int64)
+        self.occupied[self.barriers] = 1
+        self.legs = np.zeros((self.nLEF, 2), dtype=np.int64)
+        self.stalled = np.zeros((self.nLEF, 2), dtype=bool)
+        self.captured = np.zeros((self.nLEF, 2), dtype=bool)
+        self.waiting = np.ones(self.nLEF, dtype=bool) # Not on the polymer
+        self._freedBy = np.full(N, -1, dtype=np.int32) # LEF that freed each monomer during the current step
+        self._index = np.arange(self.nLEF)
+        self._touched = []
+        if legs is None:
+            self.load(self._index)
+        else:
+            self.legs[:] = legs
+            self.waiting[:] = self.legs[:, 0] < 0
+            self.occupied[self.legs[~self.waiting].ravel()] = 1
+
+    def _random(self, purpose):
+        """
+        One uniform number per LEF for a draw of the current step (UNLOAD, CAPTURE + side or RELEASE + side)
+        """
+        return self.rng.random(self.nLEF)
+
+    def _spots(self, idx, attempt, reload):
+        """
+        Random loading spots of LEFs idx in their loading regions, for one loading attempt
+        """
+        lo, hi = self.lefRegions[idx, 0], self.lefRegions[idx, 1]
+        return lo + np.floor(self.rng.random(len(idx)) * (hi - lo)).astype(np.int64)
+
+    def load(self, idx, reload=False):
+        """
+        Load LEFs idx at random free spots (pos, pos+1) of their loading regions; LEFs that cannot be
+        placed after maxLoadTries rounds stay waiting and are retried at the next step
+        Parameters:
+            reload - bool, the LEFs were unloaded in this step (rather than waiting since an earlier one)
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        for attempt in range(self.maxLoadTries):
+            if len(idx) == 0:
+                break
+            pos = self._spots(idx, attempt, reload)
+            ok = (self.occupied[pos] == 0) & (self.occupied[pos + 1] == 0)
+            # Two new LEFs on overlapping spots: the one with the lower index wins
+            order = np.lexsort((idx, pos))
+            sp, so = pos[order], ok[order]
+            clash = np.zeros(len(sp), dtype=bool)
+            lastTaken = -10
+            cand = np.nonzero(so)[0]
+            if len(cand) > 1 and np.any(np.diff(sp[cand]) < 2):
+                for k in cand: # Rare; resolve in order of position
+                    if sp[k] - lastTaken < 2:
+                        clash[k] = True
+                    else:
+                        lastTaken = sp[k]
+            accept = np.zeros(len(idx), dtype=bool)
+            accept[order] = so & ~clash
+            new = idx[accept]
+            p = pos[accept]
+            self.legs[new, LEFT] = p
+            self.legs[new, RIGHT] = p + 1
+            self.occupied[p] = 1
+            self.occupied[p + 1] = 1
+            self.stalled[new] = False
+            self.captured[new] = False
+            self.waiting[new] = False
+            idx = idx[~accept]
+        self.waiting[idx] = True
+
+    def step(self):
+        """
+        Advance every LEF by one step
+        """
+        self._touched = []
+        if self.autoload and self.waiting.any():
+            self.load(np.nonzero(self.waiting)[0])
+        onPolymer = ~self.waiting
+
+        ### 1 - unload LEFs with prob. 1/lifetime (1/lifetime_stalled if a leg is stalled), then load them again
+        p = np.where(self.stalled.any(axis=1), self.unloadProbStalled, self.unloadProb)
+        unload = onPolymer & (self._random(UNLOAD) < p)
+        if unload.any():
+            u = np.nonzero(unload)[0]
+            freed = self.legs[u].ravel()
+            self.occupied[freed] = 0
+            self._freedBy[freed] = np.repeat(u, 2)
+            self._touched.append(freed)
+            if self.autoload:
+                self.load(u, reload=True)
+            else:
+                self.waiting[u] = True
+                self.stalled[u] = False
+                self.captured[u] = False
+            onPolymer = ~self.waiting
+
+        ### 2 - capture and release by blockers
+        probs = [self.blockers.lookup(side, self.legs[:, side]) for side in (LEFT, RIGHT)]
+        for side in (LEFT, RIGHT):
+            self.captured[:, side] |= onPolymer & (self._random(CAPTURE + side) < probs[side][0])
+        anyCaptured = self.captured.any(axis=1)
+        for side in (LEFT, RIGHT):
+            self.captured[:, side] &= ~(anyCaptured & (self._random(RELEASE + side) < probs[side][1]))
+
+        ### 3 - translocate legs that are not captured
+        self._translocate(onPolymer[:, None] & ~self.captured)
+        for cells in self._touched:
+            self._freedBy[cells] = -1
+
+    def _translocate(self, trying):
+        """
+        Move every leg in trying by one monomer if the next monomer is free. A leg may enter a monomer freed
+        during this step only by an LEF with a lower index, the same outcome as translocating the LEFs in order
+        (see lef_backends.py)
+        """
+        self._touched.append(self._kernel(self.legs, trying, self.occupied, self._freedBy, self.stalled))
+
+    def positions(self):
+        """
+        (nLEF, 2) int32 array of current leg positions
+        """
+        return self.legs.astype(np.int32)
+
+    def run(self, steps):
+        """
+        Record positions, then step, for a number of steps
+        Returns:
+            (steps, nLEF, 2) int32 array
+        """
+        out = np.zeros((steps, self.nLEF, 2), dtype=np.int32)
+        for i in range(steps):
+            out[i] = self.legs
+            self.step()
+        return out
+
+def engine_from_params(params, seed=None, backend="auto"):
+    """
+    LEFEngine for the resolved parameters of a 1D driver (see lef_simulation.simulate)
+    """
+    lefRegions = []
+    for region, freq in zip(params["loading_regions"], params["loading_region_freqs"]):
+        lefRegions += [region] * int(freq)
+    blockers = BlockerTable.from_dicts(params["left_blockers_capture"], params["right_blockers_capture"],
+                                       params["left_blockers_release"], params["right_blockers_release"])
+    return LEFEngine(params["N"], lefRegions, blockers, params["LIFETIME"], params["LIFETIME_STALLED"], seed=seed,
+                     backend=backend)
+
+def vectorized_engine(params, seed):
+    """
+    Engine function for equivalence.py
+    """
+    return engine_from_params(params, seed, backend="numpy").run(params["steps"])
+
+def numba_engine(params, seed):
+    """
+    Engine function for equivalence.py, with the compiled translocation kernel
+    """
+    return engine_from_params(params, seed, backend="numba").run(params["steps"])
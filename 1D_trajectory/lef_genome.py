@@ -0,0 +1,214 @@
+###################
+# Multi-locus / genome-scale setup for the array-based 1D engine
+# Each domain (a locus or a whole chromosome) is a contiguous stretch of monomers with a boundary
+# monomer at each end, its own LEF density, lifetimes and loading regions. Blockers (i.e. CTCF sites
+# with their orientation) and loading regions are read in bulk from BED-like files.
+###################
+import json
+import numpy as np
+import h5py
+from pathlib import Path
+from lef_engine import LEFEngine, BlockerTable, LEFT, RIGHT
+
+class Domain():
+    def __init__(self, name, chrom, bpStart, bpEnd, resolution, offset, density, lifetime, lifetime_stalled):
+        """
+        Parameters:
+            name - str, domain name (also its group in the output file)
+            chrom, bpStart, bpEnd - genomic interval of the domain
+            resolution - int, base pairs per monomer
+            offset - int, first monomer of the domain in the whole polymer
+            density - float, LEFs per 1000 monomers
+            lifetime, lifetime_stalled - LEF lifetimes in this domain
+        """
+        if "/" in name: # Would nest HDF5 groups in write_domains
+            raise ValueError("Domain name {!r} contains '/'".format(name))
+        self.name = name
+        self.chrom = chrom
+        self.bpStart = bpStart
+        self.bpEnd = bpEnd
+        self.resolution = resolution
+        self.nMonomers = -(-(bpEnd - bpStart) // resolution) + 2 # One boundary monomer at each end
+        self.start = offset
+        self.end = offset + self.nMonomers
+        self.density = density
+        self.lifetime = lifetime
+        self.lifetime_stalled = lifetime_stalled
+        self.loading = [] # [low, high, weight] loading regions, in monomers of the whole polymer
+
+    def monomer(self, bp):
+        """
+        Monomer (of the whole polymer) containing genomic position bp
+        """
+        return self.start + 1 + (np.asarray(bp) - self.bpStart) // self.resolution
+
+    def lef_regions(self):
+        """
+        Loading region of each LEF of this domain; LEFs are shared out between loading regions in proportion to their weights.
+        Loading regions are clipped to the domain, and regions left without a loading spot (i.e. on a boundary monomer) are dropped
+        """
+        nLEF = int(round(self.density * self.nMonomers / 1000))
+        inner = [self.start + 1, self.end - 2] # Keep loading spots (pos, pos+1) off the boundary monomers
+        if not self.loading:
+            return [inner] * nLEF
+        loading = [[max(lo, inner[0]), min(hi, inner[1]), w] for lo, hi, w in self.loading]
+        loading = [[lo, hi, w] for lo, hi, w in loading if lo < hi]
+        if not loading:
+            raise ValueError("No loading region of domain {} has a loading spot inside the domain".format(self.name))
+        weights = np.array([w for lo, hi, w in loading], dtype=np.float64)
+        share = nLEF * weights / weights.sum()
+        counts = np.floor(share).astype(int)
+        counts[np.argsort(counts - share)[:nLEF - counts.sum()]] += 1 # Largest remainders
+        regions = []
+        for (lo, hi, w), n in zip(loading, counts):
+            regions += [[lo, hi]] * int(n)
+        return regions
+
+def read_bed(fname):
+    """
+    Yield the fields of every record of a BED-like file, skipping comments and track/browser lines
+    """
+    with open(fname) as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            yield line.rstrip('\n').split('\t') if '\t' in line else line.split()
+
+def read_domains(fname, resolution, density=5, lifetime=800, lifetime_stalled=80):
+    """
+    Domains from a BED-like file: chrom start end [name] [LEFs per 1000 monomers] [lifetime] [stalled lifetime]
+    Domains are laid out one after the other along the polymer, in file order
+    """
+    domains = []
+    offset = 0
+    for fields in read_bed(fname):
+        chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+        name = fields[3] if len(fields) > 3 else "{}:{}-{}".format(chrom, start, end)
+        d = float(fields[4]) if len(fields) > 4 else density
+        lt = float(fields[5]) if len(fields) > 5 else lifetime
+        lts = float(fields[6]) if len(fields) > 6 else (lt / 10 if len(fields) > 5 else lifetime_stalled)
+        dom = Domain(name, chrom, start, end, resolution, offset, d, lt, lts)
+        domains.append(dom)
+        offset = dom.end
+    return domains
+
+def _index_domains(domains):
+    """
+    {chrom: (sorted starts, ends, domains)} for fast lookup of the domain of a genomic position
+    """
+    byChrom = {}
+    for dom in domains:
+        byChrom.setdefault(dom.chrom, []).append(dom)
+    index = {}
+    for chrom, doms in byChrom.items():
+        doms.sort(key=lambda d: d.bpStart)
+        index[chrom] = (np.array([d.bpStart for d in doms]), np.array([d.bpEnd for d in doms]), doms)
+    return index
+
+def _find_domain(index, chrom, bp):
+    """
+    Domain containing a genomic position, or None
+    """
+    if chrom not in index:
+        return None
+    starts, ends, doms = index[chrom]
+    k = np.searchsorted(starts, bp, side='right') - 1
+    if k < 0 or bp >= ends[k]:
+        return None
+    return doms[k]
+
+def read_blockers(fname, domains, capture=0.5, release=0.01):
+    """
+    Blockers from a BED-like file of CTCF sites: chrom start end [name] [score] [strand] [capture] [release]
+    The strand gives the orientation, as in the drivers: '+' sites block left-moving legs (like E1_1),
+    '-' sites block right-moving legs (like MYC), and '.' (or no strand) sites block both (like the EBF1 regions).
+    Sites outside every domain are ignored
+    Returns:
+        BlockerTable
+    """
+    index = _index_domains(domains)
+    sites = ([], [])
+    caps = ([], [])
+    rels = ([], [])
+    for fields in read_bed(fname):
+        chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+        mid = (start + end) // 2
+        dom = _find_domain(index, chrom, mid)
+        if dom is None:
+            continue
+        pos = int(dom.monomer(mid))
+        strand = fields[5] if len(fields) > 5 else '.'
+        cap = float(fields[6]) if len(fields) > 6 else capture
+        rel = float(fields[7]) if len(fields) > 7 else release
+        sides = {'+': (LEFT,), '-': (RIGHT,)}.get(strand, (LEFT, RIGHT))
+        for side in sides:
+            sites[side].append(pos)
+            caps[side].append(cap)
+            rels[side].append(rel)
+    return BlockerTable(sites, caps, rels)
+
+def read_loading(fname, domains):
+    """
+    Loading regions from a BED-like file: chrom start end [weight]; each region is added to the domain it falls in
+    """
+    index = _index_domains(domains)
+    for fields in read_bed(fname):
+        chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+        weight = float(fields[3]) if len(fields) > 3 else 1.0
+        dom = _find_domain(index, chrom, start)
+        if dom is None:
+            continue
+        lo = int(dom.monomer(start))
+        hi = int(dom.monomer(min(end, dom.bpEnd - 1))) + 1
+        dom.loading.append([lo, max(hi, lo + 2), weight])
+
+def build_engine(domains, blockers, seed=None, backend="auto"):
+    """
+    LEFEngine over all domains
+    Parameters:
+        backend - translocation kernel of the engine (see lef_backends.py)
+    Returns:
+        (engine, list of (first LEF, last LEF + 1) of each domain)
+    """
+    lefRegions, lifetimes, stalled, lefRanges = [], [], [], []
+    for dom in domains:
+        regions = dom.lef_regions()
+        lefRanges.append((len(lefRegions), len(lefRegions) + len(regions)))
+        lefRegions += regions
+        lifetimes += [dom.lifetime] * len(regions)
+        stalled += [dom.lifetime_stalled] * len(regions)
+    N = domains[-1].end
+    barriers = sorted(set([d.start for d in domains] + [d.end - 1 for d in domains]))
+    engine = LEFEngine(N, lefRegions, blockers, np.array(lifetimes), np.array(stalled), barriers=barriers, seed=seed,
+                       backend=backend)
+    return engine, lefRanges
+
+def write_domains(engine, domains, lefRanges, outf, steps, chunk=1000, attrs=None):
+    """
+    Run the engine and write each domain's trajectory to its own dataset, domains/<name>/positions,
+    in chunks of frames. Positions are relative to the first monomer of the domain, so every domain
+    can be analyzed like a single-locus trajectory (i.e. with lef_analysis.trajectory_stats(dataset=...))
+    """
+    p = Path(outf)
+    if p.exists():
+        p.unlink()
+    with h5py.File(outf, mode='w') as f:
+        dsets = []
+        for dom, (a, b) in zip(domains, lefRanges):
+            g = f.require_group("domains").create_group(dom.name)
+            dset = g.create_dataset("positions", shape=(steps, b - a, 2), dtype=np.int32, compression="gzip",
+                                    chunks=(min(chunk, steps), max(b - a, 1), 2))
+            for key, value in (("N", dom.nMonomers), ("LEFNum", b - a), ("offset", dom.start), ("chrom", dom.chrom),
+                               ("bpStart", dom.bpStart), ("bpEnd", dom.bpEnd), ("resolution", dom.resolution)):
+                dset.attrs[key] = value
+                g.attrs[key] = value
+            dsets.append(dset)
+        for st in range(0, steps, chunk):
+            frames = engine.run(min(chunk, steps - st))
+            for dom, (a, b), dset in zip(domains, lefRanges, dsets):
+                dset[st:st+len(frames)] = frames[:, a:b] - dom.start
+        f.attrs["N"] = engine.N
+        f.attrs["LEFNum"] = engine.nLEF
+        f.attrs["domains"] = json.dumps([dom.name for dom in domains])
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
@@ -0,0 +1,126 @@
+###################
+# Weighted loading spots for targeted LEF loading
+# The spots and their weights (i.e. from ChIP peaks) go into a Vose alias table once; every reload then costs
+# one uniform draw and two array lookups, however many candidate spots there are. Draws are made in batches
+# and handed out one at a time, so Extruder objects sharing a LoadingSpots (see lef_simulation.load_extruders)
+# share the table and the batch.
+###################
+import numpy as np
+
+class AliasTable():
+    def __init__(self, weights):
+        """
+        Vose's alias method for sampling indices in proportion to their weights
+        Parameters:
+            weights - 1D array of non-negative weights (they need not sum to 1)
+        """
+        w = np.asarray(weights, dtype=np.float64)
+        if w.ndim != 1 or len(w) == 0:
+            raise ValueError("Alias table needs a non-empty 1D array of weights")
+        if not np.all(np.isfinite(w)) or np.any(w < 0) or w.sum() <= 0:
+            raise ValueError("Weights must be finite, non-negative and not all zero")
+        n = len(w)
+        scaled = w * n / w.sum()
+        self.n = n
+        self.prob = np.ones(n) # Probability of keeping column i rather than its alias
+        self.alias = np.arange(n)
+        small = list(np.nonzero(scaled < 1)[0])
+        large = list(np.nonzero(scaled >= 1)[0])
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # Whatever is left over is 1 up to rounding, and keeps prob 1
+
+    def sample(self, size, random=None):
+        """
+        Parameters:
+            size - int, number of draws
+            random - np.random.Generator or the np.random module (default: np.random, so np.random.seed applies)
+        Returns:
+            int64 array of indices
+        """
+        random = np.random if random is None else random
+        u = random.random(size) * self.n
+        i = np.minimum(u.astype(np.int64), self.n - 1)
+        return np.where(u - i < self.prob[i], i, self.alias[i])
+
+class LoadingSpots():
+    def __init__(self, spots, weights=None, batch=1024):
+        """
+        Candidate loading spots of LEFs; an LEF loaded at spot pos holds monomers pos and pos+1
+        Parameters:
+            spots - list of monomer positions
+            weights - list of relative loading probabilities, one per spot (default: uniform)
+            batch - int, spots drawn at a time by draw()
+        """
+        self.spots = np.asarray(spots, dtype=np.int64)
+        self.weights = np.ones(len(self.spots)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if self.weights.shape != self.spots.shape:
+            raise ValueError("Need one weight per loading spot ({} spots, {} weights)".format(len(self.spots), len(self.weights)))
+        self.table = AliasTable(self.weights)
+        self.batch = batch
+        self._buffer = []
+        self._next = 0
+
+    def __len__(self):
+        return len(self.spots)
+
+    def __getitem__(self, i):
+        return int(self.spots[i])
+
+    @property
+    def cdf(self):
+        """
+        Cumulative loading probabilities of the spots (the old Extruder.loading_dist)
+        """
+        return np.cumsum(self.weights) / self.weights.sum()
+
+    def sample(self, size, random=None):
+        """
+        Draw size spots at once (see AliasTable.sample)
+        """
+        return self.spots[self.table.sample(size, random)]
+
+    def draw(self):
+        """
+        Next spot of the current batch of draws
+        """
+        if self._next == len(self._buffer):
+            self._buffer = self.sample(self.batch).tolist()
+            self._next = 0
+        self._next += 1
+        return self._buffer[self._next - 1]
+
+def read_loading_spots(fname, chrom=None, bpStart=0, resolution=1, offset=0, N=None, batch=1024):
+    """
+    Loading spots from a BED-like file: chrom start end [weight]; each record becomes a spot at the monomer of
+    its midpoint, and records on the same monomer add up their weights
+    Parameters:
+        chrom - str, only keep records on this chromosome (default: all)
+        bpStart - int, genomic position of monomer `offset`
+        resolution - int, base pairs per monomer
+        offset - int, monomer of bpStart (i.e. front_buffer)
+        N - int, number of monomers; spots that would put a leg on a chain end or off the polymer are dropped
+    Returns:
+        LoadingSpots
+    """
+    from lef_genome import read_bed
+    spots, weights = [], []
+    for fields in read_bed(fname):
+        if chrom is not None and fields[0] != chrom:
+            continue
+        mid = (int(fields[1]) + int(fields[2])) // 2
+        spots.append(offset + (mid - bpStart) // resolution)
+        weights.append(float(fields[3]) if len(fields) > 3 else 1.0)
+    spots = np.array(spots, dtype=np.int64)
+    weights = np.array(weights, dtype=np.float64)
+    if N is not None:
+        keep = (spots >= 1) & (spots <= N - 3)
+        spots, weights = spots[keep], weights[keep]
+    if len(spots) == 0:
+        raise ValueError("No loading spots in {}".format(fname))
+    spots, inverse = np.unique(spots, return_inverse=True)
+    return LoadingSpots(spots, np.bincount(inverse, weights=weights), batch=batch)
@@ -0,0 +1,326 @@
+###################
+# Helpers shared by the 1D drivers: loading extruders and recording their trajectories
+###################
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from pathlib import Path
+from extruder import Extruder
+from lef_loading import LoadingSpots
+from convergence import monitor_from_params
+from trajectory_cache import TrajectoryCache, params_key, canonical_json, TRAJECTORY_VERSION
+from trajectory_ring import CLOSED, FAILED
+from run_catalog import catalog_trajectory
+
+def choose_loading_spots(loading_regions, loading_region_freqs):
+    """
+    Pick an initial loading spot for every LEF, so that no two LEFs start on or next to each other
+    Parameters:
+        loading_regions - list of [low, high) loading regions
+        loading_region_freqs - list, number of LEFs loaded in each region
+    Returns:
+        (list of loading spots, list of the loading region of each LEF)
+    """
+    LOADING_SPOTS = []
+    REGIONS_INDEX = []
+    taken = set()
+    for i, region in enumerate(loading_regions):
+        for j in range(loading_region_freqs[i]):
+            while True:
+                spot = np.random.randint(low=region[0], high=region[1])
+                if spot not in taken and spot+1 not in taken and spot-1 not in taken:
+                    break
+            taken.add(spot)
+            LOADING_SPOTS.append(spot)
+            REGIONS_INDEX.append(loading_regions[i])
+    return LOADING_SPOTS, REGIONS_INDEX
+
+def choose_targeted_spots(loading_spots, nLEF):
+    """
+    Draw an initial loading spot for every LEF from weighted loading spots, so that no two LEFs start on or next to each other
+    Parameters:
+        loading_spots - LoadingSpots
+        nLEF - int, number of LEFs
+    Returns:
+        list of loading spots
+    """
+    LOADING_SPOTS = []
+    taken = set()
+    for tries in range(100 * nLEF):
+        if len(LOADING_SPOTS) == nLEF:
+            break
+        spot = loading_spots.draw()
+        if spot not in taken and spot+1 not in taken and spot-1 not in taken:
+            taken.add(spot)
+            LOADING_SPOTS.append(spot)
+    if len(LOADING_SPOTS) < nLEF:
+        raise ValueError("Could not place {} LEFs on {} loading spots".format(nLEF, len(loading_spots)))
+    return LOADING_SPOTS
+
+def load_extruders(occupied, loading_regions, loading_region_freqs, left_blockers_capture, right_blockers_capture,
+                   left_blockers_release, right_blockers_release, lifetime, lifetime_stalled, loading_spots=None):
+    """
+    Create one Extruder per LEF at random spots of its loading region, as done by the 1D drivers
+    Parameters:
+        occupied - array of length N, occupancy of the polymer (modified in place)
+        left/right_blockers_capture/release - dicts of form {pos:prob}
+        loading_spots - LoadingSpots; if given, all LEFs (sum of loading_region_freqs) load at these weighted spots
+                        instead of uniformly in their loading regions (see lef_loading.py)
+    Returns:
+        list of Extruder objects
+    """
+    if loading_spots is None:
+        LOADING_SPOTS, REGIONS_INDEX = choose_loading_spots(loading_regions, loading_region_freqs)
+    else:
+        LOADING_SPOTS = choose_targeted_spots(loading_spots, int(np.sum(loading_region_freqs)))
+        REGIONS_INDEX = [[int(loading_spots.spots.min()), int(loading_spots.spots.max()) + 1]] * len(LOADING_SPOTS)
+    EXTRUDERS = []
+    for i, leg in enumerate(LOADING_SPOTS):
+        EXTRUDERS.append(Extruder(
+                extruder_index = i,
+                leg1 = leg,
+                leg2 = leg+1,
+                left_blockers_capture = left_blockers_capture,
+                right_blockers_capture = right_blockers_capture,
+                left_blockers_release = left_blockers_release,
+                right_blockers_release = right_blockers_release,
+                extrusion_occupancy = occupied,
+                loading_region = REGIONS_INDEX[i],
+                lifetime = lifetime,
+                lifetime_stalled = lifetime_stalled,
+                targeted_loading = loading_spots is not None,
+                loading_spots = loading_spots)
+        )
+    return EXTRUDERS
+
+def record_positions(EXTRUDERS, occupied, steps):
+    """
+    Record leg positions of all extruders, then translocate every extruder, for a number of steps
+    Returns:
+        (steps, LEFNum, 2) int32 array of positions, and the updated occupancy
+    """
+    cur = np.zeros((steps, len(EXTRUDERS), 2), dtype=np.int32)
+    for i in range(steps):
+        cur[i] = [(extruder.leg1.pos, extruder.leg2.pos) for extruder in EXTRUDERS] # Get both leg positions for all extruders
+        for extruder in EXTRUDERS:
+            occupied = extruder.translocate(occupied) # Translocate extruder
+    return cur, occupied
+
+DEFAULT_STREAMS = {"positions": 1}
+
+def create_streams(f, streams, steps, LEFNum, resizable=False):
+    """
+    Create one dataset per output stream; a stream of stride s holds frames 0, s, 2s, ... and records s in its attributes
+    Parameters:
+        f - open h5py.File
+        streams - dict {dataset name: stride}; it must include "positions" (the stream the trajectory cache and analyses read)
+        resizable - bool, allow the datasets to be shortened (see truncate_streams)
+    Returns:
+        list of (dataset, stride)
+    """
+    if "positions" not in streams:
+        raise ValueError("Output streams must include 'positions'")
+    dsets = []
+    for name, stride in streams.items():
+        if int(stride) < 1:
+            raise ValueError("Stride of stream {} must be a positive integer".format(name))
+        dset = f.create_dataset(name, shape=(-(-steps // int(stride)), LEFNum, 2), dtype=np.int32, compression="gzip",
+                                maxshape=(None, LEFNum, 2) if resizable else None)
+        dset.attrs["stride"] = int(stride)
+        dsets.append((dset, int(stride)))
+    return dsets
+
+def write_streams(dsets, frames, st):
+    """
+    Write the frames of 1D steps [st, st+len(frames)) to every stream, keeping the steps that fall on its stride
+    """
+    for dset, stride in dsets:
+        first = -(-st // stride) * stride # First step of the chunk on the stride
+        keep = frames[first - st::stride]
+        if len(keep):
+            dset[first // stride:first // stride + len(keep)] = keep
+
+def truncate_streams(dsets, steps):
+    """
+    Shorten every stream to the frames of the first steps 1D steps (a run stopped early)
+    """
+    for dset, stride in dsets:
+        dset.resize(-(-steps // stride), axis=0)
+
+def write_trajectory(outf, EXTRUDERS, occupied, steps, num_chunks=50, attrs=None, streams=None, monitor=None, stop=False):
+    """
+    Run the 1D simulation and write the positions of all extruders to an HDF5 file, in chunks
+    Parameters:
+        outf - str, output file (overwritten)
+        steps - int, number of 1D steps
+        num_chunks - int, number of chunks to write the trajectory in
+        attrs - dict of attributes to store with the file (i.e. N and LEFNum)
+        streams - dict {dataset name: stride} of output streams (default: every step in "positions"),
+                  i.e. {"positions": 1, "positions_3D": 10} for full-resolution 1D analysis plus a strided stream for 3D
+        monitor - ConvergenceMonitor fed every frame (see convergence.py); its burn-in (in 1D steps, -1 if not reached)
+                  is stored in the burn_in attribute, and its summary in the convergence attribute
+        stop - bool, end the run after the first chunk at which the monitor has converged
+    """
+    p = Path(outf)
+    if p.exists():
+        p.unlink()
+    with h5py.File(outf, mode='w') as f:
+        dsets = create_streams(f, streams or DEFAULT_STREAMS, steps, len(EXTRUDERS), resizable=stop)
+        bins = np.linspace(0, steps, num_chunks, dtype=int)
+        for st,end in zip(bins[:-1], bins[1:]): # Loop through bins
+            frames, occupied = record_positions(EXTRUDERS, occupied, end-st)
+            write_streams(dsets, frames, st)
+            if monitor is not None:
+                monitor.update(frames)
+                if stop and monitor.converged:
+                    print('1D statistics converged after {} steps (burn-in {}), stopping'.format(end, monitor.burnIn))
+                    truncate_streams(dsets, end)
+                    break
+        if monitor is not None:
+            f.attrs["burn_in"] = -1 if monitor.burnIn is None else int(monitor.burnIn)
+            f.attrs["convergence"] = canonical_json(monitor.summary())
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
+    return occupied
+
+def init_extruders(params):
+    """
+    Seed the random generator and load the extruders for a dict of resolved parameters
+    Parameters:
+        params - dict with N, steps, LIFETIME, LIFETIME_STALLED, the four blocker dicts,
+                 loading_regions, loading_region_freqs and seed; optionally loading_spots,
+                 {"spots": [...], "weights": [...]} for weighted targeted loading, streams,
+                 {dataset name: stride} of the output (see write_trajectory), and convergence, options of
+                 the burn-in and convergence monitor (see convergence.monitor_from_params)
+    Returns:
+        (list of Extruder objects, occupancy array)
+    """
+    if params.get("seed") is not None:
+        np.random.seed(params["seed"])
+    N = params["N"]
+    occupied = np.zeros(N) # List to tell if current monomer is occupied by an extruder
+    occupied[0] = 1
+    occupied[-1] = 1
+    loading_spots = None
+    if params.get("loading_spots") is not None:
+        loading_spots = LoadingSpots(params["loading_spots"]["spots"], params["loading_spots"].get("weights"))
+    EXTRUDERS = load_extruders(occupied, params["loading_regions"], params["loading_region_freqs"],
+                               params["left_blockers_capture"], params["right_blockers_capture"],
+                               params["left_blockers_release"], params["right_blockers_release"],
+                               params["LIFETIME"], params["LIFETIME_STALLED"], loading_spots=loading_spots)
+    return EXTRUDERS, occupied
+
+def simulate(params, outf, num_chunks=50, attrs=None):
+    """
+    Run a 1D simulation from a dict of resolved parameters (see init_extruders()) and write its trajectory
+    Parameters:
+        outf - str, output HDF5 file
+    """
+    EXTRUDERS, occupied = init_extruders(params)
+    monitor, stop = monitor_from_params(params)
+    write_trajectory(outf, EXTRUDERS, occupied, params["steps"], num_chunks=num_chunks, attrs=attrs,
+                     streams=params.get("streams"), monitor=monitor, stop=stop)
+
+def parse_seed(value):
+    """
+    Seed given on the command line (i.e. the drivers' --seed): an int, or "random" for a new seed at every run
+    """
+    if value == "random":
+        return int(np.random.SeedSequence().entropy % 2**32) # np.random.seed takes 32-bit seeds
+    return int(value)
+
+def trajectory_attrs(params, metadata=None):
+    """
+    HDF5 attributes stored with a trajectory: N, LEFNum, the parameters, metadata, cache key and TRAJECTORY_VERSION
+    """
+    return {"N": params["N"], "LEFNum": int(np.sum(params["loading_region_freqs"])),
+            "params": canonical_json(params), "metadata": canonical_json(metadata or {}), "key": params_key(params),
+            "version": TRAJECTORY_VERSION}
+
+def run_1D(params, outf="trajectory/LEFPositions.h5", metadata=None, cache=True, num_chunks=50, catalog=True):
+    """
+    Produce the trajectory for a set of resolved parameters, reusing the trajectory cache when possible.
+    The parameters, their cache key and any metadata (i.e. run name, blocking regions) are stored as
+    HDF5 attributes of the trajectory
+    Parameters:
+        params - dict of resolved parameters (see simulate()); all of them enter the cache key
+        outf - str, where the trajectory is copied (None to only keep it in the cache; required when cache is False)
+        metadata - dict of extra information stored with the trajectory, not part of the key
+        cache - True for the default cache, a TrajectoryCache, or False to always simulate
+        catalog - True for the default run catalog, a RunCatalog, or False not to record the run (see run_catalog.py)
+    Returns:
+        cache key of the trajectory
+    """
+    if not cache and outf is None: # The trajectory would be left in a temporary file nobody knows about
+        raise ValueError("run_1D needs an output file when the trajectory cache is off")
+    key = params_key(params)
+    if cache is True:
+        cache = TrajectoryCache()
+    attrs = trajectory_attrs(params, metadata)
+    if outf is not None and Path(outf).exists():
+        Path(outf).unlink()
+    cached = cache.lookup(key) if cache else None
+    if cached is not None and outf is not None:
+        try:
+            shutil.copyfile(cached, outf)
+        except FileNotFoundError: # Evicted by another process since the lookup
+            cached = None
+    wallTime = None
+    if cached is not None:
+        print('Trajectory {} found in cache, not simulating'.format(key))
+    else:
+        fd, tmp = tempfile.mkstemp(suffix=".h5.tmp", dir=cache.root if cache else None)
+        os.close(fd)
+        start = time.perf_counter()
+        simulate(params, tmp, num_chunks=num_chunks, attrs=attrs)
+        wallTime = time.perf_counter() - start
+        if not cache:
+            shutil.move(tmp, outf)
+            cached = outf
+        else:
+            if outf is not None: # Before storing, as other processes may evict the trajectory from the cache at any time
+                shutil.copyfile(tmp, outf)
+            cached = cache.store(key, tmp)
+    catalog_trajectory(catalog, key, params, metadata, cached, wallTime=wallTime)
+    return key
+
+def stream_1D(params, ring, metadata=None, archive=False, chunk=100):
+    """
+    Run a 1D simulation and publish its frames to a FrameRing as they are simulated (see trajectory_ring.py),
+    i.e. as the producer process of a pipelined 1D + 3D run
+    Parameters:
+        ring - FrameRing
+        archive - bool, also store the trajectory in the trajectory cache
+        chunk - int, frames simulated at a time
+    """
+    try:
+        EXTRUDERS, occupied = init_extruders(params)
+        steps = params["steps"]
+        if archive:
+            cache = TrajectoryCache()
+            fd, tmp = tempfile.mkstemp(suffix=".h5.tmp", dir=cache.root)
+            os.close(fd)
+            f = h5py.File(tmp, mode='w')
+            dsets = create_streams(f, params.get("streams") or DEFAULT_STREAMS, steps, len(EXTRUDERS))
+        for st in range(0, steps, chunk):
+            frames, occupied = record_positions(EXTRUDERS, occupied, min(chunk, steps - st))
+            if not ring.put(frames): # The 3D simulation stopped early: drop the incomplete trajectory
+                if archive:
+                    f.close()
+                    os.remove(tmp)
+                return
+            if archive:
+                write_streams(dsets, frames, st)
+        if archive:
+            attrs = trajectory_attrs(params, metadata)
+            for key, value in attrs.items():
+                f.attrs[key] = value
+            f.close()
+            cache.store(attrs["key"], tmp)
+    except BaseException:
+        ring.close(FAILED)
+        raise
+    ring.close(CLOSED)
@@ -0,0 +1,314 @@
+###################
+# Domain-decomposed 1D loop extrusion over several processes, for chromosome-sized polymers
+# The global state of an LEFEngine (legs, flags, occupancy) lives in shared memory. The run is cut into
+# windows of a few steps; at the start of each window the polymer is cut into territories, one per worker,
+# at monomers no LEF spans (preferably barriers, i.e. domain boundaries, or wide gaps between LEFs), with equal
+# numbers of LEFs, and every worker simulates the LEFs of its territory.
+# Random numbers are not drawn from a stream but computed from (seed, step, LEF, draw) (see _uniforms), so an
+# LEF gets the same numbers in any worker and in the parent. A step of a worker is then exactly the step of
+# the whole polymer, as long as its LEFs only look at monomers of their territory. A worker stops at the first
+# step where one of its legs tries to move onto a monomer outside its territory (that is not a barrier), or an
+# LEF draws a loading spot outside of it; the parent keeps all workers' frames up to the first such step, runs
+# that step over the whole polymer itself, and starts the next window after it. The results are therefore
+# identical to serial_engine (the same random numbers in one process), step by step, and match LEFEngine in
+# distribution (equivalence.py), for any window and number of workers. Windows end early when LEFs reload far
+# from where they unloaded, so the speedup comes from loading regions local to domains (see lef_genome.py).
+# There are no halo regions and no exchange of legs between neighbouring workers: territories are cut again at every
+# window, and a step that crosses a territory edge is run serially over the whole polymer by the parent. With
+# whole-polymer loading (every reload lands in another territory with probability about 1 - 1/workers) nearly every
+# step is such a step, and the engine runs at serial speed or slower; it only approaches linear scaling when LEFs
+# stay in their domains and few legs reach territory edges within a window.
+###################
+import os
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from lef_engine import LEFEngine, engine_from_params
+
+_W = {} # State of a worker process
+_MASK = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+LOAD, RELOAD = 5, 6 # Draws of loading spots (see LEFEngine._random for the others)
+
+def _mix(x):
+    """
+    splitmix64 finalizer, of a Python int or a uint64 array
+    """
+    if isinstance(x, int):
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK
+        return x ^ (x >> 31)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _uniforms(key, t, draw, ids):
+    """
+    Uniform numbers in [0, 1) of LEFs ids for one draw of step t, the same wherever they are computed
+    """
+    base = _mix((key + _mix(t * _GOLDEN + draw & _MASK)) & _MASK)
+    x = _mix(np.uint64(base) + np.asarray(ids, dtype=np.uint64) * np.uint64(_GOLDEN))
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+class _FieldEngine(LEFEngine):
+    def __init__(self, *args, key=0, ids=None, offset=0, territory=None, edge=None, **kwargs):
+        """
+        LEFEngine drawing its random numbers from _uniforms, on the slab of the polymer starting at monomer offset
+        Parameters as LEFEngine (lefRegions in monomers of the whole polymer), plus:
+            key - int, seed of the random numbers
+            ids - int array, LEF indices in the whole polymer (default: 0 .. nLEF-1)
+            territory - (a, b), monomers [a, b) of the whole polymer this engine may look at (default: all)
+            edge - bool array over the slab, monomers outside the territory whose state is not known
+        Loading spots outside the territory, and legs trying to move onto an edge monomer, set conflict
+        """
+        LEFEngine.__init__(self, *args, **kwargs)
+        self.key = key
+        self.ids = np.arange(self.nLEF) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.offset = offset
+        self.territory = (offset, offset + self.N) if territory is None else territory
+        self.edge = np.zeros(self.N, dtype=bool) if edge is None else edge
+        self.t = 0 # Step of the whole run
+        self.conflict = False
+
+    def _random(self, purpose):
+        return _uniforms(self.key, self.t, purpose, self.ids)
+
+    def _spots(self, idx, attempt, reload):
+        lo, hi = self.lefRegions[idx, 0], self.lefRegions[idx, 1]
+        u = _uniforms(self.key, self.t, (RELOAD if reload else LOAD) + 8 * attempt, self.ids[idx])
+        pos = lo + np.floor(u * (hi - lo)).astype(np.int64)
+        outside = (pos < self.territory[0]) | (pos + 1 >= self.territory[1])
+        if outside.any():
+            self.conflict = True
+        return np.where(outside, 0, pos - self.offset) # Monomer 0 of the slab is a barrier or outside the territory
+
+    def _translocate(self, trying):
+        for side, step in ((0, -1), (1, 1)):
+            if self.edge[self.legs[trying[:, side], side] + step].any():
+                self.conflict = True
+        LEFEngine._translocate(self, trying)
+
+    def step(self):
+        LEFEngine.step(self)
+        self.t += 1
+
+def _attach(spec):
+    """
+    Numpy views of the shared arrays described by spec {name: (shared memory name, shape, dtype)}
+    """
+    arrays, handles = {}, []
+    for name, (shmName, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shmName)
+        handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return arrays, handles
+
+def _init_worker(spec, params, key):
+    _W["arrays"], _W["handles"] = _attach(spec)
+    _W["params"] = params
+    _W["key"] = key
+
+def _record(S, own, i, eng):
+    S["histLegs"][i, own] = eng.legs + eng.offset
+    S["histStalled"][i, own] = eng.stalled
+    S["histCaptured"][i, own] = eng.captured
+    S["histWaiting"][i, own] = eng.waiting
+
+def _run_slab(task):
+    """
+    Simulate the LEFs of one worker from step t for up to steps steps, recording the state before every step
+    in the shared hist* arrays
+    Returns:
+        number of steps simulated before the first conflict (steps if none)
+    """
+    worker, a, b, t, steps = task
+    S, ref = _W["arrays"], _W["params"]
+    own = np.nonzero(S["owner"] == worker)[0]
+    if len(own) == 0:
+        return steps
+    lo, hi = max(a - 1, 0), min(b + 1, ref["N"]) # The territory and the monomers next to it
+    barriers = ref["barriers"][(ref["barriers"] >= lo) & (ref["barriers"] < hi)] - lo
+    halo = [m - lo for m in (a - 1, b) if lo <= m < hi]
+    edge = np.zeros(hi - lo, dtype=bool)
+    edge[[m for m in halo if m not in barriers]] = True
+    waiting = S["waiting"][own].copy()
+    legs = np.where(waiting[:, None], -1, S["legs"][own] - lo)
+    eng = _FieldEngine(hi - lo, ref["lefRegions"][own], ref["blockers"].window(lo, hi), ref["lifetime"][own],
+                       ref["lifetime_stalled"][own], barriers=np.union1d(barriers, halo), legs=legs,
+                       maxLoadTries=ref["maxLoadTries"], backend=ref["backend"], key=_W["key"], ids=own, offset=lo,
+                       territory=(a, b), edge=edge)
+    eng.legs[waiting] = S["legs"][own][waiting] - lo # Last positions of waiting LEFs, as recorded by LEFEngine
+    eng.stalled[:] = S["stalled"][own]
+    eng.captured[:] = S["captured"][own]
+    eng.t = t
+    for i in range(steps):
+        _record(S, own, i, eng)
+        eng.step()
+        if eng.conflict:
+            return i
+    _record(S, own, steps, eng)
+    return steps
+
+class ParallelLEFEngine():
+    def __init__(self, engine, workers=None, window=10, seed=None):
+        """
+        Parameters:
+            engine - LEFEngine holding the initial state; its arrays are moved to shared memory and kept up to date
+            workers - int, number of worker processes (default: number of CPUs)
+            window - int, steps between synchronizations of the workers (only affects speed)
+            seed - int, seed of the random numbers
+        Territories have no halo and legs are not handed over between workers: a step in which a leg reaches a
+        territory edge, or an LEF loads outside its territory, is run serially by the parent over the whole polymer.
+        Only loading regions local to domains keep such steps rare; with whole-polymer loading expect serial speed.
+        """
+        self.engine = engine
+        self.N = engine.N
+        self.nLEF = engine.nLEF
+        self.workers = workers or os.cpu_count()
+        self.window = window
+        key = int(np.random.SeedSequence(seed).generate_state(1, np.uint64)[0])
+        nLEF = self.nLEF
+        shapes = {"legs": ((nLEF, 2), np.int64), "stalled": ((nLEF, 2), np.bool_), "captured": ((nLEF, 2), np.bool_),
+                  "waiting": ((nLEF,), np.bool_), "occupied": ((self.N,), np.int8), "owner": ((nLEF,), np.int32),
+                  "histLegs": ((window + 1, nLEF, 2), np.int64), "histStalled": ((window + 1, nLEF, 2), np.bool_),
+                  "histCaptured": ((window + 1, nLEF, 2), np.bool_), "histWaiting": ((window + 1, nLEF), np.bool_)}
+        self._shm = []
+        spec = {}
+        self.shared = {}
+        for name, (shape, dtype) in shapes.items():
+            nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._shm.append(shm)
+            spec[name] = (shm.name, shape, dtype)
+            self.shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # The whole polymer with the same random numbers as the workers, for the steps they cannot take
+        self.field = _FieldEngine(self.N, engine.lefRegions, engine.blockers, 1 / engine.unloadProb,
+                                  1 / engine.unloadProbStalled, barriers=engine.barriers,
+                                  legs=np.full((nLEF, 2), -1), maxLoadTries=engine.maxLoadTries,
+                                  backend=engine.backend, key=key)
+        for name in ("legs", "stalled", "captured", "waiting", "occupied"): # Both engines now work on the shared arrays
+            self.shared[name][:] = getattr(engine, name)
+            setattr(engine, name, self.shared[name])
+            setattr(self.field, name, self.shared[name])
+        params = {"N": self.N, "lefRegions": engine.lefRegions, "blockers": engine.blockers, "barriers": engine.barriers,
+                  "lifetime": 1 / engine.unloadProb, "lifetime_stalled": 1 / engine.unloadProbStalled,
+                  "maxLoadTries": engine.maxLoadTries, "backend": engine.backend}
+        self.pool = Pool(self.workers, initializer=_init_worker, initargs=(spec, params, key))
+
+    def _partition(self):
+        """
+        Cut the polymer into territories at monomers no LEF spans, with equal numbers of LEFs, and assign every
+        LEF to the worker of its territory (waiting LEFs by their first loading spot)
+        Returns:
+            list of (a, b) territories, [a, b) monomers of each worker
+        """
+        eng, field, S = self.engine, self.field, self.shared
+        spans = eng.legs.copy()
+        wait = np.nonzero(eng.waiting)[0]
+        if len(wait):
+            spans[wait, 0] = field._spots(wait, 0, False)
+            spans[wait, 1] = spans[wait, 0] + 1
+        order = np.argsort(spans[:, 0], kind='stable')
+        reach = np.maximum.accumulate(spans[order, 1])
+        # Gaps between groups of overlapping LEFs: cut at monomer c in (reach[k], spans[order[k+1], 0]]
+        gaps = np.nonzero(spans[order[1:], 0] > reach[:-1])[0]
+        cuts = []
+        if len(gaps):
+            left, right = reach[gaps] + 1, spans[order[gaps + 1], 0]
+            bar = np.searchsorted(eng.barriers, left)
+            barrier = (bar < len(eng.barriers)) & (eng.barriers[np.minimum(bar, len(eng.barriers) - 1)] <= right)
+            at = np.where(barrier, eng.barriers[np.minimum(bar, len(eng.barriers) - 1)], (left + right + 1) // 2)
+            width = np.where(barrier, self.N, right - left)
+            count = gaps + 1 # LEFs left of each gap
+            tolerance = max(self.nLEF // (4 * self.workers), 1)
+            for w in range(1, self.workers):
+                target = w * self.nLEF / self.workers
+                near = np.nonzero(np.abs(count - target) <= tolerance)[0]
+                if len(near) == 0:
+                    near = [np.argmin(np.abs(count - target))]
+                k = near[np.argmax(width[near])] # Widest gap (or a barrier) near the balanced cut
+                if not cuts or at[k] > cuts[-1]:
+                    cuts.append(int(at[k]))
+        bounds = [0] + cuts + [self.N]
+        territories = list(zip(bounds[:-1], bounds[1:]))
+        S["owner"][:] = np.searchsorted(np.array(cuts, dtype=np.int64), spans[:, 0], side='right')
+        return territories
+
+    def _gather(self, m):
+        """
+        Take the state of every LEF before step m of the window from the workers
+        """
+        eng, S = self.engine, self.shared
+        eng.legs[:] = S["histLegs"][m]
+        eng.stalled[:] = S["histStalled"][m]
+        eng.captured[:] = S["histCaptured"][m]
+        eng.waiting[:] = S["histWaiting"][m]
+        eng.occupied[:] = 0
+        eng.occupied[eng.barriers] = 1
+        eng.occupied[eng.legs[~eng.waiting].ravel()] = 1
+
+    def run(self, steps):
+        """
+        Record positions, then step, for a number of steps, as LEFEngine.run
+        Returns:
+            (steps, nLEF, 2) int32 array
+        """
+        out = np.zeros((steps, self.nLEF, 2), dtype=np.int32)
+        st = 0
+        while st < steps:
+            k = min(self.window, steps - st)
+            territories = self._partition()
+            done = self.pool.map(_run_slab, [(w, a, b, self.field.t, k) for w, (a, b) in enumerate(territories)])
+            m = min(done)
+            out[st:st+m] = self.shared["histLegs"][:m]
+            self._gather(m)
+            st += m
+            self.field.t += m
+            if m < k: # A worker needed monomers of another territory: take this step over the whole polymer
+                out[st] = self.engine.legs
+                self.field.step()
+                st += 1
+        return out
+
+    def positions(self):
+        return self.engine.positions()
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory; the engine keeps a private copy of its state
+        """
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        for name in ("legs", "stalled", "captured", "waiting", "occupied"):
+            setattr(self.engine, name, self.shared[name].copy())
+        self.shared = {}
+        self.field = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parallel_engine(params, seed, workers=2):
+    """
+    Engine function for equivalence.py, with the default window
+    """
+    with ParallelLEFEngine(engine_from_params(params, seed), workers=workers, seed=seed) as eng:
+        return eng.run(params["steps"])
+
+def serial_engine(params, seed):
+    """
+    Engine function for equivalence.py: the random numbers of ParallelLEFEngine in one process (identical trajectories)
+    """
+    base = engine_from_params(params, seed)
+    key = int(np.random.SeedSequence(seed).generate_state(1, np.uint64)[0])
+    eng = _FieldEngine(base.N, base.lefRegions, base.blockers, 1 / base.unloadProb, 1 / base.unloadProbStalled,
+                       barriers=base.barriers, legs=base.legs, maxLoadTries=base.maxLoadTries, backend=base.backend, key=key)
+    return eng.run(params["steps"])
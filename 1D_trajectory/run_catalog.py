@@ -0,0 +1,250 @@
+###################
+# Catalog of past 1D and 3D runs, in SQLite
+# Every run records the cache key and resolved parameters of its 1D trajectory, its output location, wall time and
+# throughput, the code version it ran with (git describe) and its summary statistics (mean loop size and blocker
+# occupancy for 1D runs, radius of gyration for 3D runs). Parameters and statistics are also stored one value per
+# row (nested names joined by dots, i.e. left_blockers_capture.220 or occupancy.E1_2), indexed by name and value,
+# so runs can be looked up by parameter values, and throughput can be followed across code versions.
+# Run as: python3 run_catalog.py [--stage 1d] [--param LIFETIME=800] [--stat mean_loop_size] [--trends]
+###################
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import subprocess
+from trajectory_cache import canonical_json, _plain
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CATALOG = os.path.join(os.path.dirname(HERE), "runs", "catalog.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    run_name TEXT,
+    params TEXT NOT NULL,
+    metadata TEXT,
+    output TEXT,
+    wall_time REAL,
+    throughput REAL,
+    throughput_unit TEXT,
+    code_version TEXT,
+    host TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS params (run_id INTEGER NOT NULL REFERENCES runs(id), name TEXT NOT NULL, value);
+CREATE TABLE IF NOT EXISTS stats (run_id INTEGER NOT NULL REFERENCES runs(id), name TEXT NOT NULL, value REAL);
+CREATE INDEX IF NOT EXISTS runs_key ON runs(stage, key);
+CREATE INDEX IF NOT EXISTS runs_version ON runs(stage, code_version);
+CREATE INDEX IF NOT EXISTS params_value ON params(name, value);
+CREATE INDEX IF NOT EXISTS stats_value ON stats(name, value);
+CREATE INDEX IF NOT EXISTS params_run ON params(run_id);
+CREATE INDEX IF NOT EXISTS stats_run ON stats(run_id);
+"""
+
+_version = []
+
+def code_version():
+    """
+    git describe of the repository (with -dirty for uncommitted changes), or None outside a git checkout
+    """
+    if not _version:
+        try:
+            out = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=HERE, capture_output=True, text=True, timeout=10)
+            _version.append(out.stdout.strip() if out.returncode == 0 else None)
+        except (OSError, subprocess.SubprocessError):
+            _version.append(None)
+    return _version[0]
+
+def flatten(obj, prefix=""):
+    """
+    (dotted name, value) of every number, string or bool in nested dicts and lists
+    """
+    if isinstance(obj, dict):
+        return [item for k, v in obj.items() for item in flatten(v, "{}{}.".format(prefix, k))]
+    if isinstance(obj, list):
+        return [item for i, v in enumerate(obj) for item in flatten(v, "{}{}.".format(prefix, i))]
+    if obj is None or (isinstance(obj, float) and obj != obj): # Missing and NaN values are left out
+        return []
+    return [(prefix[:-1], obj)]
+
+class RunCatalog():
+    def __init__(self, path=DEFAULT_CATALOG):
+        """
+        Parameters:
+            path - str, SQLite file of the catalog (created if needed)
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def record(self, stage, key, params, metadata=None, output=None, wallTime=None, throughput=None, unit=None, stats=None):
+        """
+        Add a run
+        Parameters:
+            stage - str, "1d" or "3d"
+            key - str, cache key of the 1D trajectory
+            params - dict of resolved 1D parameters
+            metadata - dict, i.e. RUN_NAME and blocking regions
+            output - str, path of the trajectory or of the 3D output folder
+            wallTime - float, seconds
+            throughput, unit - float and its unit, i.e. 1D steps/s or MD steps/s
+            stats - dict of summary statistics (nested dicts allowed)
+        Returns:
+            id of the run
+        """
+        params, metadata = _plain(params), _plain(metadata or {})
+        with self.conn:
+            runId = self.conn.execute("""INSERT INTO runs (stage, key, run_name, params, metadata, output, wall_time, throughput,
+                                         throughput_unit, code_version, host, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                      (stage, key, metadata.get("RUN_NAME"), canonical_json(params), canonical_json(metadata),
+                                       output, wallTime, throughput, unit, code_version(), socket.gethostname(), time.time())).lastrowid
+            self.conn.executemany("INSERT INTO params VALUES (?, ?, ?)", [(runId, n, v) for n, v in flatten(params)])
+            self.conn.executemany("INSERT INTO stats VALUES (?, ?, ?)", [(runId, n, float(v)) for n, v in flatten(_plain(stats or {}))
+                                                                          if isinstance(v, (int, float))])
+        return runId
+
+    def find(self, stage=None, key=None, params=None, stats=None):
+        """
+        Runs matching every condition, newest first
+        Parameters:
+            params - dict {dotted name: value} of parameter values
+            stats - dict {dotted name: (low, high)} of statistic ranges (None for an open end)
+        Returns:
+            list of dicts (columns of runs, with params and metadata parsed)
+        """
+        where, args = [], []
+        if stage is not None:
+            where.append("r.stage = ?")
+            args.append(stage)
+        if key is not None:
+            where.append("r.key LIKE ?")
+            args.append(key + "%")
+        for name, value in (params or {}).items():
+            where.append("r.id IN (SELECT run_id FROM params WHERE name = ? AND value = ?)")
+            args += [name, _plain(value)]
+        for name, (low, high) in (stats or {}).items():
+            where.append("r.id IN (SELECT run_id FROM stats WHERE name = ? AND value >= ? AND value <= ?)")
+            args += [name, float("-inf") if low is None else low, float("inf") if high is None else high]
+        rows = self.conn.execute("SELECT r.* FROM runs r {} ORDER BY r.created DESC".format(
+            "WHERE " + " AND ".join(where) if where else ""), args).fetchall()
+        return [dict(row, params=json.loads(row["params"]), metadata=json.loads(row["metadata"] or "{}")) for row in rows]
+
+    def stats(self, runId):
+        """
+        Dict {dotted name: value} of the statistics of a run
+        """
+        return {row["name"]: row["value"] for row in self.conn.execute("SELECT name, value FROM stats WHERE run_id = ?", (runId,))}
+
+    def trends(self, stage):
+        """
+        Throughput per code version, in the order the versions were first used
+        Returns:
+            list of (code version, number of runs, mean throughput, unit)
+        """
+        return [tuple(row) for row in self.conn.execute("""
+            SELECT code_version, COUNT(*), AVG(throughput), MAX(throughput_unit) FROM runs
+            WHERE stage = ? AND throughput IS NOT NULL GROUP BY code_version ORDER BY MIN(created)""", (stage,))]
+
+def catalog_run(catalog, *args, **kwargs):
+    """
+    RunCatalog.record for the drivers: catalog is True for the default catalog, a RunCatalog, or False to skip;
+    a catalog that cannot be written (i.e. locked or read-only) only prints a warning
+    """
+    if not catalog:
+        return None
+    try:
+        if catalog is True:
+            catalog = RunCatalog()
+        return catalog.record(*args, **kwargs)
+    except (sqlite3.Error, OSError) as e:
+        print('Could not record the run in the catalog: {}'.format(e))
+        return None
+
+def trajectory_summary(path, params, metadata=None):
+    """
+    Summary statistics of a 1D trajectory (see lef_analysis.TrajectoryStats), over the blocking regions of its
+    metadata or the runs of blocker sites; empty if its positions are strided
+    Returns:
+        (dict of statistics, number of 1D steps in the trajectory)
+    """
+    import h5py
+    from lef_analysis import trajectory_stats
+    from convergence import blocking_regions
+    with h5py.File(path, mode='r') as f:
+        stride = int(f["positions"].attrs.get("stride", 1))
+        steps = f["positions"].shape[0] * stride
+        convergence = json.loads(f.attrs["convergence"]) if "convergence" in f.attrs else None
+    stats = {}
+    if stride == 1:
+        regions = (metadata or {}).get("blockingRegions") or blocking_regions(params)
+        stats = trajectory_stats(path, blockingRegions=regions).summary()
+    if convergence is not None:
+        stats["convergence"] = {"burn_in": convergence["burn_in"], "converged": convergence["converged"]}
+    return stats, steps
+
+def catalog_trajectory(catalog, key, params, metadata, path, wallTime=None):
+    """
+    Record a 1D trajectory with its summary statistics (see catalog_run for catalog). Without wallTime (a trajectory
+    read from the cache) it is only recorded if the catalog has no run with its key yet
+    """
+    if not catalog:
+        return None
+    try:
+        if catalog is True:
+            catalog = RunCatalog()
+        if wallTime is None and catalog.find(stage="1d", key=key):
+            return None
+        stats, steps = trajectory_summary(path, params, metadata)
+    except (sqlite3.Error, OSError) as e:
+        print('Could not record the run in the catalog: {}'.format(e))
+        return None
+    return catalog_run(catalog, "1d", key, params, metadata, output=os.path.abspath(path), wallTime=wallTime,
+                       throughput=steps / wallTime if wallTime else None, unit="steps/s", stats=stats)
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the catalog of past runs')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help='catalog file')
+    parser.add_argument('--stage', choices=['1d', '3d'], default=None)
+    parser.add_argument('--key', default=None, help='cache key (or prefix) of the 1D trajectory')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='parameter value (JSON when possible), i.e. LIFETIME=800 or left_blockers_capture.220=0.45')
+    parser.add_argument('--stat', action='append', default=[], metavar='NAME[=LOW:HIGH]',
+                        help='show a statistic, optionally only runs within a range, i.e. mean_loop_size=50:100')
+    parser.add_argument('--trends', action='store_true', help='throughput per code version instead of runs')
+    args = parser.parse_args()
+
+    catalog = RunCatalog(args.catalog)
+    if args.trends:
+        for stage in [args.stage] if args.stage else ['1d', '3d']:
+            for version, n, throughput, unit in catalog.trends(stage):
+                print('{}\t{}\t{} runs\t{:.4g} {}'.format(stage, version, n, throughput, unit))
+        return
+    params = {}
+    for p in args.param:
+        name, value = p.split("=", 1)
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    shown, ranges = [], {}
+    for s in args.stat:
+        name, _, span = s.partition("=")
+        shown.append(name)
+        if span:
+            low, high = span.split(":")
+            ranges[name] = (float(low) if low else None, float(high) if high else None)
+    for run in catalog.find(stage=args.stage, key=args.key, params=params, stats=ranges):
+        stats = catalog.stats(run["id"])
+        print('\t'.join([str(run["id"]), run["stage"], run["key"][:12], str(run["run_name"]), str(run["output"]),
+                         "{:.1f}s".format(run["wall_time"]) if run["wall_time"] is not None else "-"] +
+                        ["{}={}".format(name, stats.get(name)) for name in shown]))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+###################
+# Content-addressed on-disk cache of 1D trajectories
+# A trajectory is stored under the hash of the resolved parameters that produced it
+# (N, buffers, blocker tables, loading regions, lifetimes, steps and seed) and of TRAJECTORY_VERSION, so rerunning
+# identical conditions reads the cached trajectory instead of simulating it again.
+# The cache is size-bounded, evicting the least recently used trajectories first.
+###################
+import os
+import glob
+import json
+import hashlib
+import shutil
+import numpy as np
+import h5py
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(HERE, "trajectory", "cache")
+DEFAULT_MAX_BYTES = 5 * 1024**3
+### Version of the 1D semantics (loading, blocking, random draws) and trajectory format, part of every trajectory key.
+### Bump it whenever identical parameters start giving different trajectories, so old cache entries are not served
+### 1 - first cached trajectories
+### 2 - targeted loading spots from a shared alias table, clipped loading regions dropped in lef_genome
+TRAJECTORY_VERSION = 2
+
+def _plain(obj):
+    """
+    Convert parameters to plain JSON types (numpy scalars/arrays, tuples, non-string dict keys)
+    """
+    if isinstance(obj, dict):
+        return {str(_plain(k)): _plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_plain(x) for x in obj]
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    return obj
+
+def canonical_json(params):
+    """
+    Canonical JSON text of a parameter dict: plain types, sorted keys, no whitespace
+    """
+    return json.dumps(_plain(params), sort_keys=True, separators=(',', ':'))
+
+def params_key(params, version=TRAJECTORY_VERSION):
+    """
+    Cache key of a parameter dict (sha256 of its canonical JSON, together with version)
+    Parameters:
+        version - int, TRAJECTORY_VERSION for 1D trajectories; None to hash the parameters alone (i.e. for 3D libraries)
+    """
+    if version is not None:
+        params = {"params": params, "version": version}
+    return hashlib.sha256(canonical_json(params).encode()).hexdigest()
+
+class TrajectoryCache():
+    def __init__(self, root=DEFAULT_CACHE_DIR, maxBytes=DEFAULT_MAX_BYTES):
+        """
+        Parameters:
+            root - str, directory holding the cached trajectories (<key>.h5)
+            maxBytes - int, total size above which least recently used trajectories are evicted
+        """
+        self.root = root
+        self.maxBytes = maxBytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, "{}.h5".format(key))
+
+    def resolve(self, key):
+        """
+        Full key of a cached trajectory given its key or a unique prefix of it, or None
+        """
+        matches = [f[:-3] for f in os.listdir(self.root) if f.endswith(".h5") and f.startswith(key)]
+        if len(matches) > 1:
+            raise ValueError("Cache key prefix {} is ambiguous ({} matches)".format(key, len(matches)))
+        return matches[0] if matches else None
+
+    def lookup(self, key):
+        """
+        Path of a valid cached trajectory for this key (or unique key prefix), or None.
+        A hit marks the trajectory as recently used; an unreadable entry is removed
+        """
+        full = self.resolve(key)
+        if full is None:
+            return None
+        p = self.path(full)
+        try:
+            with h5py.File(p, mode='r') as f:
+                valid = "positions" in f and f.attrs.get("key") == full
+        except OSError:
+            valid = False
+        try:
+            if not valid:
+                os.unlink(p)
+                return None
+            os.utime(p) # Recently used
+        except FileNotFoundError: # Evicted by another process
+            return None
+        return p
+
+    def store(self, key, fname):
+        """
+        Move a finished trajectory file into the cache, then evict old entries if over the size limit
+        Returns:
+            path of the cached trajectory
+        """
+        p = self.path(key)
+        shutil.move(fname, p)
+        os.utime(p)
+        self.evict(keep=p)
+        return p
+
+    def entries(self):
+        """
+        List of (path, size, last used time) of all cached trajectories, least recently used first
+        """
+        out = []
+        for f in os.listdir(self.root):
+            if f.endswith(".h5"):
+                p = os.path.join(self.root, f)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError: # Evicted by another process since listdir
+                    continue
+                out.append((p, st.st_size, st.st_mtime))
+        return sorted(out, key=lambda e: e[2])
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used trajectories until the cache fits in maxBytes. Several processes may share
+        the cache, so files removed by another one in the meantime are skipped
+        """
+        entries = self.entries()
+        total = sum(size for p, size, t in entries)
+        for p, size, t in entries:
+            if total <= self.maxBytes:
+                break
+            if p == keep:
+                continue
+            for f in [p] + glob.glob(p[:-3] + "*.bonds"): # Bond tables of the 3D simulation (see 3D_simulation/bond_index.py)
+                try:
+                    os.unlink(f)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+def read_metadata(fname):
+    """
+    Parameters and metadata stored in the attributes of a trajectory file
+    Returns:
+        (params dict, metadata dict); empty dicts for trajectories written without them
+    """
+    with h5py.File(fname, mode='r') as f:
+        params = json.loads(f.attrs["params"]) if "params" in f.attrs else {}
+        metadata = json.loads(f.attrs["metadata"]) if "metadata" in f.attrs else {}
+    return params, metadata
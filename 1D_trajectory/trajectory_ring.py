@@ -0,0 +1,140 @@
+###################
+# Shared-memory ring buffer of 1D frames, for running the 1D and 3D stages at the same time
+# A 1D producer process publishes frames of LEF positions into the ring as it simulates them and blocks
+# when the ring is full (backpressure); the 3D driver reads them through FrameRingReader, which looks like
+# the "positions" dataset of LEFPositions.h5 to bondUpdater, so no intermediate trajectory file is needed.
+###################
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+OPEN, CLOSED, FAILED, CANCELLED = 0, 1, 2, 3 # Producer states; CANCELLED is set by the reader
+
+class FrameRing():
+    def __init__(self, LEFNum, capacity=200, ctx=None):
+        """
+        Parameters:
+            LEFNum - int, number of extruders per frame
+            capacity - int, number of frames the ring holds; the producer blocks when it is full
+            ctx - multiprocessing context of the producer process (default: the default context)
+        """
+        ctx = ctx or multiprocessing
+        self.LEFNum = LEFNum
+        self.capacity = capacity
+        self._buf = shared_memory.SharedMemory(create=True, size=max(capacity * LEFNum * 2 * 4, 1))
+        self._head = shared_memory.SharedMemory(create=True, size=3 * 8)
+        self.free = ctx.Semaphore(capacity) # Free slots
+        self.filled = ctx.Semaphore(0) # Frames ready to be read
+        self._owner = True
+        self._views()
+        self.header[:] = 0
+
+    def _views(self):
+        self.frames = np.ndarray((self.capacity, self.LEFNum, 2), dtype=np.int32, buffer=self._buf.buf)
+        self.header = np.ndarray(3, dtype=np.int64, buffer=self._head.buf) # Frames written, frames read, producer state
+
+    def __getstate__(self):
+        return {"LEFNum": self.LEFNum, "capacity": self.capacity, "buf": self._buf.name, "head": self._head.name,
+                "free": self.free, "filled": self.filled}
+
+    def __setstate__(self, state):
+        self.LEFNum = state["LEFNum"]
+        self.capacity = state["capacity"]
+        self._buf = shared_memory.SharedMemory(name=state["buf"])
+        self._head = shared_memory.SharedMemory(name=state["head"])
+        self.free = state["free"]
+        self.filled = state["filled"]
+        self._owner = False
+        self._views()
+
+    def put(self, frames):
+        """
+        Publish (n, LEFNum, 2) frames, waiting for free slots when the ring is full
+        Returns:
+            False if the reader cancelled the trajectory (see cancel), True otherwise
+        """
+        for frame in frames:
+            self.free.acquire()
+            if self.header[2] == CANCELLED:
+                self.free.release() # Let further calls return as well
+                return False
+            self.frames[self.header[0] % self.capacity] = frame
+            self.header[0] += 1
+            self.filled.release()
+        return True
+
+    def cancel(self):
+        """
+        Tell the producer that no more frames will be read (i.e. the 3D simulation stopped early); a producer
+        waiting for free slots wakes up and put returns False
+        """
+        self.header[2] = CANCELLED
+        self.free.release()
+
+    def close(self, state=CLOSED):
+        """
+        Mark the end of the trajectory (or FAILED if the producer stopped on an error)
+        """
+        self.header[2] = state
+        self.filled.release() # Wake up a waiting reader
+
+    def get(self, n, alive=None):
+        """
+        Read the next n frames, waiting for the producer as needed
+        Parameters:
+            alive - callable returning False once the producer is gone (i.e. Process.is_alive)
+        Returns:
+            (n, LEFNum, 2) int32 array
+        """
+        out = np.zeros((n, self.LEFNum, 2), dtype=np.int32)
+        for i in range(n):
+            while not self.filled.acquire(timeout=1):
+                if alive is not None and not alive():
+                    raise RuntimeError("1D producer exited after {} frames".format(self.header[0]))
+            if self.header[1] == self.header[0]: # Woken up by close()
+                self.filled.release()
+                raise RuntimeError("1D producer {} after {} frames".format(
+                    "failed" if self.header[2] == FAILED else "finished", self.header[0]))
+            out[i] = self.frames[self.header[1] % self.capacity]
+            self.header[1] += 1
+            self.free.release()
+        return out
+
+    def unlink(self):
+        """
+        Free the shared memory (creating process only, once both sides are done)
+        """
+        self.frames = self.header = None
+        for shm in (self._buf, self._head):
+            shm.close()
+            if self._owner:
+                shm.unlink()
+
+class FrameRingReader():
+    def __init__(self, ring, nFrames, producer=None):
+        """
+        Array-like, read-once view of a FrameRing for bondUpdater: slices must be read in order,
+        i.e. positions[curtime:curtime+blocks]
+        Parameters:
+            nFrames - int, total number of frames the producer will publish
+            producer - multiprocessing.Process of the producer, to notice if it dies
+        """
+        self.ring = ring
+        self.shape = (nFrames, ring.LEFNum, 2)
+        self.producer = producer
+        self.pos = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise ValueError("Frames of a FrameRing can only be read as consecutive slices")
+        start = self.pos if key.start is None else key.start
+        stop = self.shape[0] if key.stop is None else min(key.stop, self.shape[0])
+        if start != self.pos:
+            raise ValueError("Frames of a FrameRing are read in order: expected frame {}, got {}".format(self.pos, start))
+        alive = self.producer.is_alive if self.producer is not None else None
+        out = self.ring.get(max(stop - start, 0), alive=alive)
+        self.pos += len(out)
+        return out
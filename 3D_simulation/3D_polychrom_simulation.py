@@ -4,24 +4,113 @@
 # Originally written as a jupyter notebook
 ###############
 
+import os
+import sys
+import json
 import time
+import argparse
+import importlib
+import multiprocessing
 import numpy as np
 import h5py
-from bondUpdater import bondUpdater
-from polychrom.starting_conformations import grow_cubic
-from polychrom.simulation import Simulation
-from polychrom.hdf5_format import HDF5Reporter
-import polychrom.forcekits as forcekits
-import polychrom.forces as forces
-import matplotlib.pyplot as plt
-
-def main():
+from bondUpdater import bondUpdater, clockedBondUpdater
+from bond_index import bond_index_for
+from instrumentation import PhaseTimer, openmm_timing
+from fast_reporter import FastReporter
+from conformation_analysis import radius_of_gyration
+from starting_conformations import DEFAULT_FORCES, ConformationLibrary, add_polymer_forces, grow
+from coarse_grain import CoarseFrames, coarse_forces, n_beads, write_preview_info
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "1D_trajectory"))
+from trajectory_cache import TrajectoryCache, params_key
+from trajectory_ring import FrameRing, FrameRingReader
+from lef_simulation import stream_1D
+from convergence import SeriesMonitor
+from run_catalog import catalog_run
+
+def pipe_1D(params, metadata, capacity, archive=False):
+    """
+    Run a 1D simulation in a separate process while the 3D simulation consumes its frames
+    through a shared-memory ring, instead of reading them from LEFPositions.h5
+
+    :param params: resolved 1D parameters (from the parameters() function of a 1D driver)
+    :param metadata: dict stored with the archived trajectory
+    :param capacity: frames held by the ring; the 1D process waits when the 3D simulation is this far behind
+    :param archive: also store the 1D trajectory in the trajectory cache
+    :return: (positions, N, LEFNum, producer process, ring)
+    """
+    LEFNum = int(np.sum(params["loading_region_freqs"]))
+    ctx = multiprocessing.get_context("spawn") # Do not fork a process that may hold a GPU context
+    ring = FrameRing(LEFNum, capacity=capacity, ctx=ctx)
+    producer = ctx.Process(target=stream_1D, args=(params, ring), kwargs={"metadata": metadata, "archive": archive}, daemon=True)
+    producer.start()
+    return FrameRingReader(ring, params["steps"], producer), params["N"], LEFNum, producer, ring
+
+def main(argv=None):
     ### Gather parameters from the 1D portion
-    trajectories = h5py.File("../1D_trajectory/trajectory/LEFPositions.h5") # Saved trajectories from 1D siumulation
-    N = trajectories.attrs["N"] # Length of polymer
-    LEFNum = trajectories.attrs["LEFNum"] # Number of extruders
-    LEFpositions = trajectories["positions"] # Positions of extruders at each 1D step
-    Nframes = LEFpositions.shape[0] # Number of 1D steps (= number of extruder steps)
+    # Usage: python3 3D_polychrom_simulation.py [1D trajectory cache key (or a unique prefix of it) | --trajectory <file.h5>]
+    #        python3 3D_polychrom_simulation.py --pipe <1D driver, i.e. 1D_polychrom_simulation_blocking_WT> [--archive]
+    parser = argparse.ArgumentParser(description='3D loop extrusion simulation of a 1D trajectory (default: ../1D_trajectory/trajectory/LEFPositions.h5)')
+    parser.add_argument('key', nargs='?', default=None, help='cache key of the 1D trajectory, or a unique prefix of it')
+    parser.add_argument('--trajectory', metavar='FILE', default=None, help='1D trajectory file to simulate, i.e. one kept in a run directory')
+    parser.add_argument('--pipe', metavar='DRIVER', default=None,
+                        help='run this 1D driver (i.e. 1D_polychrom_simulation_blocking_WT) alongside, reading its frames as they are made')
+    parser.add_argument('--archive', action='store_true', help='--pipe: also store the 1D trajectory in the trajectory cache')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if sum(a is not None for a in (args.key, args.trajectory, args.pipe)) > 1:
+        parser.error('give one of a cache key, --trajectory or --pipe')
+    if args.archive and args.pipe is None:
+        parser.error('--archive only applies to --pipe')
+    RING_FRAMES = 200 # --pipe: 1D frames the 1D process may run ahead of the 3D simulation
+    TRAJECTORY_STREAM = "positions" # Output stream of the 1D trajectory to read (i.e. a strided "positions_3D", see lef_simulation.write_trajectory)
+    BLOCK_STRIDE = 1 # 1D steps per block: bonds follow every BLOCK_STRIDE-th 1D step (a multiple of the stream's stride)
+    ### Preview mode: PREVIEW_BEADS monomers per bead (1 = full resolution). Extruder legs and blocking regions are mapped
+    # to beads, the angle stiffness divided by PREVIEW_BEADS (other forces stay in bead units, see coarse_grain.coarse_forces)
+    # and the MD steps per block divided by PREVIEW_BEADS; conformations go to sim_outs_preview/
+    # and their contact maps compare to full-resolution maps binned by PREVIEW_BEADS (see coarse_grain.py)
+    PREVIEW_BEADS = 1
+    SKIP_BURN_IN = True # Start after the 1D burn-in of trajectories run with a convergence monitor (burn_in attribute, see convergence.py)
+    burnInSteps = None # 1D steps before steady state; None if the trajectory was not monitored
+    producer = None
+    trajectoryFile = "../1D_trajectory/trajectory/LEFPositions.h5"
+    params, metadata = {}, {} # Of the 1D trajectory, for the run catalog
+    if args.pipe is not None:
+        params, metadata = importlib.import_module(args.pipe).parameters()
+        cached = TrajectoryCache().lookup(params_key(params))
+        if cached is not None:
+            print('Trajectory for {} found in cache, not running the 1D simulation'.format(args.pipe))
+            trajectoryFile = cached
+        else:
+            LEFpositions, N, LEFNum, producer, ring = pipe_1D(params, metadata, RING_FRAMES, archive=args.archive)
+    elif args.key is not None:
+        trajectoryFile = TrajectoryCache().lookup(args.key)
+        if trajectoryFile is None:
+            print('No cached 1D trajectory with key {}'.format(args.key))
+            os._exit(1)
+    elif args.trajectory is not None:
+        trajectoryFile = args.trajectory
+        if not os.path.isfile(trajectoryFile):
+            print('No 1D trajectory file {}'.format(trajectoryFile))
+            os._exit(1)
+    if producer is None:
+        trajectories = h5py.File(trajectoryFile, mode='r') # Saved trajectories from 1D siumulation
+        N = trajectories.attrs["N"] # Length of polymer
+        LEFNum = trajectories.attrs["LEFNum"] # Number of extruders
+        LEFpositions = trajectories[TRAJECTORY_STREAM] # Positions of extruders at every stride-th 1D step
+        if "burn_in" in trajectories.attrs:
+            burnInSteps = int(trajectories.attrs["burn_in"])
+        if "params" in trajectories.attrs:
+            params, metadata = json.loads(trajectories.attrs["params"]), json.loads(trajectories.attrs["metadata"])
+    streamStride = int(LEFpositions.attrs.get("stride", 1)) if producer is None else 1 # 1D steps per frame
+    if BLOCK_STRIDE % streamStride != 0:
+        print('BLOCK_STRIDE ({}) must be a multiple of the stride of stream {} ({})'.format(BLOCK_STRIDE, TRAJECTORY_STREAM, streamStride))
+        os._exit(1)
+    frameStride = BLOCK_STRIDE // streamStride # Frames per block
+    Nframes = LEFpositions.shape[0] // frameStride # Number of blocks (= number of extruder steps used)
+    monomers = N
+    if PREVIEW_BEADS > 1:
+        N = n_beads(N, PREVIEW_BEADS) # Number of beads simulated
+        LEFpositions = CoarseFrames(LEFpositions, PREVIEW_BEADS, N)
+        print('Preview: {} monomers coarse-grained to {} beads of {}'.format(monomers, N, PREVIEW_BEADS))
 
     print("""
     Polymer is {} monomers long. There are {} Extruders loaded. 
@@ -30,8 +119,23 @@ def main():
 
     ### Set molecular dynamics parameters
     steps = 500 # MD steps PER STEP OF EXTRUDER
+    if PREVIEW_BEADS > 1:
+        steps = max(steps // PREVIEW_BEADS, 1) # Extruders move 1/PREVIEW_BEADS of a bead per 1D step
     box = (N / 0.1) ** 0.35 # Dimensions of bounding box with Periodic Boundary Conditions (PBC)
-    data = grow_cubic(N, int(box)) # Initialize random-walk chains for our polymers
+    polymerForces = DEFAULT_FORCES # Bond, angle and nonbonded force parameters (see starting_conformations.py)
+    if PREVIEW_BEADS > 1:
+        polymerForces = coarse_forces(polymerForces, PREVIEW_BEADS)
+    ### Starting conformation: "grow_cubic", "random_walk" (vectorized, for large N), or "library": a cached,
+    # pre-equilibrated conformation for this N, box and force set, generated in parallel the first time
+    STARTING_CONFORMATION = "grow_cubic"
+    LIBRARY_SIZE = 16 # "library": number of conformations in the library
+    REPLICA = 0 # "library": replica index of this run, i.e. which conformation it starts from
+    if STARTING_CONFORMATION == "library":
+        library = ConformationLibrary(N, box=box, forces=polymerForces)
+        library.generate(LIBRARY_SIZE)
+        data = library.sample(REPLICA)
+    else:
+        data = grow(N, box, STARTING_CONFORMATION) # Initialize random-walk chains for our polymers
     # SMC (Extruder) parameters
     smcBondWiddleDist = 0.2
     smcBondDist = 0.5
@@ -39,10 +143,38 @@ def main():
     ### Simulation saving parameters
     saveEveryBlocks = 5 # Write coordinates every this many blocks
     restartSimulationEveryBlocks = 100 # 
+    FAST_SAMPLING = True # Save coordinates straight from the context instead of through do_block (no energy evaluation)
+    checkEveryBlocks = 100 # With FAST_SAMPLING, run do_block (energy and sanity checks, not saved) every this many blocks
+    ### Radius of gyration of the saved conformations: steady state (after relaxing from the starting conformation)
+    # and convergence of its mean are detected over windows of RG_WINDOW conformations, and written to sim_outs/convergence.json
+    RG_WINDOW = 10
+    RG_STOP = False # End the run at the next restart once the mean radius of gyration has converged
+    startBlock = 0 # First block of the trajectory simulated
+    if SKIP_BURN_IN and burnInSteps is not None:
+        if burnInSteps < 0:
+            print('The 1D trajectory did not reach steady state; simulating it from the start')
+        # Skip the burn-in, rounded up so that the remaining blocks fill whole restarts (monitored runs may stop early)
+        burnInBlocks = -(-max(burnInSteps, 0) // BLOCK_STRIDE)
+        startBlock = Nframes - (Nframes - burnInBlocks) // restartSimulationEveryBlocks * restartSimulationEveryBlocks
+        Nframes -= startBlock
+        print('Skipping the first {} blocks of the trajectory (1D burn-in: {} steps)'.format(startBlock, burnInSteps))
     # Checks
     assert Nframes % restartSimulationEveryBlocks == 0 # So we don't have leftover steps that won't get saved
     assert (restartSimulationEveryBlocks % saveEveryBlocks) == 0
 
+    ### SMC bond backend: "harmonic" adds the SMC bonds to the polymer's HarmonicBondForce and re-uploads
+    # all bond parameters every block; "clocked" keeps them in their own CustomBondForce, switched on and off
+    # by a single global parameter per block (faster with many LEFs)
+    BOND_BACKEND = "harmonic"
+    ### "harmonic" backend: read the SMC bonds of each restart from a table of the whole trajectory, built once and
+    # saved next to it (<trajectory>.bonds, see bond_index.py) so further runs and replicas reuse it
+    BOND_INDEX = True
+
+    ### Instrumentation parameters
+    TIMING_LOG = "timing.jsonl" # One JSON summary line per simulation restart; None prints to stdout
+    PROFILE = False # Also run cProfile over each simulation restart (profile_segment<i>.prof)
+    CATALOG = True # Record the run (trajectory key, output, wall time, MD steps/s, radius of gyration) in the run catalog (see run_catalog.py)
+
     savesPerSim = restartSimulationEveryBlocks // saveEveryBlocks
     simInitsTotal = Nframes // restartSimulationEveryBlocks # Number of simulation initializations
 
@@ -54,43 +186,43 @@ def main():
 
 
     ### The Simulation Loop
-    milker = bondUpdater(LEFpositions)
+    from polychrom.simulation import Simulation # Imported here so that argument errors and cache lookups stay fast
+    index = None
+    if BOND_INDEX and BOND_BACKEND == "harmonic" and producer is None and PREVIEW_BEADS == 1: # Frames piped from a 1D process (or coarse-grained) have no file to index
+        index = bond_index_for(trajectoryFile, dataset=TRAJECTORY_STREAM)
+    milker = {"harmonic": bondUpdater, "clocked": clockedBondUpdater}[BOND_BACKEND](LEFpositions, index=index, stride=frameStride)
+    milker.curtime = startBlock * frameStride # Frame of the first block
+    rgMonitor = SeriesMonitor(["rg"], window=RG_WINDOW)
 
-    reporter = HDF5Reporter(folder="sim_outs", # Save data location
+    reporter = FastReporter(folder="sim_outs" if PREVIEW_BEADS == 1 else "sim_outs_preview", # Save data location (same layout as polychrom's HDF5Reporter)
                             max_data_length=100, # Write data in chunks of this size - THIS CONTROLS HOW MANY CONFIGS ARE IN EACH BLOCK!
                             overwrite=True, # overwrite existing file in out location
                             blocks_only=True) # only save simulation blocks
+    if PREVIEW_BEADS > 1:
+        write_preview_info(reporter.folder, PREVIEW_BEADS, monomers, regions=metadata.get("blockingRegions")) # Blockers in beads
 
+    timer = PhaseTimer(logfile=TIMING_LOG, profile=PROFILE)
+    runWall, runMdSteps = 0.0, 0 # Totals over the restarts, for the run catalog
     for iter in range(simInitsTotal):
+        timer.start_segment(iter)
         # Create the simulation object
-        a = Simulation(
-                platform="cuda", # platform to do computations on
-                integrator="variableLangevin", # Integrator from OpenMM
-                error_tol=0.01, # error rate parameter for variableLangevin integrator
-                GPU="0", # GPU index
-                collision_rate=0.03, # collision rate of particles in inverse picoseconds
-                N=len(data), # no. of particles
-                reporters=[reporter], # list of reporter objects to use
-                PBCbox=[box,box,box], # Periodic Boundary Conditions (PBC) box dimensions (x,y,z)
-                precision="mixed" # GPU calculation precision, mixed is slow on 3080 and newer GPUs
-        )
-        # Loads the polymer we created, and puts center of mass at (0,0,0)
-        a.set_data(data) 
-        # Add a force to the simulation object - since we are doing polymer simulation, we add a 'forcekit' that describes all the forces in a polymer chain and the interactions between them
-        a.add_force(
-            forcekits.polymer_chains(
-                a, # Simulation object
-                chains=[(0, None, 0)], # List of tuples desctibing 1 chain each - this is the default value, i.e. one chain of length N that is not a ring (i.e. a chain)
-                bond_force_func=forces.harmonic_bonds, # Define the bonded force as harmonic bonds
-                bond_force_kwargs={'bondLength':1.0, 'bondWiggleDistance':0.05}, # Parameters for harmonic bonds
-                angle_force_func=forces.angle_force, # Angle force 
-                angle_force_kwargs={'k':1.5}, # Angle force parameters. k = stiffness bond (8=very stiff, k=1.5 is "realistically flexible")
-                nonbonded_force_func=forces.grosberg_repulsive_force, # Nonbonded force
-                nonbonded_force_kwargs={'trunc':1.5, # Allows chains to cross, the energy value at dist=0
-                                        'radiusMult':1},
-                except_bonds=True # Nonbonded forces do not affect bonded pieces
+        with timer.phase("simulation_init"):
+            a = Simulation(
+                    platform="cuda", # platform to do computations on
+                    integrator="variableLangevin", # Integrator from OpenMM
+                    error_tol=0.01, # error rate parameter for variableLangevin integrator
+                    GPU="0", # GPU index
+                    collision_rate=0.03, # collision rate of particles in inverse picoseconds
+                    N=len(data), # no. of particles
+                    reporters=[reporter], # list of reporter objects to use
+                    PBCbox=[box,box,box], # Periodic Boundary Conditions (PBC) box dimensions (x,y,z)
+                    precision="mixed" # GPU calculation precision, mixed is slow on 3080 and newer GPUs
             )
-        )
+            # Loads the polymer we created, and puts center of mass at (0,0,0)
+            a.set_data(data) 
+        # Add a force to the simulation object - since we are doing polymer simulation, we add a 'forcekit' that describes all the forces in a polymer chain and the interactions between them
+        with timer.phase("add_forces"):
+            add_polymer_forces(a, polymerForces) # Harmonic bonds, angle force and Grosberg repulsion, see starting_conformations.py
         #a.add_force(forces.spherical_confinement(a,density=0.2)) # Confine polymer in a sphere
         # Calculate bond parameters for extruder contact
         kbond = a.kbondScalingFactor / (smcBondWiddleDist**2)
@@ -98,29 +230,72 @@ def main():
         activeParams = {"length":bondDist, "k":kbond}
         inactiveParams = {"length":bondDist, "k":0}
         # Set up bond manager object ("milker")
-        milker.setParams(activeParams, inactiveParams)
-        milker.setup(bondForce=a.force_dict["harmonic_bonds"], blocks=restartSimulationEveryBlocks)
+        with timer.phase("bond_setup"):
+            milker.setParams(activeParams, inactiveParams)
+            if BOND_BACKEND == "clocked":
+                a.add_force(milker.create_force())
+            milker.setup(bondForce=a.force_dict[milker.forceName], blocks=restartSimulationEveryBlocks)
 
-        # During the first simulation initiation, minimize energy of conformations
-        if iter == 0:
-            a.local_energy_minimization()
+        # During the first simulation initiation, minimize energy of conformations (library conformations already are)
+        if iter == 0 and STARTING_CONFORMATION != "library":
+            with timer.phase("energy_minimization"):
+                a.local_energy_minimization()
         else:
-            a._apply_forces()
+            with timer.phase("apply_forces"):
+                a._apply_forces()
+        timingStart = openmm_timing(a.context)
         ########## Start of the actual physics/MD calculations ##########
         for i in range(restartSimulationEveryBlocks): # Loop for our simulation length
-            if i % saveEveryBlocks == (saveEveryBlocks-1): ### THIS IS WHERE WE SAVE A BLOCK!!! At the last step of the simulation before we restart
-                a.do_block(steps=steps) # do steps AND GET new monomer positions consisting of <steps> steps
+            save = i % saveEveryBlocks == (saveEveryBlocks-1) ### THIS IS WHERE WE SAVE A BLOCK!!!
+            if save and not FAST_SAMPLING:
+                with timer.phase("do_block"):
+                    a.do_block(steps=steps) # do steps AND GET new monomer positions consisting of <steps> steps
+            elif FAST_SAMPLING and (iter * restartSimulationEveryBlocks + i) % checkEveryBlocks == (checkEveryBlocks-1):
+                with timer.phase("do_block"):
+                    a.do_block(steps=steps, save=False) # do steps and check energies, without saving
             else:
-                a.integrator.step(steps) # do steps WITHOUT getting new monomer positions (faster)
+                with timer.phase("md_step"):
+                    a.integrator.step(steps) # do steps WITHOUT getting new monomer positions (faster)
+            if save and FAST_SAMPLING:
+                with timer.phase("sample"):
+                    reporter.sample(a) # Positions only, straight into the reporter's buffer
+            if save:
+                rgMonitor.add([radius_of_gyration(reporter.last)])
+            timer.count("md_steps", steps)
             if i < restartSimulationEveryBlocks - 1: # if this is not the final block...
-                curBonds, pastBonds = milker.step(a.context) # Update bonds with the milker
-        data = a.get_data() # Fetch new polymer positions 
+                with timer.phase("bond_update"):
+                    curBonds, pastBonds = milker.step(a.context) # Update bonds with the milker
+                timer.count("blocks")
+                timer.count("bonds_changed", len(set(curBonds).symmetric_difference(pastBonds)))
+        timingEnd = openmm_timing(a.context)
+        with timer.phase("get_data"):
+            data = a.get_data() # Fetch new polymer positions 
         del a 
 
         reporter.blocks_only = True # Write only blocks, not individual steps in block
-        time.sleep(0.2) # wait so garbage collector can clean up
+        with timer.phase("sleep"):
+            time.sleep(0.2) # wait so garbage collector can clean up
+        segment = timer.end_segment(platform=timingEnd["platform"], sim_time_ps=timingEnd["sim_time_ps"] - timingStart["sim_time_ps"])
+        runWall += segment["wall_seconds"]
+        runMdSteps += segment["counters"].get("md_steps", 0)
+        with open(os.path.join(reporter.folder, "convergence.json"), "w") as f:
+            json.dump({"trajectory_burn_in": burnInSteps, "start_block": startBlock,
+                       "burn_in_conformations": rgMonitor.summary()["burn_in"], "rg": rgMonitor.summary()}, f, indent=1)
+        if RG_STOP and rgMonitor.converged:
+            print('Radius of gyration converged after {} conformations, stopping'.format(rgMonitor.samples))
+            if producer is not None:
+                ring.cancel() # The 1D process would otherwise wait forever for the frames left in the ring to be read
+            break
 
     reporter.dump_data() # Output
+    rg = rgMonitor.summary()
+    catalog_run(CATALOG, "3d", params_key(params) if params else "", params, metadata, output=os.path.abspath(reporter.folder),
+                wallTime=runWall, throughput=runMdSteps / runWall if runWall > 0 else None, unit="MD steps/s",
+                stats={"conformations": reporter.counter, "start_block": startBlock, "preview_beads": PREVIEW_BEADS, "rg_mean": rg["mean"]["rg"],
+                       "rg_standard_error": rg["standard_error"]["rg"], "rg_burn_in": rg["burn_in"]})
+    if producer is not None:
+        producer.join()
+        ring.unlink()
 
 if __name__ == '__main__':
     main()
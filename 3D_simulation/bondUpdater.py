@@ -1,17 +1,31 @@
 #### Object for handling bonds
 import numpy as np
 class bondUpdater(object):
+    forceName = "harmonic_bonds" # Force (in Simulation.force_dict) that the SMC bonds are added to
 
-    def __init__(self, LEFpositions):
+    def __init__(self, LEFpositions, index=None, stride=1):
         """
         Initialize a bondUpdater object
 
         :param LEFpositions: numpy array of extruder positions wrt polymer position
+        :param index: BondIndex of the whole trajectory (see bond_index.py); setup and step then work on bond ids
+        :param stride: frames of LEFpositions per block; every stride-th frame is used
         """
         self.LEFpositions = LEFpositions
+        self.index = index
+        self.stride = stride
         self.curtime  = 0
         self.allBonds = []
 
+    def _frames(self, blocks):
+        """
+        Positions of the next blocks (every stride-th frame from curtime); advances curtime
+        """
+        stop = self.curtime + blocks * self.stride
+        frames = self.LEFpositions[self.curtime : stop] # Consecutive frames, so that FrameRingReader works too
+        self.curtime = stop
+        return frames[::self.stride] if self.stride != 1 else frames
+
     def setParams(self, activeParamDict, inactiveParamDict):
         """
         A method to set parameters for bonds.
@@ -41,11 +55,13 @@ class bondUpdater(object):
             raise ValueError("Not all bonds were used; {0} sets left".format(len(self.allBonds)))
 
         self.bondForce = bondForce # force_dict from simulation object (bondForce obj)
+        if self.index is not None:
+            return self._setup_indexed(bondForce, blocks)
 
         #precalculating all bonds
         allBonds = []
         
-        loaded_positions  = self.LEFpositions[self.curtime : self.curtime+blocks] # Get all extruder positions from curtime to curtime+blocks
+        loaded_positions  = self._frames(blocks) # Get all extruder positions for the next blocks
         allBonds = [[(int(loaded_positions[i, j, 0]), int(loaded_positions[i, j, 1])) 
                         for j in range(loaded_positions.shape[1])] for i in range(blocks)] # Get all positions for both legs of extruder, i.e. location of the 'bonds'
         self.allBonds = allBonds
@@ -62,11 +78,43 @@ class bondUpdater(object):
             self.bondInds.append(ind)
         self.bondToInd = {i:j for i,j in zip(self.uniqueBonds, self.bondInds)} # Dict of {bond : bond index}
         
-        self.curtime += blocks # Advance blocks
-        
         return self.curBonds,[]
 
 
+    def _setup_indexed(self, bondForce, blocks):
+        """
+        setup() from the trajectory-wide bond table: the bonds of the segment are a slice of it
+        """
+        frames = self.index.frames(self.curtime, self.curtime + blocks * self.stride, self.stride) # Bond ids of each block
+        self.curtime += blocks * self.stride
+        self.uniqueBonds = np.unique(np.concatenate(frames))
+        self.bondPairs = dict(zip(self.uniqueBonds.tolist(), self.index.pairs(self.uniqueBonds))) # {bond id : (i, j)}
+        active = np.isin(self.uniqueBonds, frames[0])
+        self.bondInds = [bondForce.addBond(i, j, **(self.activeParamDict if a else self.inactiveParamDict))
+                         for (i, j), a in zip(self.bondPairs.values(), active)]
+        self.bondToInd = dict(zip(self.bondPairs, self.bondInds)) # Dict of {bond id : bond index}
+        self.allBonds = [f.tolist() for f in frames]
+        self.curIds = self.allBonds.pop(0)
+        self.curBonds = [self.bondPairs[b] for b in self.curIds]
+        return self.curBonds, []
+
+    def _step_indexed(self, context, verbose):
+        pastIds, pastBonds = self.curIds, self.curBonds
+        self.curIds = self.allBonds.pop(0)
+        self.curBonds = [self.bondPairs[b] for b in self.curIds]
+        past, cur = set(pastIds), set(self.curIds)
+        bondsAdd = [b for b in self.curIds if b not in past]
+        bondsRemove = [b for b in pastIds if b not in cur]
+        if verbose:
+            print("{0} bonds stay, {1} new bonds, {2} bonds removed".format(len(cur) - len(bondsAdd),
+                                                                            len(bondsAdd), len(bondsRemove)))
+        for ids, paramset in ((bondsAdd, self.activeParamDict), (bondsRemove, self.inactiveParamDict)):
+            for bond in ids:
+                i, j = self.bondPairs[bond]
+                self.bondForce.setBondParameters(self.bondToInd[bond], i, j, **paramset)
+        self.bondForce.updateParametersInContext(context)
+        return self.curBonds, pastBonds
+
     def step(self, context, verbose=True):
         """
         Update the bonds to the next step.
@@ -76,6 +124,8 @@ class bondUpdater(object):
         """
         if len(self.allBonds) == 0:
             raise ValueError("No bonds left to run; you should restart simulation and run setup  again")
+        if self.index is not None:
+            return self._step_indexed(context, verbose)
 
         pastBonds = self.curBonds
         self.curBonds = self.allBonds.pop(0)  # getting current bonds
@@ -92,4 +142,78 @@ class bondUpdater(object):
             paramset = self.activeParamDict if isAdd else self.inactiveParamDict # Fetch parameters
             self.bondForce.setBondParameters(ind, bond[0], bond[1], **paramset)  # actually updating bonds
         self.bondForce.updateParametersInContext(context)  # now run this to update things in the context
-        return self.curBonds, pastBonds
\ No newline at end of file
+        return self.curBonds, pastBonds
+
+
+class clockedBondUpdater(bondUpdater):
+    """
+    bondUpdater with the SMC bonds in their own CustomBondForce. Each bond carries the interval of blocks
+    [t_on, t_off) in which it is active, and a global parameter smc_t holds the current block, so step()
+    only sets one global parameter instead of uploading the whole bond list to the context.
+    A bond held again later in the segment gets one entry per interval.
+    """
+    forceName = "smc_bonds"
+
+    def create_force(self):
+        """
+        Create the CustomBondForce for the SMC bonds of one simulation; add it to the Simulation
+        (i.e. a.add_force) before calling setup. Uses the "length" and "k" of the active bond parameters
+
+        :return: openmm.CustomBondForce named smc_bonds
+        """
+        import openmm
+        force = openmm.CustomBondForce("active * 0.5 * smc_k * (r - smc_r0)^2;"
+                                       "active = step(smc_t - t_on) * step(t_off - smc_t - 0.5)")
+        force.addGlobalParameter("smc_k", self.activeParamDict["k"])
+        force.addGlobalParameter("smc_r0", self.activeParamDict["length"])
+        force.addGlobalParameter("smc_t", 0)
+        force.addPerBondParameter("t_on")
+        force.addPerBondParameter("t_off")
+        force.name = self.forceName
+        return force
+
+    def setup(self, bondForce, blocks=100, smcStepsPerBlock=1):
+        """
+        Add one bond per interval in which an extruder holds the same pair of monomers, for the next blocks
+
+        :param bondForce: the force made by create_force (new after simulation restart!)
+        :param blocks: number of blocks to precalculate
+        :param smcStepsPerBlock: number of smcTranslocator steps per block
+        :return: (current bonds, [])
+        """
+        if len(self.allBonds) != 0:
+            raise ValueError("Not all bonds were used; {0} sets left".format(len(self.allBonds)))
+        self.bondForce = bondForce
+        positions = np.asarray(self._frames(blocks), dtype=np.int64)
+        self.allBonds = [[tuple(bond) for bond in frame] for frame in positions.tolist()]
+
+        change = np.ones(positions.shape[:2], dtype=bool) # (block, extruder): bond differs from the previous block
+        change[1:] = np.any(positions[1:] != positions[:-1], axis=2)
+        lef, t_on = np.nonzero(change.T) # Intervals, sorted by extruder then block
+        t_off = np.append(t_on[1:], blocks)
+        t_off[np.append(lef[1:] != lef[:-1], True)] = blocks # Last interval of each extruder
+        legs = positions[t_on, lef]
+        self.bondInds = [bondForce.addBond(int(i), int(j), [float(a), float(b)])
+                         for (i, j), a, b in zip(legs, t_on, t_off)]
+        self.uniqueBonds = list(set(sum(self.allBonds, [])))
+        self.block = 0
+        self.curBonds = self.allBonds.pop(0)
+        return self.curBonds, []
+
+    def step(self, context, verbose=True):
+        """
+        Advance to the next block by setting smc_t in the context
+
+        :param context: context
+        :return: (current bonds, previous step bonds); just for reference
+        """
+        if len(self.allBonds) == 0:
+            raise ValueError("No bonds left to run; you should restart simulation and run setup  again")
+        pastBonds = self.curBonds
+        self.curBonds = self.allBonds.pop(0)
+        if verbose:
+            past, cur = set(pastBonds), set(self.curBonds)
+            print("{0} bonds stay, {1} new bonds, {2} bonds removed".format(len(past & cur), len(cur - past), len(past - cur)))
+        self.block += 1
+        context.setParameter("smc_t", self.block)
+        return self.curBonds, pastBonds
@@ -0,0 +1,143 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Trajectory-wide table of SMC bonds, built once per 1D trajectory and shared by all 3D restarts and replicas
+# Every unique (i, j) pair of leg positions gets an integer id (its row in `bonds`), and the bonds of each frame
+# are stored in CSR form: the ids active in frame f are indices[indptr[f]:indptr[f+1]]. The table is saved next
+# to the trajectory (<trajectory>.bonds, an HDF5 file), so bondUpdater.setup only slices it instead of rebuilding the bond
+# sets of every segment from Python tuples.
+###############
+import os
+import sys
+import tempfile
+import numpy as np
+import h5py
+
+class BondIndex(object):
+    def __init__(self, bonds, indptr, indices):
+        """
+        :param bonds: (nBonds, 2) int array of unique (i, j) pairs; the row is the bond id
+        :param indptr: (nFrames + 1,) int array, CSR row pointers
+        :param indices: int array, ids of the bonds active in each frame (in extruder order)
+        """
+        self.bonds = np.asarray(bonds, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.nFrames = len(self.indptr) - 1
+
+    def __len__(self):
+        return self.nFrames
+
+    def frames(self, start, stop, step=1):
+        """
+        Ids of the active bonds of frames range(start, stop, step)
+
+        :return: list of int arrays, one per frame
+        """
+        stop = min(stop, self.nFrames)
+        if step != 1:
+            return [self.indices[self.indptr[f]:self.indptr[f+1]] for f in range(start, stop, step)]
+        ptr = self.indptr[start:stop+1]
+        return np.split(self.indices[ptr[0]:ptr[-1]], ptr[1:-1] - ptr[0])
+
+    def pairs(self, ids):
+        """
+        (i, j) tuples of bond ids
+        """
+        return [tuple(b) for b in self.bonds[ids].tolist()]
+
+    def save(self, fname, source=""):
+        """
+        Write the table to an HDF5 file (atomically, so concurrent replicas never read a partial file)
+
+        :param source: fingerprint of the trajectory the table was built from (see trajectory_fingerprint)
+        """
+        fd, tmp = tempfile.mkstemp(suffix=".h5.tmp", dir=os.path.dirname(os.path.abspath(fname)))
+        os.close(fd)
+        with h5py.File(tmp, mode='w') as f:
+            f.create_dataset("bonds", data=self.bonds, compression="gzip")
+            f.create_dataset("indptr", data=self.indptr, compression="gzip")
+            f.create_dataset("indices", data=self.indices, compression="gzip")
+            f.attrs["source"] = source
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        :return: (BondIndex, source fingerprint)
+        """
+        with h5py.File(fname, mode='r') as f:
+            return cls(f["bonds"][:], f["indptr"][:], f["indices"][:]), str(f.attrs["source"])
+
+def build_bond_index(positions, chunk=10000):
+    """
+    Build the bond table of a whole trajectory, reading it in chunks of frames
+
+    :param positions: (nFrames, LEFNum, 2) array or h5py dataset of extruder positions
+    :param chunk: frames read at a time
+    :return: BondIndex
+    """
+    nFrames, LEFNum = positions.shape[0], positions.shape[1]
+    # Pass 1: unique pairs, encoded as i * 2**32 + j
+    codes = [np.zeros(0, dtype=np.int64)]
+    for st in range(0, nFrames, chunk):
+        block = np.asarray(positions[st:st+chunk], dtype=np.int64).reshape(-1, 2)
+        if len(block) and block.min() < 0:
+            raise ValueError("Negative leg positions in frames {}-{}".format(st, st + chunk))
+        codes.append(np.unique((block[:, 0] << 32) + block[:, 1]))
+    codes = np.unique(np.concatenate(codes)) # Sorted by i, then j
+    # Pass 2: id of the bond of every (frame, extruder)
+    indices = np.zeros(nFrames * LEFNum, dtype=np.int64)
+    for st in range(0, nFrames, chunk):
+        block = np.asarray(positions[st:st+chunk], dtype=np.int64).reshape(-1, 2)
+        indices[st*LEFNum:st*LEFNum+len(block)] = np.searchsorted(codes, (block[:, 0] << 32) + block[:, 1])
+    bonds = np.stack([codes >> 32, codes & 0xFFFFFFFF], axis=1)
+    return BondIndex(bonds, np.arange(nFrames + 1, dtype=np.int64) * LEFNum, indices)
+
+def trajectory_fingerprint(trajectoryFile):
+    """
+    Cache key of a trajectory if it has one (see trajectory_cache.py), otherwise its size and modification time
+    """
+    with h5py.File(trajectoryFile, mode='r') as f:
+        if "key" in f.attrs:
+            return str(f.attrs["key"])
+    st = os.stat(trajectoryFile)
+    return "{}-{}".format(st.st_size, st.st_mtime_ns)
+
+def index_path(trajectoryFile, dataset="positions"):
+    """
+    <trajectory>.bonds, or <trajectory>.<dataset>.bonds for other output streams (not .h5, which the trajectory cache reserves for trajectories)
+    """
+    base = os.path.splitext(trajectoryFile)[0]
+    return base + ".bonds" if dataset == "positions" else "{}.{}.bonds".format(base, dataset)
+
+def bond_index_for(trajectoryFile, dataset="positions"):
+    """
+    Bond table of a trajectory: read from <trajectory>.bonds if it was built from this trajectory, else built and saved there
+
+    :param trajectoryFile: HDF5 file of the 1D trajectory (i.e. LEFPositions.h5 or a cached trajectory)
+    :param dataset: output stream of the trajectory
+    :return: BondIndex
+    """
+    source = trajectory_fingerprint(trajectoryFile)
+    fname = index_path(trajectoryFile, dataset)
+    if os.path.exists(fname):
+        index, built = BondIndex.load(fname)
+        if built == source:
+            return index
+    with h5py.File(trajectoryFile, mode='r') as f:
+        index = build_bond_index(f[dataset])
+    try:
+        index.save(fname, source)
+    except OSError: # Read-only location; use the table for this run only
+        pass
+    return index
+
+def main():
+    if len(sys.argv) != 2:
+        print('Usage: python3 bond_index.py <1D trajectory, i.e. ../1D_trajectory/trajectory/LEFPositions.h5>')
+        os._exit(1)
+    index = bond_index_for(sys.argv[1])
+    print('{} unique bonds over {} frames in {}'.format(len(index.bonds), len(index), index_path(sys.argv[1])))
+
+if __name__ == '__main__':
+    main()
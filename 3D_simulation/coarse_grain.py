@@ -0,0 +1,104 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Coarse-grained preview of the 3D simulation: k monomers per bead
+# Bead b holds monomers b*k .. (b+1)*k-1, so a preview of N monomers has ceil(N/k) beads and its contact map lines up
+# with the full-resolution map binned by k. Extruder legs (and blocking regions) are mapped to the beads holding
+# them; an extruder with both legs in one bead bridges that bead and the next one, as the bond needs two particles.
+# The bead chain is simulated in bead units: bonds, repulsion and the box keep their parameter values, now meaning
+# one bead instead of one monomer, and only the angle stiffness changes, divided by k so the persistence length stays
+# the same in monomers (see coarse_forces). A bead spans about k**NU monomer diameters
+# (ideal chain), the factor applied to the contact radius when analyzing previews (preview.json in the output folder).
+###############
+import os
+import copy
+import json
+import numpy as np
+
+NU = 0.5 # Size exponent of a k-monomer segment, for the length scale of a bead
+PREVIEW_INFO = "preview.json"
+
+def n_beads(N, beads):
+    """
+    Number of beads of a polymer of N monomers, beads monomers per bead
+    """
+    return -(-N // beads)
+
+def coarse_legs(positions, beads, nBeads):
+    """
+    Bead indices of extruder legs
+
+    :param positions: (..., 2) int array of leg positions in monomers
+    :return: (..., 2) int array of distinct bead indices
+    """
+    legs = np.asarray(positions, dtype=np.int64) // beads
+    same = legs[..., 0] == legs[..., 1]
+    left = np.where(same, np.minimum(legs[..., 0], nBeads - 2), legs[..., 0])
+    right = np.where(same, left + 1, legs[..., 1])
+    return np.stack([left, right], axis=-1)
+
+class CoarseFrames(object):
+    def __init__(self, positions, beads, nBeads):
+        """
+        Frames of extruder positions in beads, read from a frames source in monomers, for bondUpdater
+
+        :param positions: (frames, LEFNum, 2) array, h5py dataset or FrameRingReader, in monomers
+        :param beads: monomers per bead
+        :param nBeads: number of beads
+        """
+        self.positions = positions
+        self.beads = beads
+        self.nBeads = nBeads
+        self.shape = positions.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return coarse_legs(self.positions[item], self.beads, self.nBeads)
+
+def coarse_forces(forces, beads):
+    """
+    Polymer force set of the bead chain (see starting_conformations.DEFAULT_FORCES): angle stiffness divided by beads.
+    Every other parameter is left unchanged on purpose, as the bead diameter is the unit length of a preview:
+    bondLength and bondWiggleDistance stay 1 and 0.05 beads, the repulsion keeps radiusMult 1 and trunc 1.5 (beads
+    touch at one bead diameter and can cross at the same energy cost), and the driver's box, computed from the number
+    of beads, keeps the same bead density. A spherical confinement (commented out in the driver) would likewise take
+    its density in beads. Lengths of a preview are converted to monomer diameters afterwards, with length_scale
+    """
+    forces = copy.deepcopy(forces)
+    forces["angle_force_kwargs"]["k"] = forces["angle_force_kwargs"]["k"] / beads
+    return forces
+
+def coarse_regions(regions, beads):
+    """
+    Beads holding the monomers of each region, {name: array of monomers} -> {name: array of beads}
+    """
+    return {name: np.unique(np.asarray(monomers, dtype=np.int64) // beads) for name, monomers in regions.items()}
+
+def length_scale(beads):
+    """
+    Monomer diameters spanned by a bead
+    """
+    return beads ** NU
+
+def write_preview_info(folder, beads, N, regions=None):
+    """
+    Record the coarse-graining of a preview run next to its conformations
+
+    :param N: number of monomers of the full polymer
+    :param regions: dict {name: array of monomers}, stored mapped to beads
+    """
+    info = {"beads": beads, "monomers": int(N), "nBeads": n_beads(int(N), beads), "length_scale": length_scale(beads),
+            "blockingRegions": {name: b.tolist() for name, b in coarse_regions(regions or {}, beads).items()}}
+    with open(os.path.join(folder, PREVIEW_INFO), "w") as f:
+        json.dump(info, f, indent=1)
+
+def read_preview_info(folder):
+    """
+    Coarse-graining of a simulation output (see write_preview_info), or None for full-resolution outputs
+    """
+    fname = os.path.join(folder, PREVIEW_INFO) if isinstance(folder, str) else ""
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
@@ -0,0 +1,453 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Vectorized analysis of the 3D conformation ensemble
+# Computes contact probability vs. genomic separation P(s), radius of gyration and
+# virtual 4C profiles in one streaming pass over the simulation output.
+# Contacts are found with a cell list, and large ensembles are split over a process pool.
+###############
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+from coarse_grain import coarse_regions, read_preview_info
+
+### Viewpoints (monomer indices, front_buffer of 10 included) taken from the blocking regions in the 1D drivers
+VIEWPOINTS = {'MYC': np.arange(737+10, 742+10),
+              'E1': np.arange(210+10, 220+10),
+              'E2': np.arange(304+10, 310+10),
+              'B3': np.arange(553+10, 578+10)}
+
+# Half of the 26 neighbouring cells, plus the cell itself, so every pair of cells is visited once
+_HALF_SHELL = [(0, 0, 0)] + [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                             if (dx, dy, dz) > (0, 0, 0)]
+
+def list_conformations(source):
+    """
+    List references to every conformation in a simulation output, in simulation order
+
+    :param source: folder of polychrom HDF5 blocks (i.e. sim_outs/), folder of text conformations (i.e. confs_txt/) or a list of files
+    :return: list of (filename, block) tuples; block is None for text conformations
+    """
+    if isinstance(source, (list, tuple)):
+        files = list(source)
+    else:
+        files = [os.path.join(source, f) for f in os.listdir(source)]
+    refs = []
+    blockFiles = sorted([f for f in files if re.search(r"blocks_(\d+)-(\d+)\.h5$", f)],
+                        key=lambda f: int(re.search(r"blocks_(\d+)-\d+\.h5$", f).group(1)))
+    for fname in blockFiles:
+        with h5py.File(fname, mode='r') as f:
+            refs += [(fname, b) for b in sorted(f.keys(), key=int)]
+    textFiles = [f for f in files if f.endswith('.txt')]
+    textFiles.sort(key=lambda f: [int(x) for x in re.findall(r"\d+", os.path.basename(f))] or [0])
+    refs += [(fname, None) for fname in textFiles]
+    return refs
+
+def burn_in_conformations(source):
+    """
+    Conformations saved before the radius of gyration reached steady state, from the convergence.json the 3D driver
+    writes next to its output (0 if there is none, or steady state was not reached)
+
+    :param source: folder of the simulation output (i.e. sim_outs/)
+    """
+    fname = os.path.join(source, "convergence.json") if isinstance(source, str) else ""
+    if not os.path.isfile(fname):
+        return 0
+    with open(fname) as f:
+        return max(int(json.load(f).get("burn_in_conformations", -1)), 0)
+
+def preview_scale(source):
+    """
+    Coarse-graining of a simulation output, from the preview.json the 3D driver writes in preview mode (see coarse_grain.py)
+
+    :param source: folder of the simulation output (i.e. sim_outs_preview/)
+    :return: (monomers per bead, monomer diameters per bead length); (1, 1.0) at full resolution
+    """
+    info = read_preview_info(source)
+    if info is None:
+        return 1, 1.0
+    return int(info["beads"]), float(info["length_scale"])
+
+def load_conformation(ref):
+    """
+    Load the (N,3) positions of one conformation from a reference returned by list_conformations
+    """
+    fname, block = ref
+    if block is None:
+        return np.loadtxt(fname, skiprows=1) # polychrom text format: first line is N, then "x y z" lines
+    with h5py.File(fname, mode='r') as f:
+        return f[block]['pos'][:]
+
+def iter_conformations(refs):
+    """
+    Stream conformations, opening every HDF5 block file only once
+    """
+    openFile, handle = None, None
+    try:
+        for fname, block in refs:
+            if block is None:
+                yield load_conformation((fname, block))
+                continue
+            if fname != openFile:
+                if handle is not None:
+                    handle.close()
+                handle, openFile = h5py.File(fname, mode='r'), fname
+            yield handle[block]['pos'][:]
+    finally:
+        if handle is not None:
+            handle.close()
+
+def contact_pairs(pos, cutoff=10):
+    """
+    Find all pairs of monomers closer than cutoff using a cell list
+
+    :param pos: (N,3) array of monomer positions
+    :param cutoff: contact radius, in the same units as pos
+    :return: (i, j) arrays of contacting monomers, i < j
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    n = len(pos)
+    cells = np.floor((pos - pos.min(axis=0)) / cutoff).astype(np.int64) + 1 # +1 so neighbour offsets stay non-negative
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    allI, allJ = [], []
+    for dx, dy, dz in _HALF_SHELL:
+        neighbourKeys = keys + (dx * dims[1] + dy) * dims[2] + dz
+        start = np.searchsorted(sortedKeys, neighbourKeys, side='left')
+        counts = np.searchsorted(sortedKeys, neighbourKeys, side='right') - start
+        total = counts.sum()
+        if total == 0:
+            continue
+        i = np.repeat(np.arange(n), counts)
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) # index inside the neighbour cell
+        j = order[np.repeat(start, counts) + within]
+        keep = np.sum((pos[i] - pos[j]) ** 2, axis=1) < cutoff ** 2
+        if (dx, dy, dz) == (0, 0, 0):
+            keep &= i < j
+        allI.append(i[keep])
+        allJ.append(j[keep])
+    if not allI:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    i, j = np.concatenate(allI), np.concatenate(allJ)
+    return np.minimum(i, j), np.maximum(i, j)
+
+def radius_of_gyration(pos):
+    """
+    Radius of gyration of one conformation
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    return np.sqrt(np.mean(np.sum((pos - pos.mean(axis=0)) ** 2, axis=1)))
+
+class EnsembleAccumulator(object):
+
+    def __init__(self, N, viewpoints=None, cutoff=10, keepMatrix=False):
+        """
+        Running sums of P(s), radius of gyration and virtual 4C over a set of conformations.
+        Accumulators from different chunks of the ensemble can be combined with merge()
+
+        :param N: number of monomers
+        :param viewpoints: dict of {name: array of monomers} used for virtual 4C; defaults to VIEWPOINTS
+        :param cutoff: contact radius
+        :param keepMatrix: also accumulate the full (N,N) contact matrix
+        """
+        self.N = N
+        self.cutoff = cutoff
+        self.viewpoints = VIEWPOINTS if viewpoints is None else viewpoints
+        self.count = 0
+        self.contactsAtSeparation = np.zeros(N, dtype=np.int64)
+        self.rg = []
+        self.fourC = {name: np.zeros(N, dtype=np.int64) for name in self.viewpoints}
+        self._viewpointMasks = {}
+        for name, monomers in self.viewpoints.items():
+            mask = np.zeros(N, dtype=bool)
+            mask[np.asarray(monomers)] = True
+            self._viewpointMasks[name] = mask
+        self.matrix = np.zeros((N, N), dtype=np.int64) if keepMatrix else None
+
+    def add(self, pos):
+        """
+        Add one conformation to the running sums
+        """
+        if len(pos) != self.N:
+            raise ValueError("Conformation has {0} monomers, expected {1}".format(len(pos), self.N))
+        i, j = contact_pairs(pos, self.cutoff)
+        self.add_pairs(i, j)
+        self.rg.append(radius_of_gyration(pos))
+        self.count += 1
+
+    def add_pairs(self, i, j):
+        """
+        Add the contacts of one conformation, when they were already computed elsewhere
+        """
+        self.contactsAtSeparation += np.bincount(j - i, minlength=self.N)
+        for name, mask in self._viewpointMasks.items():
+            self.fourC[name] += np.bincount(j[mask[i]], minlength=self.N) + np.bincount(i[mask[j]], minlength=self.N)
+        if self.matrix is not None:
+            np.add.at(self.matrix, (i, j), 1)
+            np.add.at(self.matrix, (j, i), 1)
+
+    def merge(self, other):
+        self.count += other.count
+        self.contactsAtSeparation += other.contactsAtSeparation
+        self.rg += other.rg
+        for name in self.fourC:
+            self.fourC[name] += other.fourC[name]
+        if self.matrix is not None:
+            self.matrix += other.matrix
+        return self
+
+    def contact_probability(self):
+        """
+        :return: (s, P(s)) - mean contact probability of monomer pairs at each genomic separation s
+        """
+        s = np.arange(1, self.N)
+        pairs = (self.N - s) * max(self.count, 1)
+        return s, self.contactsAtSeparation[1:] / pairs
+
+    def virtual_4C(self):
+        """
+        :return: dict of {viewpoint name: contact probability of each monomer with the viewpoint}
+        """
+        return {name: profile / max(self.count, 1) for name, profile in self.fourC.items()}
+
+def _analyze_chunk(args):
+    refs, N, viewpoints, cutoff, keepMatrix = args
+    acc = EnsembleAccumulator(N, viewpoints=viewpoints, cutoff=cutoff, keepMatrix=keepMatrix)
+    for pos in iter_conformations(refs):
+        acc.add(pos)
+    return acc
+
+def analyze_ensemble(refs, viewpoints=None, cutoff=10, processes=1, chunkSize=50, keepMatrix=False):
+    """
+    Stream every conformation through an EnsembleAccumulator
+
+    :param refs: conformation references from list_conformations
+    :param processes: number of worker processes; chunks of chunkSize conformations are handed out to each
+    :param chunkSize: number of conformations loaded by a worker at a time
+    :return: merged EnsembleAccumulator
+    """
+    if len(refs) == 0:
+        raise ValueError("No conformations to analyze")
+    N = len(load_conformation(refs[0]))
+    chunks = [(refs[k:k+chunkSize], N, viewpoints, cutoff, keepMatrix) for k in range(0, len(refs), chunkSize)]
+    total = EnsembleAccumulator(N, viewpoints=viewpoints, cutoff=cutoff, keepMatrix=keepMatrix)
+    if processes == 1:
+        for chunk in chunks:
+            total.merge(_analyze_chunk(chunk))
+        return total
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for acc in pool.map(_analyze_chunk, chunks):
+            total.merge(acc)
+    return total
+
+class ContactMapStack(object):
+
+    def __init__(self, N, labels, binSize=1, cutoff=10):
+        """
+        Sparse contact counts of many accumulators (i.e. the whole ensemble, each time window, each replica),
+        filled from one neighbour search per conformation
+
+        :param N: number of monomers
+        :param labels: list of accumulator names
+        :param binSize: monomers per bin
+        :param cutoff: contact radius the contacts were found with (stored with the stack)
+        """
+        self.N = N
+        self.labels = list(labels)
+        self.binSize = binSize
+        self.cutoff = cutoff
+        self.nBins = -(-N // binSize)
+        self.conformations = np.zeros(len(self.labels), dtype=np.int64) # Conformations added to each accumulator
+        self.codes = np.zeros(0, dtype=np.int64) # Sorted (accumulator, bin i, bin j) codes with a contact, bin i <= bin j
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._pendingSize = 0
+
+    def add_pairs(self, i, j, accumulators):
+        """
+        Add the contacts of one conformation (i < j, see contact_pairs) to each of the accumulators
+
+        :param accumulators: indices of the accumulators (in labels) the conformation belongs to
+        """
+        accumulators = np.asarray(accumulators, dtype=np.int64)
+        bins = (i // self.binSize) * self.nBins + j // self.binSize
+        codes = (accumulators[:, None] * self.nBins ** 2 + bins[None, :]).ravel()
+        self._pending.append(codes)
+        self._pendingSize += len(codes)
+        self.conformations[accumulators] += 1
+        if self._pendingSize > 2 ** 22:
+            self._reduce()
+
+    def _fold(self, codes, weights):
+        """
+        Add weighted codes to the sorted (code, count) arrays
+        """
+        self.codes, inverse = np.unique(np.concatenate([self.codes, codes]), return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=np.concatenate([self.counts, weights]),
+                                  minlength=len(self.codes)).astype(np.int64)
+
+    def _reduce(self):
+        """
+        Fold the pending contacts into the sorted (code, count) arrays
+        """
+        if self._pending:
+            self._fold(np.concatenate(self._pending), np.ones(self._pendingSize, dtype=np.int64))
+            self._pending, self._pendingSize = [], 0
+
+    def merge(self, other):
+        """
+        Add the counts of a stack with the same labels (i.e. from another chunk of conformations)
+        """
+        self._reduce()
+        other._reduce()
+        self._fold(other.codes, other.counts)
+        self.conformations += other.conformations
+        return self
+
+    def sparse(self, label):
+        """
+        :return: (bin i, bin j, count) arrays of one accumulator, bin i <= bin j
+        """
+        self._reduce()
+        a = self.labels.index(label)
+        lo, hi = np.searchsorted(self.codes, [a * self.nBins ** 2, (a + 1) * self.nBins ** 2])
+        pair = self.codes[lo:hi] - a * self.nBins ** 2
+        return pair // self.nBins, pair % self.nBins, self.counts[lo:hi]
+
+    def matrix(self, label, normalize=False):
+        """
+        Dense symmetric (nBins, nBins) contact map of one accumulator
+
+        :param normalize: divide by the number of conformations of the accumulator (contact probability)
+        """
+        i, j, count = self.sparse(label)
+        out = np.zeros((self.nBins, self.nBins))
+        np.add.at(out, (i, j), count)
+        out = out + out.T
+        if normalize:
+            out /= max(self.conformations[self.labels.index(label)], 1)
+        return out
+
+    def save(self, fname):
+        """
+        Write the stack to HDF5: labels, conformations per label, and the contacts of all labels as one COO table
+        (i, j, count) sorted by label, the rows of label k being indptr[k]:indptr[k+1]
+        """
+        self._reduce()
+        nB2 = self.nBins ** 2
+        with h5py.File(fname, mode='w') as f:
+            f.create_dataset("labels", data=np.array(self.labels, dtype=h5py.string_dtype()))
+            f.create_dataset("conformations", data=self.conformations)
+            f.create_dataset("indptr", data=np.searchsorted(self.codes, np.arange(len(self.labels) + 1) * nB2))
+            f.create_dataset("i", data=(self.codes % nB2) // self.nBins, compression="gzip")
+            f.create_dataset("j", data=self.codes % self.nBins, compression="gzip")
+            f.create_dataset("count", data=self.counts, compression="gzip")
+            f.attrs["N"] = self.N
+            f.attrs["binSize"] = self.binSize
+            f.attrs["cutoff"] = self.cutoff
+
+    @classmethod
+    def load(cls, fname):
+        with h5py.File(fname, mode='r') as f:
+            labels = [l.decode() if isinstance(l, bytes) else l for l in f["labels"][:]]
+            stack = cls(int(f.attrs["N"]), labels, binSize=int(f.attrs["binSize"]), cutoff=float(f.attrs["cutoff"]))
+            stack.conformations = f["conformations"][:]
+            indptr = f["indptr"][:]
+            label = np.repeat(np.arange(len(labels)), np.diff(indptr))
+            stack.codes = label * stack.nBins ** 2 + f["i"][:] * stack.nBins + f["j"][:]
+            stack.counts = f["count"][:]
+        return stack
+
+def _contact_chunk(args):
+    items, N, labels, cutoff, binSize, radius = args
+    stack = ContactMapStack(N, labels, binSize=binSize, cutoff=cutoff)
+    for (ref, accumulators), pos in zip(items, iter_conformations([ref for ref, accumulators in items])):
+        i, j = contact_pairs(pos, radius)
+        stack.add_pairs(i, j, accumulators)
+    stack._reduce()
+    return stack
+
+def contact_map_stack(sources, window=None, cutoff=10, binSize=1, processes=1, chunkSize=50, skipBurnIn=False):
+    """
+    Contact maps of the whole ensemble ("all"), of each replica ("replica:<folder>", with several sources) and of
+    each time window ("window:<k>", conformations k*window .. (k+1)*window-1 of every replica), in one pass
+
+    :param sources: list of simulation outputs (sim_outs/ or confs_txt/ folders), one per replica
+    :param window: conformations per time window (None for no time windows)
+    :param skipBurnIn: leave out the burn-in conformations of each replica (see burn_in_conformations)
+    :return: ContactMapStack
+    Previews (see preview_scale) are binned in monomers, so binSize must be a multiple of their beads, and their contact
+    radius is divided by the bead length; their maps then line up with full-resolution maps of the same binSize
+    """
+    scales = set(preview_scale(src) for src in sources)
+    if len(scales) > 1:
+        raise ValueError("Sources mix resolutions (monomers per bead): {}".format(sorted(b for b, l in scales)))
+    beads, lengthScale = scales.pop()
+    if binSize % beads != 0:
+        raise ValueError("binSize ({}) must be a multiple of the monomers per bead of the preview ({})".format(binSize, beads))
+    replicas = [list_conformations(src)[burn_in_conformations(src) if skipBurnIn else 0:] for src in sources]
+    if not any(replicas):
+        raise ValueError("No conformations to analyze")
+    labels = ["all"]
+    if len(sources) > 1:
+        labels += ["replica:{}".format(os.path.normpath(src) if isinstance(src, str) else r) for r, src in enumerate(sources)]
+    nWindows = -(-max(len(refs) for refs in replicas) // window) if window else 0
+    labels += ["window:{}".format(k) for k in range(nWindows)]
+    items = []
+    for r, refs in enumerate(replicas):
+        for k, ref in enumerate(refs):
+            accumulators = [0]
+            if len(sources) > 1:
+                accumulators.append(1 + r)
+            if window:
+                accumulators.append(len(labels) - nWindows + k // window)
+            items.append((ref, accumulators))
+    N = len(load_conformation(items[0][0]))
+    chunks = [(items[k:k+chunkSize], N, labels, cutoff, binSize // beads, cutoff / lengthScale) for k in range(0, len(items), chunkSize)]
+    total = ContactMapStack(N, labels, binSize=binSize // beads, cutoff=cutoff)
+    if processes == 1:
+        for chunk in chunks:
+            total.merge(_contact_chunk(chunk))
+        return total
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for stack in pool.map(_contact_chunk, chunks):
+            total.merge(stack)
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description='P(s), radius of gyration and virtual 4C from 3D simulation outputs')
+    parser.add_argument('source', help='sim_outs/ (polychrom HDF5 blocks) or confs_txt/ directory')
+    parser.add_argument('--cutoff', type=float, default=10, help='contact radius (default: 10, as in make_contactMap.py)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--chunk', type=int, default=50, help='conformations per worker chunk')
+    parser.add_argument('--out', default='analysis', help='prefix of the output files')
+    parser.add_argument('--skip-burn-in', action='store_true', help='leave out the conformations before steady state (see convergence.json)')
+    args = parser.parse_args()
+
+    refs = list_conformations(args.source)
+    if args.skip_burn_in:
+        skip = burn_in_conformations(args.source)
+        print('Skipping {} burn-in conformations'.format(skip))
+        refs = refs[skip:]
+    beads, lengthScale = preview_scale(args.source)
+    if beads > 1: # Preview: same contact radius and Rg in monomer diameters, viewpoints mapped to beads, P(s) in monomers
+        print('Preview of {} monomers per bead'.format(beads))
+    print('Analyzing {} conformations from {}'.format(len(refs), args.source))
+    acc = analyze_ensemble(refs, viewpoints=coarse_regions(VIEWPOINTS, beads), cutoff=args.cutoff / lengthScale,
+                           processes=args.processes, chunkSize=args.chunk)
+    s, ps = acc.contact_probability()
+    s = s * beads # Separation in monomers
+    np.savetxt('{}_Ps.txt'.format(args.out), np.column_stack([s, ps]), delimiter='\t', header='s\tP(s)', comments='')
+    np.savetxt('{}_Rg.txt'.format(args.out), np.array(acc.rg) * lengthScale, delimiter='\t')
+    for name, profile in acc.virtual_4C().items():
+        np.savetxt('{}_4C_{}.txt'.format(args.out, name), profile, delimiter='\t')
+    print('Mean radius of gyration: {:.3f}'.format(np.mean(acc.rg) * lengthScale))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+###############
+# Lightweight position sampling for the 3D simulation
+# FastReporter is a drop-in replacement for polychrom's HDF5Reporter (blocks_only=True) that also samples
+# positions straight from the OpenMM context into a preallocated float32 buffer, without do_block's energy
+# evaluation and checks. Its files use polychrom's layout (blocks_<first>-<last>.h5, one group per
+# conformation holding "pos"), so polychrom.hdf5_format, trajectory_to_txt.py and conformation_analysis.py read them.
+###############
+import os
+import glob
+import numpy as np
+import h5py
+
+class FastReporter(object):
+    def __init__(self, folder, max_data_length=100, overwrite=False, blocks_only=True, compression=None):
+        """
+        :param folder: output folder
+        :param max_data_length: conformations per output file (size of the preallocated buffer)
+        :param overwrite: remove existing blocks files from the folder
+        :param blocks_only: ignore everything but conformations (initArgs, applied_forces, ... reports)
+        :param compression: h5py compression of the positions (None is fastest)
+        """
+        self.folder = folder
+        self.max_data_length = max_data_length
+        self.blocks_only = blocks_only
+        self.compression = compression
+        self.counter = 0 # Number of the next conformation
+        self.buffer = None # (max_data_length, N, 3) float32, allocated at the first conformation
+        self.last = None # Positions of the latest conformation (a view of the buffer)
+        self.attrs = []
+        os.makedirs(folder, exist_ok=True)
+        existing = glob.glob(os.path.join(folder, "blocks_*.h5"))
+        if existing and not overwrite:
+            raise ValueError("Folder {} already has blocks files; use overwrite=True".format(folder))
+        for f in existing:
+            os.unlink(f)
+
+    def _slot(self, N):
+        if self.buffer is None:
+            self.buffer = np.zeros((self.max_data_length, N, 3), dtype=np.float32)
+        self.last = self.buffer[len(self.attrs)]
+        return self.last
+
+    def _add(self, attrs):
+        self.attrs.append(attrs)
+        self.counter += 1
+        if len(self.attrs) == self.max_data_length:
+            self.dump_data()
+
+    def report(self, name, values):
+        """
+        polychrom reporter interface; conformations reported by do_block(save=True) are stored as well
+        """
+        if name != "data":
+            return
+        self._slot(len(values["pos"]))[:] = values["pos"]
+        self._add({k: v for k, v in values.items() if np.isscalar(v)})
+
+    def sample(self, sim):
+        """
+        Store the current positions of a Simulation without running do_block
+
+        :param sim: polychrom Simulation
+        """
+        from openmm import unit
+        state = sim.context.getState(getPositions=True)
+        pos = state.getPositions(asNumpy=True) / sim.conlen # In units of the bond length, as do_block
+        np.copyto(self._slot(sim.N), pos, casting='same_kind')
+        self._add({"block": sim.block, "time": state.getTime().value_in_unit(unit.picosecond)})
+
+    def dump_data(self):
+        """
+        Write the buffered conformations to blocks_<first>-<last>.h5
+        """
+        if not self.attrs:
+            return
+        first = self.counter - len(self.attrs)
+        fname = os.path.join(self.folder, "blocks_{}-{}.h5".format(first, self.counter - 1))
+        with h5py.File(fname, mode='w') as f:
+            for k, attrs in enumerate(self.attrs):
+                g = f.create_group(str(first + k))
+                g.create_dataset("pos", data=self.buffer[k], compression=self.compression)
+                for key, value in attrs.items():
+                    g.attrs[key] = value
+        self.attrs = []
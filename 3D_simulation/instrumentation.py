@@ -0,0 +1,115 @@
+#### Low-overhead timers and counters for the phases of the 3D simulation loop
+import sys
+import json
+import time
+import cProfile
+import pstats
+import socket
+
+class _Phase(object):
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class PhaseTimer(object):
+
+    def __init__(self, logfile=None, profile=False, profileOut="profile_segment{0}.prof"):
+        """
+        Collects wall time per phase and counters for each simulation segment (one segment = one Simulation object),
+        and writes one JSON summary line per segment
+
+        :param logfile: file to append JSON summaries to; None prints them to stdout
+        :param profile: also run cProfile over each segment
+        :param profileOut: file name pattern for the cProfile stats of each segment
+        """
+        self.logfile = logfile
+        self.profile = profile
+        self.profileOut = profileOut
+        self.segment = -1
+        self.totals = {}
+        self.calls = {}
+        self.counters = {}
+        self._profiler = None
+        self._segmentStart = None
+
+    def phase(self, name):
+        """
+        Context manager timing one phase, i.e.
+            with timer.phase("md_step"):
+                a.integrator.step(steps)
+        """
+        return _Phase(self, name)
+
+    def add_time(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def start_segment(self, segment):
+        """
+        Reset timers and counters at the start of a segment
+        """
+        self.segment = segment
+        self.totals, self.calls, self.counters = {}, {}, {}
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._segmentStart = time.perf_counter()
+
+    def end_segment(self, **extra):
+        """
+        Emit the JSON summary of the segment; extra keyword arguments are added to it
+
+        :return: the summary dict
+        """
+        wall = time.perf_counter() - self._segmentStart
+        if self._profiler is not None:
+            self._profiler.disable()
+            fname = self.profileOut.format(self.segment)
+            pstats.Stats(self._profiler).dump_stats(fname)
+            extra["profile"] = fname
+            self._profiler = None
+        summary = {"segment": self.segment, "host": socket.gethostname(), "wall_seconds": wall,
+                   "phases": {name: {"seconds": t, "calls": self.calls[name]} for name, t in self.totals.items()},
+                   "untimed_seconds": wall - sum(self.totals.values()),
+                   "counters": dict(self.counters)}
+        mdSteps = self.counters.get("md_steps", 0)
+        mdTime = self.totals.get("md_step", 0.0) + self.totals.get("do_block", 0.0)
+        if mdSteps and mdTime > 0:
+            summary["md_steps_per_second"] = mdSteps / mdTime
+        blocks = self.counters.get("blocks", 0)
+        if blocks:
+            summary["bonds_changed_per_block"] = self.counters.get("bonds_changed", 0) / blocks
+        summary.update(extra)
+        line = json.dumps(summary)
+        if self.logfile is None:
+            print(line)
+            sys.stdout.flush()
+        else:
+            with open(self.logfile, "a") as f:
+                f.write(line + "\n")
+        return summary
+
+def openmm_timing(context):
+    """
+    Simulated time (ps) and platform of an OpenMM context, for reporting ns/day across nodes
+    """
+    state = context.getState()
+    platform = context.getPlatform()
+    try:
+        from openmm import unit
+    except ImportError:
+        from simtk import unit
+    return {"sim_time_ps": state.getTime().value_in_unit(unit.picosecond), "platform": platform.getName()}
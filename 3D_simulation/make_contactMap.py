@@ -3,18 +3,50 @@
 # Script using polychrom's contact map generation implementation
 # Noah Burgt
 # 3/26/24
+# With several directories (replicas), --window or --out, the maps of the whole ensemble, of each replica and of
+# each time window are built in one pass instead (conformation_analysis.contact_map_stack), one neighbour search per
+# conformation, and written as one stacked sparse HDF5 file
+# Previews of the 3D driver (sim_outs_preview/, see coarse_grain.py) are always stacked, binned in monomers (by default
+# one bin per bead): their maps compare to full-resolution maps made with the same --bin
 #########################
 import sys
 import os
-import numpy as np
-from polychrom import contactmaps as cm
-if len(sys.argv) != 2:
-    print('Usage: python3 make_contactMaps <dir of confs>')
-    os._exit(1)
+import argparse
 
-filenames = os.listdir(sys.argv[1])
-for i,x in enumerate(filenames):
-    filenames[i] = "{}/{}".format(sys.argv[1],x)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description='Contact map of 3D conformations',
+                                     usage='python3 make_contactMaps <dir of confs> [<dir of confs> ...] [--window K] [--out stack.h5]')
+    parser.add_argument('dirs', nargs='+', help='directories of conformations (confs_txt/ or sim_outs/), one per replica')
+    parser.add_argument('--window', type=int, default=None, help='also a map per time window of this many conformations')
+    parser.add_argument('--out', default=None, help='stacked sparse output (default: contacts_stack.h5 when stacking)')
+    parser.add_argument('--bin', type=int, default=None, help='monomers per bin of the stacked maps (default: 1, or the monomers per bead of a preview)')
+    parser.add_argument('--cutoff', type=float, default=10, help='contact radius')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes of the stacked maps')
+    parser.add_argument('--skip-burn-in', action='store_true', help='leave out the burn-in conformations of each replica (see convergence.json)')
+    args = parser.parse_args(argv)
+    import numpy as np
 
-out = cm.monomerResolutionContactMap(filenames, cutoff=10)
-np.savetxt('matrix.txt', out, delimiter='\t')
+    from coarse_grain import read_preview_info
+    preview = [info["beads"] for info in map(read_preview_info, args.dirs) if info] # Previews are binned in monomers, see contact_map_stack
+    binSize = args.bin or (preview[0] if preview else 1)
+    if len(args.dirs) > 1 or args.window or args.out or args.skip_burn_in or binSize != 1 or preview:
+        from conformation_analysis import contact_map_stack
+        stack = contact_map_stack(args.dirs, window=args.window, cutoff=args.cutoff, binSize=binSize,
+                                  processes=args.processes, skipBurnIn=args.skip_burn_in)
+        out = args.out or 'contacts_stack.h5'
+        stack.save(out)
+        np.savetxt('matrix.txt', stack.matrix('all'), delimiter='\t')
+        print('{} contact maps ({}) written to {}'.format(len(stack.labels), ", ".join(stack.labels), out))
+        return
+    from polychrom import contactmaps as cm # Imported after the argument check, it is slow to load
+
+    filenames = os.listdir(args.dirs[0])
+    for i,x in enumerate(filenames):
+        filenames[i] = "{}/{}".format(args.dirs[0],x)
+
+    out = cm.monomerResolutionContactMap(filenames, cutoff=args.cutoff)
+    np.savetxt('matrix.txt', out, delimiter='\t')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Starting conformations for the 3D simulation
+# A vectorized random-walk generator for large polymers, and an on-disk library of pre-equilibrated
+# conformations for a given N, box and force set: the library is generated once (in parallel) and every
+# replica of an ensemble starts from one of its conformations instead of growing and minimizing its own.
+###############
+import os
+import sys
+import fcntl
+import shutil
+import argparse
+import numpy as np
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "1D_trajectory"))
+from trajectory_cache import params_key
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LIBRARY_DIR = os.path.join(HERE, "conformations")
+
+### Polymer force set of the 3D driver (forcekits.polymer_chains arguments)
+DEFAULT_FORCES = {
+    "bond_force_kwargs": {'bondLength': 1.0, 'bondWiggleDistance': 0.05}, # Parameters for harmonic bonds
+    "angle_force_kwargs": {'k': 1.5}, # Angle force parameters. k = stiffness bond (8=very stiff, k=1.5 is "realistically flexible")
+    "nonbonded_force_kwargs": {'trunc': 1.5, # Allows chains to cross, the energy value at dist=0
+                               'radiusMult': 1},
+    "except_bonds": True # Nonbonded forces do not affect bonded pieces
+}
+
+def default_box(N):
+    """
+    Dimensions of the bounding box with Periodic Boundary Conditions (PBC), as in the 3D driver
+    """
+    return (N / 0.1) ** 0.35
+
+def random_walk(N, box=None, seed=None):
+    """
+    Freely jointed chain of N monomers with unit bonds, made in one vectorized pass
+    (overlaps are allowed; the repulsive force and energy minimization sort them out)
+
+    :param N: number of monomers
+    :param box: if given, the chain is centered in a cube of this size
+    :param seed: random seed
+    :return: (N, 3) array of positions
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=(N, 3))
+    steps /= np.linalg.norm(steps, axis=1)[:, None]
+    steps[0] = 0
+    data = np.cumsum(steps, axis=0)
+    data -= data.mean(axis=0)
+    if box is not None:
+        data += box / 2
+    return data
+
+def grow(N, box, generator="grow_cubic", seed=None):
+    """
+    Initial conformation from grow_cubic (compact, no overlaps) or random_walk (fast for large N)
+    """
+    if generator == "random_walk":
+        return random_walk(N, box, seed)
+    if generator != "grow_cubic":
+        raise ValueError("Unknown generator {}".format(generator))
+    from polychrom.starting_conformations import grow_cubic
+    if seed is not None:
+        np.random.seed(seed)
+    return grow_cubic(N, int(box))
+
+def add_polymer_forces(sim, forces=DEFAULT_FORCES):
+    """
+    Add the polymer forcekit (harmonic bonds, angle force, Grosberg repulsion) to a Simulation
+
+    :param sim: polychrom Simulation
+    :param forces: dict of forcekits.polymer_chains arguments (see DEFAULT_FORCES)
+    """
+    import polychrom.forcekits as forcekits
+    import polychrom.forces as polyforces
+    sim.add_force(
+        forcekits.polymer_chains(
+            sim, # Simulation object
+            chains=[(0, None, 0)], # One chain of length N that is not a ring
+            bond_force_func=polyforces.harmonic_bonds,
+            bond_force_kwargs=forces["bond_force_kwargs"],
+            angle_force_func=polyforces.angle_force,
+            angle_force_kwargs=forces["angle_force_kwargs"],
+            nonbonded_force_func=polyforces.grosberg_repulsive_force,
+            nonbonded_force_kwargs=forces["nonbonded_force_kwargs"],
+            except_bonds=forces["except_bonds"]
+        )
+    )
+
+def equilibrate(N, box, forces=DEFAULT_FORCES, generator="grow_cubic", blocks=10, steps=500, seed=None, platform="CPU"):
+    """
+    Grow a conformation, minimize its energy and run a short MD relaxation under the given force set
+
+    :param blocks: relaxation blocks of `steps` MD steps after energy minimization
+    :param platform: OpenMM platform (one process per conformation, so CPU by default)
+    :return: (N, 3) array of positions
+    """
+    from polychrom.simulation import Simulation
+    sim = Simulation(platform=platform, integrator="variableLangevin", error_tol=0.01, collision_rate=0.03,
+                     N=N, reporters=[], PBCbox=[box, box, box])
+    sim.set_data(grow(N, box, generator, seed))
+    add_polymer_forces(sim, forces)
+    sim.local_energy_minimization()
+    for b in range(blocks):
+        sim.integrator.step(steps)
+    return sim.get_data()
+
+def _equilibrate(args):
+    return equilibrate(*args)
+
+def _count(path):
+    """
+    Number of conformations in a library file
+    """
+    with h5py.File(path, mode='r') as f:
+        return f["conformations"].shape[0] if "conformations" in f else 0
+
+class ConformationLibrary():
+    def __init__(self, N, box=None, forces=DEFAULT_FORCES, generator="grow_cubic", blocks=10, steps=500, root=DEFAULT_LIBRARY_DIR):
+        """
+        Cached pre-equilibrated conformations for one N, box, force set and equilibration protocol,
+        stored in <root>/<key>.h5 where the key is a hash of all of them
+
+        :param N: number of monomers
+        :param box: PBC box size (default: as in the 3D driver)
+        :param forces: force set (see DEFAULT_FORCES)
+        :param generator: grow_cubic or random_walk
+        :param blocks, steps: MD relaxation after energy minimization
+        """
+        self.N = N
+        self.box = default_box(N) if box is None else box
+        self.forces = forces
+        self.generator = generator
+        self.blocks = blocks
+        self.steps = steps
+        self.key = params_key({"N": N, "box": self.box, "forces": forces, "generator": generator,
+                               "blocks": blocks, "steps": steps}, version=None)
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, "{}.h5".format(self.key))
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return _count(self.path)
+
+    def generate(self, count, processes=None, platform="CPU"):
+        """
+        Make sure the library holds at least count conformations, generating the missing ones in parallel.
+        Conformation i is always generated with seed i, so the library does not depend on the number of processes.
+        One process at a time generates (under a lock on <key>.h5.lock), into <key>.h5.partial, which then
+        atomically replaces the library, so concurrent replicas wait for it and readers never see a partial file
+        """
+        if len(self) >= count:
+            return
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if len(self) < count: # Unless another replica generated them while this one waited
+                    self._generate(count, processes, platform)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _generate(self, count, processes, platform):
+        partial = self.path + ".partial" # Kept by an interrupted run: its conformations are reused
+        try:
+            have = _count(partial) if os.path.exists(partial) else 0
+        except OSError: # Interrupted while writing
+            have = 0
+        if have < len(self):
+            shutil.copyfile(self.path, partial)
+            have = len(self)
+        elif have == 0 and os.path.exists(partial):
+            os.remove(partial)
+        jobs = [(self.N, self.box, self.forces, self.generator, self.blocks, self.steps, seed, platform)
+                for seed in range(have, count)]
+        with h5py.File(partial, mode='a') as f:
+            if "conformations" not in f:
+                f.create_dataset("conformations", shape=(0, self.N, 3), maxshape=(None, self.N, 3),
+                                 chunks=(1, self.N, 3), dtype=np.float32)
+                f.attrs["key"] = self.key
+                f.attrs["N"] = self.N
+                f.attrs["box"] = self.box
+            dset = f["conformations"]
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                for data in pool.map(_equilibrate, jobs):
+                    dset.resize(dset.shape[0] + 1, axis=0)
+                    dset[-1] = data
+                    f.flush() # Finished conformations survive an interrupted run
+        os.replace(partial, self.path)
+
+    def sample(self, replica):
+        """
+        Starting conformation of a replica (replicas beyond the library size reuse conformations in turn)
+        """
+        with h5py.File(self.path, mode='r') as f:
+            dset = f["conformations"]
+            return dset[replica % dset.shape[0]].astype(np.float64)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a library of pre-equilibrated starting conformations')
+    parser.add_argument('N', type=int, help='number of monomers')
+    parser.add_argument('--count', type=int, default=16, help='conformations in the library')
+    parser.add_argument('--box', type=float, default=None, help='PBC box size (default: as in the 3D driver)')
+    parser.add_argument('--generator', choices=['grow_cubic', 'random_walk'], default='grow_cubic')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--platform', default='CPU', help='OpenMM platform of the workers')
+    args = parser.parse_args()
+
+    lib = ConformationLibrary(args.N, box=args.box, generator=args.generator)
+    lib.generate(args.count, processes=args.processes, platform=args.platform)
+    print('{} conformations in {}'.format(len(lib), lib.path))
+
+if __name__ == '__main__':
+    sys.exit(main())
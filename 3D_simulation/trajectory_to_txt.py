@@ -6,22 +6,28 @@
 ###############
 import os
 import sys
-import polychrom.polymerutils as polu
 from pathlib import Path
-if len(sys.argv) != 3:
-    print('Usage: python3 trajectory_to_txt.py <total number of confs> <path to h5>')
-    os._exit(1)
 
-d = "confs_txt"
-p = Path(d)
-if not p.exists():
-    p.mkdir()
-else:
-    print('Delete ./confs_txt and re-run.')
-    os._exit(1)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print('Usage: python3 trajectory_to_txt.py <total number of confs> <path to h5>')
+        os._exit(1)
 
-n=int(sys.argv[1])
-for i in range(n):
-    t = polu.fetch_block(sys.argv[2], i)
-    # Write as text file
-    polu.save(t, filename="{}/conf{}.txt".format(d, i), mode="txt")
+    d = "confs_txt"
+    p = Path(d)
+    if not p.exists():
+        p.mkdir()
+    else:
+        print('Delete ./confs_txt and re-run.')
+        os._exit(1)
+    import polychrom.polymerutils as polu # Imported after the argument checks, it is slow to load
+
+    n=int(argv[0])
+    for i in range(n):
+        t = polu.fetch_block(argv[1], i)
+        # Write as text file
+        polu.save(t, filename="{}/conf{}.txt".format(d, i), mode="txt")
+
+if __name__ == '__main__':
+    main()
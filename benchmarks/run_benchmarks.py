@@ -0,0 +1,313 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Benchmark suite for the loop extrusion pipeline
+# Times 1D stepping, bondUpdater setup/step, HDF5 trajectory writes/reads and contact map accumulation
+# over a range of polymer lengths and LEF counts, and writes the results as JSON.
+# Results can be compared against a previous JSON file to catch performance regressions.
+###############
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "1D_trajectory"))
+sys.path.insert(0, os.path.join(HERE, "..", "3D_simulation"))
+from lef_simulation import load_extruders, record_positions
+from lef_engine import LEFEngine, BlockerTable
+from parallel_engine import ParallelLEFEngine
+from leaping_engine import LeapingLEFEngine
+from lef_backends import available_backends
+from bondUpdater import bondUpdater, clockedBondUpdater
+from bond_index import build_bond_index
+from conformation_analysis import contact_pairs
+
+### Scales to run: (polymer lengths in monomers, LEF counts)
+SCALES = {"quick": ([1000, 10000], [10, 100]),
+          "full": ([1000, 10000, 100000, 1000000], [10, 100, 1000, 10000])}
+
+def _timeit(func, repeat=3, setup=None):
+    """
+    Best wall time of several calls of func (the first call result is returned too)
+    With setup, func is built anew by setup() before every call, untimed (i.e. a fresh engine for stateful runs)
+    """
+    best, result = None, None
+    for r in range(repeat):
+        if setup is not None:
+            func = setup()
+        t = time.perf_counter()
+        out = func()
+        dt = time.perf_counter() - t
+        if best is None or dt < best:
+            best = dt
+        if r == 0:
+            result = out
+    return best, result
+
+def _blockers(N, nBlockers=None, seed=0):
+    """
+    Random CTCF-like blocker dicts with roughly one blocker per 100 monomers
+    """
+    rng = np.random.RandomState(seed)
+    nBlockers = nBlockers or max(N // 100, 1)
+    sites = rng.choice(np.arange(1, N-1), size=nBlockers, replace=False)
+    left, right = {}, {}
+    for k, s in enumerate(sites):
+        (left if k % 2 else right)[int(s)] = 0.9
+    relLeft = {s: 0.01 for s in left}
+    relRight = {s: 0.01 for s in right}
+    return left, right, relLeft, relRight
+
+def _extruder_setup(N, LEFNum, seed=0):
+    np.random.seed(seed)
+    occupied = np.zeros(N)
+    occupied[0] = 1
+    occupied[-1] = 1
+    lc, rc, lr, rr = _blockers(N, seed=seed)
+    EXTRUDERS = load_extruders(occupied, [[1, N-2]], [LEFNum], lc, rc, lr, rr, lifetime=800, lifetime_stalled=80)
+    return EXTRUDERS, occupied
+
+def engine_extruder(N, LEFNum, steps, seed=0):
+    """
+    Reference engine: the Extruder objects, stepped as in the 1D drivers
+    Returns a callable that runs `steps` steps
+    """
+    EXTRUDERS, occupied = _extruder_setup(N, LEFNum, seed)
+    return lambda: record_positions(EXTRUDERS, occupied, steps)[0]
+
+### 1D engines to compare; each entry builds a callable running a number of steps for (N, LEFNum)
+def _lef_engine(N, LEFNum, seed=0, backend="numpy"):
+    blockers = BlockerTable.from_dicts(*_blockers(N, seed=seed))
+    return LEFEngine(N, [[1, N-2]] * LEFNum, blockers, lifetime=800, lifetime_stalled=80, seed=seed, backend=backend)
+
+def engine_vectorized(N, LEFNum, steps, seed=0):
+    """
+    Array-based engine (lef_engine.LEFEngine)
+    """
+    engine = _lef_engine(N, LEFNum, seed)
+    return lambda: engine.run(steps)
+
+def engine_numba(N, LEFNum, steps, seed=0):
+    """
+    Array-based engine with the compiled translocation kernel; compilation is not timed (skipped by bench_1D without Numba)
+    """
+    engine = _lef_engine(N, LEFNum, seed, backend="numba")
+    return lambda: engine.run(steps)
+
+def engine_leaping(N, LEFNum, steps, seed=0):
+    """
+    Array-based engine with multi-step leaps of free legs (leaping_engine.LeapingLEFEngine)
+    """
+    blockers = BlockerTable.from_dicts(*_blockers(N, seed=seed))
+    engine = LeapingLEFEngine(N, [[1, N-2]] * LEFNum, blockers, lifetime=800, lifetime_stalled=80, seed=seed)
+    return lambda: engine.run(steps)
+
+def engine_parallel(N, LEFNum, steps, seed=0):
+    """
+    Domain-decomposed engine (parallel_engine.ParallelLEFEngine) on all CPUs; worker start-up is not timed
+    """
+    engine = ParallelLEFEngine(_lef_engine(N, LEFNum, seed), seed=seed)
+    def run():
+        try:
+            return engine.run(steps)
+        finally:
+            engine.close()
+    return run
+
+ENGINES = {"extruder": engine_extruder, "vectorized": engine_vectorized, "numba": engine_numba, "leaping": engine_leaping, "parallel": engine_parallel}
+
+def bench_1D(Ns, LEFNums, engines, steps=None):
+    results = []
+    if "numba" in engines and "numba" not in available_backends(): # Would time the numpy fallback under the numba label
+        print("Numba not installed, skipping the numba 1D engine")
+        results.append({"benchmark": "1D_step", "engine": "numba", "skipped": "numba not installed"})
+        engines = [name for name in engines if name != "numba"]
+    for N in Ns:
+        for LEFNum in LEFNums:
+            if 4 * LEFNum > N: # Not enough room to load all LEFs
+                continue
+            nSteps = steps or max(10, min(1000, 2000000 // (LEFNum * 50)))
+            for name in engines:
+                dt, _ = _timeit(None, setup=lambda: ENGINES[name](N, LEFNum, nSteps))
+                results.append({"benchmark": "1D_step", "engine": name, "N": N, "LEFNum": LEFNum, "steps": nSteps,
+                                "seconds": dt, "steps_per_second": nSteps / dt,
+                                "LEF_steps_per_second": nSteps * LEFNum / dt})
+    return results
+
+def bench_hdf5(Ns, LEFNums, frames=50000, num_chunks=50):
+    results = []
+    tmp = tempfile.mkdtemp()
+    for N in Ns:
+        for LEFNum in LEFNums:
+            if 4 * LEFNum > N:
+                continue
+            nFrames = max(1000, min(frames, 50000000 // LEFNum // 10))
+            rng = np.random.RandomState(0)
+            start = rng.randint(1, N - 2, size=LEFNum)
+            # Extruding trajectory: each leg moves out by one per frame, wrapped to stay on the polymer
+            walk = np.arange(nFrames)[:, None] % (N // (2 * max(LEFNum, 1)) + 1)
+            data = np.stack([np.clip(start - walk, 0, N-1), np.clip(start + 1 + walk, 0, N-1)], axis=-1).astype(np.int32)
+            fname = os.path.join(tmp, "LEFPositions_{}_{}.h5".format(N, LEFNum))
+
+            def write():
+                with h5py.File(fname, mode='w') as f:
+                    dset = f.create_dataset("positions", shape=data.shape, dtype=np.int32, compression="gzip")
+                    bins = np.linspace(0, nFrames, num_chunks, dtype=int)
+                    for st, end in zip(bins[:-1], bins[1:]):
+                        dset[st:end] = data[st:end]
+                    f.attrs["N"] = N
+                    f.attrs["LEFNum"] = LEFNum
+
+            def read_all():
+                with h5py.File(fname, mode='r') as f:
+                    return f["positions"][:]
+
+            def read_windows(window=100):
+                with h5py.File(fname, mode='r') as f:
+                    dset = f["positions"]
+                    for st in range(0, nFrames - window + 1, window):
+                        dset[st:st+window]
+
+            tw, _ = _timeit(write)
+            tr, _ = _timeit(read_all)
+            tws, _ = _timeit(read_windows)
+            size = os.path.getsize(fname)
+            common = {"N": N, "LEFNum": LEFNum, "frames": nFrames, "bytes": size}
+            results.append(dict(benchmark="hdf5_write", seconds=tw, frames_per_second=nFrames / tw, **common))
+            results.append(dict(benchmark="hdf5_read", seconds=tr, frames_per_second=nFrames / tr, **common))
+            results.append(dict(benchmark="hdf5_read_windows", seconds=tws, frames_per_second=nFrames / tws, **common))
+            os.unlink(fname)
+    return results
+
+def bench_bondUpdater(Ns, LEFNums, blocks=100):
+    """
+    bondUpdater.setup and step (harmonic, harmonic with a bond index, and clocked backends) against a real OpenMM context (Reference platform);
+    skipped without OpenMM
+    """
+    try:
+        import openmm
+    except ImportError:
+        print("OpenMM not installed, skipping bondUpdater benchmarks")
+        return [{"benchmark": "bondUpdater", "skipped": "openmm not installed"}]
+    results = []
+    for N in Ns:
+        if N > 100000: # Context creation for larger systems dominates the measurement
+            continue
+        for LEFNum in LEFNums:
+            if 4 * LEFNum > N:
+                continue
+            EXTRUDERS, occupied = _extruder_setup(N, LEFNum)
+            positions, _ = record_positions(EXTRUDERS, occupied, blocks)
+            index = build_bond_index(positions)
+            for backend, updater in (("harmonic", bondUpdater), ("indexed", bondUpdater), ("clocked", clockedBondUpdater)):
+                system = openmm.System()
+                for i in range(N):
+                    system.addParticle(1.0)
+                milker = updater(positions, index=index if backend == "indexed" else None)
+                milker.setParams({"length": 0.5, "k": 100.0}, {"length": 0.5, "k": 0.0})
+                bondForce = milker.create_force() if backend == "clocked" else openmm.HarmonicBondForce()
+                system.addForce(bondForce)
+                t = time.perf_counter()
+                milker.setup(bondForce=bondForce, blocks=blocks)
+                tSetup = time.perf_counter() - t
+                context = openmm.Context(system, openmm.VerletIntegrator(0.001), openmm.Platform.getPlatformByName("Reference"))
+                context.setPositions(np.cumsum(np.random.normal(size=(N, 3)), axis=0) * 0.1)
+                t = time.perf_counter()
+                for i in range(blocks - 1):
+                    milker.step(context, verbose=False)
+                tStep = (time.perf_counter() - t) / (blocks - 1)
+                results.append({"benchmark": "bondUpdater_setup", "backend": backend, "N": N, "LEFNum": LEFNum, "blocks": blocks, "seconds": tSetup})
+                results.append({"benchmark": "bondUpdater_step", "backend": backend, "N": N, "LEFNum": LEFNum, "seconds": tStep})
+                del context
+    return results
+
+def bench_contacts(Ns, conformations=5, cutoff=10):
+    results = []
+    rng = np.random.RandomState(0)
+    for N in Ns:
+        confs = [np.cumsum(rng.normal(size=(N, 3)), axis=0) for c in range(conformations)]
+
+        def accumulate():
+            counts = np.zeros(N, dtype=np.int64)
+            for pos in confs:
+                i, j = contact_pairs(pos, cutoff)
+                counts += np.bincount(j - i, minlength=N)
+            return counts
+
+        dt, counts = _timeit(accumulate)
+        results.append({"benchmark": "contact_accumulation", "N": N, "conformations": conformations, "cutoff": cutoff,
+                        "seconds": dt, "conformations_per_second": conformations / dt, "contacts": int(counts.sum())})
+    return results
+
+def _key(result):
+    return json.dumps({k: v for k, v in result.items() if not isinstance(v, float) and k != "bytes" and k != "contacts"}, sort_keys=True)
+
+def compare(results, baseline, threshold):
+    """
+    Compare wall times against a baseline run
+    Returns:
+        list of (benchmark key, baseline seconds, new seconds) for every benchmark slower than threshold x baseline
+    """
+    old = {_key(r): r for r in baseline["results"] if "seconds" in r}
+    regressions = []
+    for r in results:
+        ref = old.get(_key(r))
+        if ref is None or "seconds" not in r:
+            continue
+        limit = ref.get("threshold", threshold)
+        if r["seconds"] > limit * ref["seconds"]:
+            regressions.append((_key(r), ref["seconds"], r["seconds"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the 1D engine, bondUpdater, HDF5 trajectories and contact mapping')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='quick', help='set of polymer lengths and LEF counts')
+    parser.add_argument('--only', action='append', choices=['1D', 'hdf5', 'bondUpdater', 'contacts'], default=None,
+                        help='run only these benchmarks (repeatable)')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES), default=None, help='1D engines to time (default: all)')
+    parser.add_argument('--out', default='benchmark_results.json', help='output JSON file')
+    parser.add_argument('--baseline', default=None, help='previous results JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='a benchmark regresses when slower than threshold x baseline (a "threshold" entry in the baseline overrides this)')
+    args = parser.parse_args()
+
+    Ns, LEFNums = SCALES[args.scale]
+    only = args.only or ['1D', 'hdf5', 'bondUpdater', 'contacts']
+    results = []
+    if '1D' in only:
+        results += bench_1D(Ns, LEFNums, args.engine or sorted(ENGINES))
+    if 'hdf5' in only:
+        results += bench_hdf5(Ns, LEFNums)
+    if 'bondUpdater' in only:
+        results += bench_bondUpdater(Ns, LEFNums)
+    if 'contacts' in only:
+        results += bench_contacts(Ns)
+    for r in results:
+        print(r)
+
+    out = {"meta": {"host": socket.gethostname(), "platform": platform.platform(), "python": platform.python_version(),
+                    "numpy": np.__version__, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "scale": args.scale,
+                    "threshold": args.threshold},
+           "results": results}
+    with open(args.out, 'w') as f:
+        json.dump(out, f, indent=2)
+    print('Results written to {}'.format(args.out))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new in regressions:
+            print('REGRESSION {}: {:.4g}s -> {:.4g}s'.format(key, old, new))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
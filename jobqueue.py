@@ -0,0 +1,329 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Local job queue for pipeline runs, backed by SQLite
+# A run is a 1D driver plus parameter overrides, with its own work directory (runs/<name>/), and is queued as a chain
+# of stage jobs: 1d (trajectory.h5, also kept in the trajectory cache), 3d (sim_outs/ from trajectory.h5), export
+# (confs_txt/) and contacts (matrix.txt). Every stage runs in the work directory of its run, so runs never share
+# outputs, and each job starts only once the stage before it is done. The run keeps its own copy of the trajectory, so
+# evictions from the size-bounded cache do not affect queued 3D jobs; a 3D job whose trajectory is missing makes it again.
+# Workers (loopsim.py queue work) take as many ready jobs as fit in their CPU threads and GPUs; every job runs in a
+# subprocess whose thread pools (OpenMP, BLAS, Numba, OpenMM CPU) are limited to the threads it was given, and 3D jobs
+# get their own GPU (CUDA_VISIBLE_DEVICES). Failed jobs are retried with exponential backoff, up to their number of
+# attempts. A stage whose outputs already exist and were made from the same inputs (a stamp file in the work
+# directory) is skipped, so resubmitting a run, or restarting a killed worker, only redoes what is missing.
+# Several workers may share one queue file; a job is claimed in a single transaction.
+###############
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DIR_1D = os.path.join(HERE, "1D_trajectory")
+DIR_3D = os.path.join(HERE, "3D_simulation")
+DEFAULT_DB = os.path.join(HERE, "runs", "queue.sqlite")
+STAGES = ["1d", "3d", "export", "contacts"]
+DEFAULT_THREADS = {"1d": 1, "3d": 4, "export": 1, "contacts": 1} # CPU threads per job
+DEFAULT_GPUS = {"1d": 0, "3d": 1, "export": 0, "contacts": 0}
+TRAJECTORY = "trajectory.h5" # 1D trajectory of a run, in its work directory
+STAGE_OUTPUTS = {"1d": [TRAJECTORY], "3d": ["sim_outs", "timing.jsonl"], "export": ["confs_txt"], "contacts": ["matrix.txt"]}
+CLAIM_GRACE = 60 # Seconds a claimed job may go without a pid (between claim and launch) before recover takes it back
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMBA_NUM_THREADS", "OPENMM_CPU_THREADS"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    driver TEXT NOT NULL,
+    overrides TEXT NOT NULL,
+    workdir TEXT NOT NULL,
+    trajectory_key TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT NOT NULL,
+    depends_on INTEGER REFERENCES jobs(id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    threads INTEGER NOT NULL,
+    gpus INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, not_before);
+"""
+
+def connect(db=DEFAULT_DB):
+    """
+    Open (and create if needed) a queue file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db)), exist_ok=True)
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None) # Transactions are explicit
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+def submit(conn, driver, overrides=None, name=None, stages=STAGES, threads=None, gpus=None, attempts=3, root=None):
+    """
+    Queue a run as a chain of stage jobs
+    Parameters:
+        driver - str, 1D driver module providing parameters()
+        overrides - dict of parameter values replacing those of the driver (as loopsim.py sweep)
+        name - str, name of the work directory (default: <driver>-<run id>)
+        stages - list of stages to run, in pipeline order
+        threads, gpus - dict {stage: count} replacing DEFAULT_THREADS / DEFAULT_GPUS
+        attempts - int, runs of a job before it is marked failed
+        root - str, directory holding the work directories (default: runs/ next to the queue file)
+    Returns:
+        run id
+    """
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise ValueError("Unknown stages {}; choose from {}".format(", ".join(unknown), ", ".join(STAGES)))
+    threads = dict(DEFAULT_THREADS, **(threads or {}))
+    gpus = dict(DEFAULT_GPUS, **(gpus or {}))
+    root = root or os.path.dirname(os.path.abspath(conn.execute("PRAGMA database_list").fetchone()["file"]))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        runId = conn.execute("INSERT INTO runs (name, driver, overrides, workdir, created) VALUES (?, ?, ?, '', ?)",
+                             (name or driver, driver, json.dumps(overrides or {}, sort_keys=True), time.time())).lastrowid
+        name = name or "{}-{}".format(driver, runId)
+        conn.execute("UPDATE runs SET name = ?, workdir = ? WHERE id = ?", (name, os.path.join(root, name), runId))
+        prev = None
+        for stage in sorted(stages, key=STAGES.index):
+            prev = conn.execute("INSERT INTO jobs (run_id, stage, depends_on, threads, gpus, max_attempts) VALUES (?, ?, ?, ?, ?, ?)",
+                                (runId, stage, prev, threads[stage], gpus[stage], attempts)).lastrowid
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return runId
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def recover(conn):
+    """
+    Put back in the queue the running jobs of this host whose process is gone (i.e. a killed worker). Jobs without a pid
+    are only taken back after CLAIM_GRACE seconds, as another worker may have claimed them and not launched them yet
+    """
+    host = socket.gethostname()
+    for job in conn.execute("SELECT id, pid, started FROM jobs WHERE status = 'running' AND host = ?", (host,)).fetchall():
+        if job["pid"] is None and job["started"] > time.time() - CLAIM_GRACE:
+            continue
+        if job["pid"] is None or not _alive(job["pid"]):
+            conn.execute("UPDATE jobs SET status = 'pending', pid = NULL WHERE id = ? AND status = 'running'", (job["id"],))
+
+def claim(conn, freeThreads, freeGpus, capacity):
+    """
+    Mark the oldest ready job that fits in the free resources as running
+    Parameters:
+        capacity - int, threads of the worker; jobs asking for more are given all of them
+    Returns:
+        sqlite3.Row of the job, or None
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        job = conn.execute("""
+            SELECT j.* FROM jobs j LEFT JOIN jobs d ON d.id = j.depends_on
+            WHERE j.status = 'pending' AND j.not_before <= ? AND (d.id IS NULL OR d.status = 'done')
+              AND MIN(j.threads, ?) <= ? AND j.gpus <= ?
+            ORDER BY j.run_id, j.id LIMIT 1""", (time.time(), capacity, freeThreads, freeGpus)).fetchone()
+        if job is not None:
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, host = ?, started = ? WHERE id = ?",
+                         (socket.gethostname(), time.time(), job["id"]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return job
+
+def finish(conn, job, returncode, retryDelay=60):
+    """
+    Record the end of a job: done, back to pending after a delay, or failed (with every job depending on it)
+    """
+    if returncode == 0:
+        conn.execute("UPDATE jobs SET status = 'done', finished = ?, pid = NULL, error = NULL WHERE id = ?", (time.time(), job["id"]))
+        return
+    error = "exit code {}".format(returncode)
+    if job["attempts"] + 1 < job["max_attempts"]:
+        conn.execute("UPDATE jobs SET status = 'pending', pid = NULL, error = ?, not_before = ? WHERE id = ?",
+                     (error, time.time() + retryDelay * 2 ** job["attempts"], job["id"]))
+        return
+    conn.execute("UPDATE jobs SET status = 'failed', finished = ?, pid = NULL, error = ? WHERE id = ?", (time.time(), error, job["id"]))
+    blocked = [job["id"]]
+    while blocked:
+        rows = conn.execute("SELECT id FROM jobs WHERE depends_on = ? AND status = 'pending'", (blocked.pop(),)).fetchall()
+        for row in rows:
+            conn.execute("UPDATE jobs SET status = 'failed', error = ? WHERE id = ?", ("stage {} failed".format(job["stage"]), row["id"]))
+            blocked.append(row["id"])
+
+def work(db=DEFAULT_DB, threads=None, gpus=1, poll=5, retryDelay=60, exitWhenIdle=True):
+    """
+    Run queued jobs until none is left, keeping at most threads CPU threads and gpus GPUs busy
+    Parameters:
+        threads - int, CPU threads to use (default: number of CPUs)
+        gpus - int, GPUs to use (devices 0 .. gpus-1)
+        poll - float, seconds between checks for finished and ready jobs
+        retryDelay - float, seconds before the first retry of a failed job (doubled at every retry)
+        exitWhenIdle - bool, return once no job is pending or running (else wait for new ones)
+    """
+    capacity = threads or os.cpu_count()
+    conn = connect(db)
+    recover(conn)
+    running = {} # Popen: (job, threads, gpu ids)
+    freeGpus = list(range(gpus))
+    while True:
+        for proc in [p for p in running if p.poll() is not None]:
+            job, used, devices = running.pop(proc)
+            freeGpus += devices
+            finish(conn, job, proc.returncode, retryDelay)
+            print('Job {} ({} of run {}): {}'.format(job["id"], job["stage"], job["run_id"],
+                                                     "done" if proc.returncode == 0 else "exit code {}".format(proc.returncode)))
+        free = capacity - sum(used for job, used, devices in running.values())
+        while free > 0:
+            job = claim(conn, free, len(freeGpus), capacity)
+            if job is None:
+                break
+            used = min(job["threads"], capacity)
+            devices, freeGpus = freeGpus[:job["gpus"]], freeGpus[job["gpus"]:]
+            proc = _launch(conn, db, job, used, devices)
+            conn.execute("UPDATE jobs SET pid = ? WHERE id = ?", (proc.pid, job["id"]))
+            running[proc] = (job, used, devices)
+            free -= used
+        if not running and exitWhenIdle:
+            # Nothing runs and nothing fits: done, unless a retry is waiting for its delay
+            if conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending' AND not_before > ?", (time.time(),)).fetchone()[0] == 0:
+                stuck = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+                if stuck:
+                    print('{} pending jobs cannot run on this worker (they need more GPUs, or wait for jobs of another worker)'.format(stuck))
+                return
+        time.sleep(poll)
+
+def _launch(conn, db, job, threads, devices):
+    """
+    Start a job in a subprocess, in the work directory of its run, with its thread and GPU limits
+    """
+    workdir = _run(conn, job["run_id"])["workdir"]
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ, **{v: str(threads) for v in THREAD_VARIABLES})
+    if job["gpus"] > 0:
+        env["CUDA_VISIBLE_DEVICES"] = ",".join(str(d) for d in devices)
+    with open(os.path.join(workdir, "{}.log".format(job["stage"])), "a") as log: # One log per stage, appended at every attempt
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), os.path.abspath(db), str(job["id"])],
+                                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def _run(conn, runId):
+    return conn.execute("SELECT * FROM runs WHERE id = ?", (runId,)).fetchone()
+
+def _stamp(stage):
+    return ".{}.done".format(stage)
+
+def _valid(stage, inputs):
+    """
+    True if the outputs of a stage in the current directory exist and were made from these inputs
+    """
+    if not os.path.exists(_stamp(stage)) or not all(os.path.exists(p) for p in STAGE_OUTPUTS[stage]):
+        return False
+    with open(_stamp(stage)) as f:
+        return json.load(f) == inputs
+
+def _clean(stage):
+    """
+    Remove the outputs of an unfinished attempt of a stage
+    """
+    for p in [_stamp(stage)] + STAGE_OUTPUTS[stage]:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.unlink(p)
+
+def _trajectory(conn, run):
+    """
+    Write the 1D trajectory of a run to TRAJECTORY in the current directory (copied from the trajectory cache if it
+    is there), unless it is already there
+    Returns:
+        cache key of the trajectory
+    """
+    import importlib
+    from lef_simulation import run_1D
+    from trajectory_cache import params_key
+    params, metadata = importlib.import_module(run["driver"]).parameters()
+    params.update(json.loads(run["overrides"]))
+    key = params_key(params)
+    inputs = {"trajectory_key": key}
+    if _valid("1d", inputs):
+        print('Trajectory {} is up to date, skipping'.format(key))
+    else:
+        _clean("1d")
+        run_1D(params, outf=TRAJECTORY, metadata=dict(metadata, run=run["name"]))
+        with open(_stamp("1d"), "w") as f:
+            json.dump(inputs, f)
+    conn.execute("UPDATE runs SET trajectory_key = ? WHERE id = ?", (key, run["id"]))
+    return key
+
+def execute(db, jobId):
+    """
+    Run one stage job in the current directory (the work directory of its run); called in the job's subprocess
+    """
+    conn = connect(db)
+    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (jobId,)).fetchone()
+    run = _run(conn, job["run_id"])
+    sys.path[:0] = [DIR_1D, DIR_3D]
+    stage = job["stage"]
+    if stage == "1d":
+        _trajectory(conn, run)
+        return
+    key = run["trajectory_key"]
+    if key is None:
+        raise ValueError("Run {} has no 1D trajectory; queue it with the 1d stage".format(run["name"]))
+    inputs = {"trajectory_key": key}
+    if _valid(stage, inputs):
+        print('Outputs of stage {} are up to date, skipping'.format(stage))
+        return
+    _clean(stage)
+    if stage == "3d":
+        import importlib
+        if not _valid("1d", inputs): # Removed from the work directory since the 1d job ran
+            print('Trajectory {} missing from the work directory, making it again'.format(key))
+            inputs["trajectory_key"] = _trajectory(conn, run)
+        importlib.import_module("3D_polychrom_simulation").main(["--trajectory", TRAJECTORY])
+    elif stage == "export":
+        import trajectory_to_txt
+        from conformation_analysis import list_conformations
+        trajectory_to_txt.main([str(len(list_conformations("sim_outs"))), "sim_outs"])
+    elif stage == "contacts":
+        import make_contactMap
+        make_contactMap.main(["confs_txt"])
+    with open(_stamp(stage), "w") as f:
+        json.dump(inputs, f)
+
+def status(conn):
+    """
+    Rows of (run name, stage, status, attempts, error) of every job
+    """
+    return conn.execute("""SELECT r.name, j.stage, j.status, j.attempts, j.error FROM jobs j JOIN runs r ON r.id = j.run_id
+                           ORDER BY j.run_id, j.id""").fetchall()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python3 jobqueue.py <queue file> <job id> (run by loopsim.py queue work)')
+        os._exit(1)
+    execute(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,203 @@
+#!/home/noah/.conda/envs/noah/bin/python3
+###############
+# Single command-line entry point for the loop extrusion pipeline
+#   loopsim.py 1d <1D driver> [driver arguments]     1D simulation (i.e. 1D_polychrom_simulation_blocking_WT)
+#   loopsim.py 3d [cache key | --trajectory <file.h5> | --pipe <1D driver> [--archive]]
+#   loopsim.py export <total number of confs> <path to h5>
+#   loopsim.py contacts <dir of confs> [<dir of confs> ...] [--window K] [--out stack.h5]
+#   loopsim.py sweep <1D driver> --set KEY=v1,v2 [--set ...] [--processes P]
+#   loopsim.py fit <1D driver> <reference matrix> [fit_parameters.py arguments]
+#   loopsim.py queue submit <1D driver> [--set KEY=v1,v2 ...] [--stages 1d,3d,export,contacts]
+#   loopsim.py queue work [--threads T] [--gpus G]     (and: loopsim.py queue status)
+#   loopsim.py catalog [--stage 1d] [--param NAME=VALUE ...] [--stat NAME[=LOW:HIGH] ...] [--trends]
+# Only argparse is imported at startup; numpy, h5py, polychrom and OpenMM are imported by the subcommand
+# that needs them, so argument errors, cache lookups and sweep workers start quickly.
+###############
+import os
+import sys
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DIR_1D = os.path.join(HERE, "1D_trajectory")
+DIR_3D = os.path.join(HERE, "3D_simulation")
+
+def _enter(directory):
+    """
+    Run from a stage directory, as the drivers expect (relative output paths, sibling module imports)
+    """
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+
+def _driver(name):
+    import importlib
+    return importlib.import_module(name[:-3] if name.endswith(".py") else name)
+
+def run_1d(args):
+    _enter(DIR_1D)
+    driver = _driver(args.driver)
+    sys.argv = [args.driver] + args.args # Drivers with their own options (i.e. 1D_genome_simulation) parse sys.argv
+    driver.main()
+
+def run_3d(args):
+    argv = list(args.args)
+    for i in range(len(argv) - 1):
+        if argv[i] == '--trajectory':
+            argv[i+1] = os.path.abspath(argv[i+1]) # Before leaving the current directory
+    _enter(DIR_3D)
+    sys.path.insert(1, DIR_1D) # --pipe imports the 1D driver
+    _driver("3D_polychrom_simulation").main(argv)
+
+def run_export(args):
+    import trajectory_to_txt
+    trajectory_to_txt.main([args.n, args.path])
+
+def run_contacts(args):
+    import make_contactMap
+    make_contactMap.main([args.dir] + args.args)
+
+def parse_values(values):
+    """
+    Values of a --set option: "a,b,c" -> [a, b, c], each read as JSON when possible (numbers, lists) or kept as a string
+    """
+    import json
+    out = []
+    for v in values.split(","):
+        try:
+            out.append(json.loads(v))
+        except ValueError:
+            out.append(v)
+    return out
+
+def _sweep_job(job):
+    driver, overrides = job
+    from lef_simulation import run_1D
+    params, metadata = _driver(driver).parameters()
+    params.update(overrides)
+    metadata = dict(metadata, sweep=overrides)
+    return run_1D(params, outf=None, metadata=metadata)
+
+def parse_grid(driver, settings):
+    """
+    Every combination of the values of --set options, as a list of dicts of parameter overrides of a driver
+    """
+    import itertools
+    grid = []
+    for s in settings:
+        if "=" not in s:
+            print('--set takes KEY=v1,v2,...; got {}'.format(s))
+            os._exit(1)
+        key, values = s.split("=", 1)
+        grid.append([(key, v) for v in parse_values(values)])
+    params, metadata = _driver(driver).parameters()
+    unknown = [g[0][0] for g in grid if g[0][0] not in params]
+    if unknown:
+        print('Unknown parameters for {}: {}'.format(driver, ", ".join(unknown)))
+        os._exit(1)
+    return [dict(point) for point in itertools.product(*grid)]
+
+def run_sweep(args):
+    from concurrent.futures import ProcessPoolExecutor
+    _enter(DIR_1D)
+    jobs = [(args.driver, overrides) for overrides in parse_grid(args.driver, args.set)]
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for (driver, overrides), key in zip(jobs, pool.map(_sweep_job, jobs)):
+            print('{}\t{}'.format(key, " ".join("{}={}".format(k, v) for k, v in overrides.items())))
+
+def run_fit(args):
+    reference = os.path.abspath(args.reference) # Before leaving the current directory
+    _enter(DIR_1D)
+    import fit_parameters
+    sys.argv = ["fit_parameters.py", args.driver, reference] + args.args
+    fit_parameters.main()
+
+def run_queue(args):
+    import jobqueue
+    conn = jobqueue.connect(args.db)
+    if args.action == 'submit':
+        if args.driver is None:
+            print('queue submit needs a 1D driver')
+            os._exit(1)
+        sys.path.insert(0, DIR_1D)
+        stages = args.stages.split(",")
+        threads = {"3d": args.threads_3d} if args.threads_3d is not None else None
+        for overrides in parse_grid(args.driver, args.set):
+            runId = jobqueue.submit(conn, args.driver, overrides, stages=stages, threads=threads, attempts=args.attempts)
+            print('Run {}: {} {}'.format(runId, args.driver, " ".join("{}={}".format(k, v) for k, v in overrides.items())))
+    elif args.action == 'work':
+        jobqueue.work(args.db, threads=args.threads, gpus=args.gpus, poll=args.poll, retryDelay=args.retry_delay)
+    else:
+        for row in jobqueue.status(conn):
+            print('{}\t{}\t{}\t{}\t{}'.format(row["name"], row["stage"], row["status"], row["attempts"], row["error"] or ""))
+
+def run_catalog(args):
+    sys.path.insert(0, DIR_1D)
+    import run_catalog
+    sys.argv = ["run_catalog.py"] + args.args
+    run_catalog.main()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Loop extrusion simulation pipeline')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('1d', help='run a 1D driver (trajectory written to 1D_trajectory/trajectory/)')
+    p.add_argument('driver', help='1D driver module, i.e. 1D_polychrom_simulation_blocking_WT')
+    p.add_argument('args', nargs=argparse.REMAINDER, help='arguments of the driver')
+    p.set_defaults(func=run_1d)
+
+    p = sub.add_parser('3d', help='run the 3D simulation (arguments as 3D_polychrom_simulation.py)')
+    p.add_argument('args', nargs=argparse.REMAINDER, help='[cache key], --trajectory <file.h5> or --pipe <1D driver> [--archive]')
+    p.set_defaults(func=run_3d)
+
+    p = sub.add_parser('export', help='write conformations as text (trajectory_to_txt.py)')
+    p.add_argument('n', help='total number of conformations')
+    p.add_argument('path', help='path to the h5 conformations')
+    p.set_defaults(func=run_export)
+
+    p = sub.add_parser('contacts', help='contact matrix of text conformations (make_contactMap.py)')
+    p.add_argument('dir', help='directory of conformations')
+    p.add_argument('args', nargs=argparse.REMAINDER, help='more directories (replicas), --window K, --out stack.h5, ...')
+    p.set_defaults(func=run_contacts)
+
+    p = sub.add_parser('sweep', help='1D trajectories for a grid of parameter values, stored in the trajectory cache')
+    p.add_argument('driver', help='1D driver module providing parameters()')
+    p.add_argument('--set', action='append', default=[], metavar='KEY=v1,v2',
+                   help='values of one parameter (repeat for a grid over several)')
+    p.add_argument('--processes', type=int, default=None, help='worker processes (default: number of CPUs)')
+    p.set_defaults(func=run_sweep)
+
+    p = sub.add_parser('fit', help='fit blocker cap/rel and LIFETIME of a 1D driver to a reference contact map')
+    p.add_argument('driver', help='1D driver module providing parameters()')
+    p.add_argument('reference', help='reference contact map (tab-delimited)')
+    p.add_argument('args', nargs=argparse.REMAINDER, help='arguments of fit_parameters.py (--regions, --lifetime, --bin, ...)')
+    p.set_defaults(func=run_fit)
+
+    p = sub.add_parser('queue', help='queue pipeline runs (1d, 3d, export, contacts) and run them with a local worker')
+    p.add_argument('action', choices=['submit', 'work', 'status'])
+    p.add_argument('driver', nargs='?', default=None, help='submit: 1D driver module providing parameters()')
+    p.add_argument('--db', default=os.path.join(HERE, "runs", "queue.sqlite"), help='queue file (work directories go next to it)')
+    p.add_argument('--set', action='append', default=[], metavar='KEY=v1,v2', help='submit: one run per combination, as sweep')
+    p.add_argument('--stages', default='1d,3d,export,contacts', help='submit: stages of each run')
+    p.add_argument('--threads-3d', type=int, default=None, help='submit: CPU threads of each 3D job (default: 4)')
+    p.add_argument('--attempts', type=int, default=3, help='submit: runs of a failing job before it is marked failed')
+    p.add_argument('--threads', type=int, default=None, help='work: CPU threads to keep busy (default: number of CPUs)')
+    p.add_argument('--gpus', type=int, default=1, help='work: GPUs to use, one per 3D job')
+    p.add_argument('--poll', type=float, default=5, help='work: seconds between checks')
+    p.add_argument('--retry-delay', type=float, default=60, help='work: seconds before the first retry (doubles every retry)')
+    p.set_defaults(func=run_queue)
+
+    p = sub.add_parser('catalog', help='query past runs by parameters and statistics (run_catalog.py)')
+    p.add_argument('args', nargs=argparse.REMAINDER, help='arguments of run_catalog.py')
+    p.set_defaults(func=run_catalog)
+
+    # Pass-through arguments that start with an option (i.e. 3d --pipe) are not taken by REMAINDER; hand them over here
+    args, extra = parser.parse_known_args(argv)
+    if extra:
+        if not hasattr(args, 'args'):
+            parser.error('unrecognized arguments: {}'.format(" ".join(extra)))
+        args.args = extra + args.args
+    if args.command in ('export', 'contacts'):
+        sys.path.insert(0, DIR_3D)
+    args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+###############
+# The pipeline is made of flat script modules run from their own directories; make them importable
+###############
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+for directory in (ROOT, os.path.join(ROOT, "1D_trajectory"), os.path.join(ROOT, "3D_simulation")):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
@@ -0,0 +1,55 @@
+###############
+# Exactness of the 1D engines: translocation backends, and ParallelLEFEngine against its serial counterpart
+###############
+import numpy as np
+import pytest
+from equivalence import scenario, compare_backends
+from lef_engine import BlockerTable, engine_from_params
+from lef_genome import Domain, build_engine
+from parallel_engine import ParallelLEFEngine, _FieldEngine, parallel_engine, serial_engine
+
+def test_numpy_and_python_backends_agree():
+    passed, results = compare_backends(params=scenario(steps=500), seeds=3, backends=["numpy", "python"])
+    assert passed, results
+
+def test_auto_backend_matches_numpy():
+    params = scenario(steps=300)
+    ref = engine_from_params(params, 1, backend="numpy").run(params["steps"])
+    assert np.array_equal(engine_from_params(params, 1, backend="auto").run(params["steps"]), ref)
+
+@pytest.mark.parametrize("window", [1, 10, 25])
+def test_parallel_engine_equals_serial(window):
+    params = scenario(steps=400)
+    ref = serial_engine(params, 3)
+    with ParallelLEFEngine(engine_from_params(params, 3), workers=2, window=window, seed=3) as eng:
+        assert np.array_equal(eng.run(params["steps"]), ref)
+
+def test_parallel_engine_function_equals_serial():
+    params = scenario(steps=300)
+    assert np.array_equal(parallel_engine(params, 5, workers=3), serial_engine(params, 5))
+
+def _genome(seed):
+    """
+    Engine over 12 domains with local loading regions and a few blockers, the case the workers run in parallel
+    """
+    domains, offset = [], 0
+    for d in range(12):
+        dom = Domain("d{}".format(d), "chr1", 0, 200000, 1000, offset, 40, 300, 30)
+        dom.loading.append([dom.start + 20, dom.start + 180, 1.0])
+        domains.append(dom)
+        offset = dom.end
+    sites = [dom.start + 60 for dom in domains], [dom.start + 140 for dom in domains]
+    caps = [[0.8] * len(domains)] * 2
+    rels = [[0.01] * len(domains)] * 2
+    return build_engine(domains, BlockerTable(sites, caps, rels), seed=seed)[0]
+
+def test_parallel_engine_equals_serial_on_domains():
+    steps, seed = 300, 11
+    base = _genome(seed)
+    key = int(np.random.SeedSequence(seed).generate_state(1, np.uint64)[0])
+    serial = _FieldEngine(base.N, base.lefRegions, base.blockers, 1 / base.unloadProb, 1 / base.unloadProbStalled,
+                          barriers=base.barriers, legs=base.legs, maxLoadTries=base.maxLoadTries, backend=base.backend, key=key)
+    ref = serial.run(steps)
+    for workers, window in ((2, 10), (4, 5)):
+        with ParallelLEFEngine(_genome(seed), workers=workers, window=window, seed=seed) as eng:
+            assert np.array_equal(eng.run(steps), ref)
@@ -0,0 +1,16 @@
+###############
+# The equivalence harness: every 1D engine against the reference Extruder, in distribution
+# Slow (about a minute on one CPU); run with python3 -m pytest -m slow
+###############
+import pytest
+from equivalence import compare_engines, scenario, reference_engine
+from lef_engine import vectorized_engine
+from parallel_engine import parallel_engine
+
+pytestmark = pytest.mark.slow
+
+@pytest.mark.parametrize("candidate", [reference_engine, vectorized_engine, parallel_engine],
+                         ids=["reference", "vectorized", "parallel"])
+def test_engine_matches_reference(candidate):
+    passed, tests = compare_engines(candidate, params=scenario(steps=3000), seeds=8)
+    assert passed, tests
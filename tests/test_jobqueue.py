@@ -0,0 +1,68 @@
+###############
+# Job queue: dependencies, retries, failure propagation and recovery of lost jobs
+###############
+import time
+import pytest
+import jobqueue
+
+@pytest.fixture
+def conn(tmp_path):
+    return jobqueue.connect(str(tmp_path / "queue.sqlite"))
+
+def _jobs(conn, runId):
+    return {row["stage"]: row for row in conn.execute("SELECT * FROM jobs WHERE run_id = ?", (runId,))}
+
+def test_claim_follows_stage_order(conn, tmp_path):
+    runId = jobqueue.submit(conn, "driver", stages=["1d", "3d", "export"], root=str(tmp_path))
+    job = jobqueue.claim(conn, freeThreads=8, freeGpus=1, capacity=8)
+    assert job["stage"] == "1d"
+    assert jobqueue.claim(conn, freeThreads=8, freeGpus=1, capacity=8) is None # 3d waits for 1d
+    jobqueue.finish(conn, job, 0)
+    assert jobqueue.claim(conn, freeThreads=8, freeGpus=0, capacity=8) is None # 3d needs a GPU
+    assert jobqueue.claim(conn, freeThreads=8, freeGpus=1, capacity=8)["stage"] == "3d"
+    assert _jobs(conn, runId)["1d"]["status"] == "done"
+
+def test_unknown_stage_is_rejected(conn):
+    with pytest.raises(ValueError):
+        jobqueue.submit(conn, "driver", stages=["1d", "render"])
+
+def test_retry_then_failure_propagates(conn, tmp_path):
+    runId = jobqueue.submit(conn, "driver", stages=["1d", "3d", "export"], attempts=2, root=str(tmp_path))
+    job = jobqueue.claim(conn, 8, 1, 8)
+    jobqueue.finish(conn, job, 1, retryDelay=0)
+    jobs = _jobs(conn, runId)
+    assert jobs["1d"]["status"] == "pending" and jobs["1d"]["attempts"] == 1
+    assert jobs["3d"]["status"] == "pending"
+    job = jobqueue.claim(conn, 8, 1, 8)
+    assert job["stage"] == "1d"
+    jobqueue.finish(conn, job, 1, retryDelay=0)
+    jobs = _jobs(conn, runId)
+    assert jobs["1d"]["status"] == "failed" and jobs["1d"]["attempts"] == 2
+    assert jobs["1d"]["error"] == "exit code 1"
+    assert [(jobs[s]["status"], jobs[s]["error"]) for s in ("3d", "export")] == [("failed", "stage 1d failed")] * 2
+    assert jobqueue.claim(conn, 8, 1, 8) is None
+
+def test_retry_waits_for_delay(conn, tmp_path):
+    jobqueue.submit(conn, "driver", stages=["1d"], root=str(tmp_path))
+    jobqueue.finish(conn, jobqueue.claim(conn, 8, 1, 8), 1, retryDelay=3600)
+    assert jobqueue.claim(conn, 8, 1, 8) is None
+
+def test_recover_spares_jobs_being_launched(conn, tmp_path):
+    runId = jobqueue.submit(conn, "driver", stages=["1d"], root=str(tmp_path))
+    jobqueue.claim(conn, 8, 1, 8) # Claimed, no pid yet
+    jobqueue.recover(conn)
+    assert _jobs(conn, runId)["1d"]["status"] == "running"
+    conn.execute("UPDATE jobs SET started = ?", (time.time() - 2 * jobqueue.CLAIM_GRACE,))
+    jobqueue.recover(conn)
+    assert _jobs(conn, runId)["1d"]["status"] == "pending"
+
+def test_recover_takes_back_dead_processes(conn, tmp_path, monkeypatch):
+    runId = jobqueue.submit(conn, "driver", stages=["1d"], root=str(tmp_path))
+    jobqueue.claim(conn, 8, 1, 8)
+    conn.execute("UPDATE jobs SET pid = 12345")
+    monkeypatch.setattr(jobqueue, "_alive", lambda pid: True)
+    jobqueue.recover(conn)
+    assert _jobs(conn, runId)["1d"]["status"] == "running"
+    monkeypatch.setattr(jobqueue, "_alive", lambda pid: False)
+    jobqueue.recover(conn)
+    assert _jobs(conn, runId)["1d"]["status"] == "pending"
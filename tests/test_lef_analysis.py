@@ -0,0 +1,73 @@
+###############
+# Chunked 1D statistics and the contact map proxy, against direct dense computations
+###############
+import numpy as np
+import h5py
+from equivalence import scenario, reference_engine
+from lef_analysis import TrajectoryStats, contact_proxy, effective_separation_weights, reloads
+
+def _trajectory(steps=600, seed=2):
+    params = scenario(steps=steps)
+    return params, np.asarray(reference_engine(params, seed), dtype=np.int64)
+
+def _write(path, positions, N):
+    with h5py.File(path, mode='w') as f:
+        f.create_dataset("positions", data=positions.astype(np.int32))
+        f.attrs["N"] = N
+        f.attrs["LEFNum"] = positions.shape[1]
+
+def test_contact_proxy_matches_dense_average(tmp_path):
+    params, positions = _trajectory()
+    N = params["N"]
+    _write(tmp_path / "t.h5", positions, N)
+    stride, binSize, alpha = 7, 5, 1.5
+    centers = np.arange(binSize // 2, N - N % binSize, binSize)
+    W = effective_separation_weights(positions[::stride], N)[:, centers]
+    sEff = np.maximum(np.abs(W[:, :, None] - W[:, None, :]), 1).astype(np.float64)
+    expected = (sEff ** -alpha).mean(axis=0)
+    proxy = contact_proxy(str(tmp_path / "t.h5"), stride=stride, binSize=binSize, alpha=alpha, chunkSize=50)
+    assert np.allclose(proxy, expected)
+
+def test_effective_separation_collapses_loops():
+    W = effective_separation_weights(np.array([[[2, 6]]]), 10)[0]
+    assert W[6] - W[2] == 1 # The loop bridge
+    assert W[5] - W[3] == 0 # Inside the loop
+    assert W[9] - W[0] == 2 + 1 + 3 # 0..2, the bridge, 6..9
+
+def _dense_stalls(stats, positions):
+    """
+    Stall and capture counts from a dense occupancy of every previous frame, with the chain ends occupied
+    """
+    N, nR = stats.N, len(stats.regionNames)
+    legFrames, stalled, captured = np.zeros(nR, dtype=np.int64), np.zeros(nR, dtype=np.int64), np.zeros(nR, dtype=np.int64)
+    prev, cur = positions[:-1], positions[1:]
+    reloaded = reloads(prev, cur)
+    for t in range(len(prev)):
+        occ = np.zeros(N + 1, dtype=bool)
+        occ[[0, N - 1, N]] = True
+        occ[prev[t].ravel()] = True
+        for side, col in ((-1, 0), (1, 1)):
+            for lef in range(prev.shape[1]):
+                pos = prev[t, lef, col]
+                r = stats.regionOf[pos]
+                if r < 0 or reloaded[t, lef]:
+                    continue
+                legFrames[r] += 1
+                if cur[t, lef, col] == pos:
+                    if occ[min(max(pos + side, 0), N)]:
+                        stalled[r] += 1
+                    else:
+                        captured[r] += 1
+    return legFrames, stalled, captured
+
+def test_stall_counts_match_dense_occupancy():
+    params, positions = _trajectory(steps=400)
+    regions = {"left": np.arange(95, 110), "both": np.arange(235, 250), "right": np.arange(375, 390)}
+    stats = TrajectoryStats(params["N"], positions.shape[1], blockingRegions=regions)
+    for st in range(0, len(positions), 64): # In chunks, as trajectory_stats does
+        stats.update(positions[st:st+64])
+    legFrames, stalled, captured = _dense_stalls(stats, positions)
+    assert np.array_equal(stats.legFrames, legFrames)
+    assert np.array_equal(stats.stalledFrames, stalled)
+    assert np.array_equal(stats.capturedFrames, captured)
+    assert stalled.sum() > 0 and captured.sum() > 0
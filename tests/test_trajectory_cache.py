@@ -0,0 +1,84 @@
+###############
+# Trajectory cache: keys, hits, invalid entries and least recently used eviction
+###############
+import os
+import numpy as np
+import h5py
+import pytest
+from trajectory_cache import TrajectoryCache, params_key, canonical_json, TRAJECTORY_VERSION
+from lef_simulation import run_1D
+
+def _trajectory(path, key, nbytes=0):
+    with h5py.File(path, mode='w') as f:
+        f.create_dataset("positions", data=np.zeros((4, 2, 2), dtype=np.int32))
+        f.create_dataset("padding", data=np.zeros(nbytes, dtype=np.uint8))
+        f.attrs["key"] = key
+    return str(path)
+
+def test_params_key_includes_version():
+    params = {"N": 100, "seed": np.int64(0), "regions": (1, 2)}
+    assert params_key(params) == params_key({"seed": 0, "regions": [1, 2], "N": 100})
+    assert params_key(params) != params_key(params, version=TRAJECTORY_VERSION + 1)
+    assert params_key(params) != params_key(params, version=None)
+    assert canonical_json(params) == '{"N":100,"regions":[1,2],"seed":0}'
+
+def test_store_then_lookup(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "cache"))
+    key = params_key({"N": 10})
+    assert cache.lookup(key) is None
+    p = cache.store(key, _trajectory(tmp_path / "t.h5", key))
+    assert not os.path.exists(tmp_path / "t.h5")
+    assert cache.lookup(key) == p
+    assert cache.lookup(key[:8]) == p # Unique prefix
+
+def test_invalid_entry_is_removed(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "cache"))
+    key = params_key({"N": 10})
+    _trajectory(cache.path(key), "some other key")
+    assert cache.lookup(key) is None
+    assert not os.path.exists(cache.path(key))
+
+def test_eviction_keeps_most_recently_used(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "cache"), maxBytes=10**9)
+    keys = [params_key({"N": n}) for n in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, _trajectory(tmp_path / "t.h5", key, nbytes=100000))
+        os.utime(cache.path(key), (i, i)) # Distinct last used times
+    cache.lookup(keys[0]) # Now the most recently used
+    cache.maxBytes = 2 * os.path.getsize(cache.path(keys[0]))
+    cache.evict()
+    assert [os.path.exists(cache.path(k)) for k in keys] == [True, False, True]
+
+def test_store_keeps_new_entry_over_limit(tmp_path):
+    cache = TrajectoryCache(str(tmp_path / "cache"), maxBytes=1)
+    old, new = params_key({"N": 1}), params_key({"N": 2})
+    cache.store(old, _trajectory(tmp_path / "t.h5", old))
+    p = cache.store(new, _trajectory(tmp_path / "t.h5", new))
+    assert not os.path.exists(cache.path(old))
+    assert cache.lookup(new) == p
+
+def test_entries_vanishing_during_eviction(tmp_path, monkeypatch):
+    cache = TrajectoryCache(str(tmp_path / "cache"), maxBytes=1)
+    keys = [params_key({"N": n}) for n in range(2)]
+    for key in keys:
+        _trajectory(cache.path(key), key)
+    listdir = os.listdir
+    def racing(path): # Another process evicts every entry right after this one lists them
+        names = listdir(path)
+        for key in keys:
+            os.unlink(cache.path(key))
+        return names
+    monkeypatch.setattr(os, "listdir", racing)
+    assert cache.entries() == []
+    monkeypatch.setattr(os, "listdir", listdir)
+    for key in keys:
+        _trajectory(cache.path(key), key)
+    entries = cache.entries()
+    os.unlink(entries[0][0])
+    monkeypatch.setattr(cache, "entries", lambda: entries)
+    cache.evict()
+    assert not any(os.path.exists(cache.path(k)) for k in keys)
+
+def test_run_1D_needs_output_without_cache():
+    with pytest.raises(ValueError):
+        run_1D({}, outf=None, cache=False)